@@ -0,0 +1,163 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Static files and pages served from memory, compressed once.
+
+Static files are fingerprinted: url_for('static', filename='main.js') gives
+/static/main.<hash>.js, which never changes, so browsers may keep it
+forever. Files are compressed with gzip (and brotli, if the module is
+installed) when loaded, responses are chosen by Accept-Encoding.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from collections import namedtuple
+import gzip
+from hashlib import sha1
+import logging as log
+import mimetypes
+import os
+import threading
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only
+    brotli = None
+
+
+log.basicConfig(level=log.DEBUG)
+
+Asset = namedtuple('Asset', 'mimetype,etag,encodings')
+FOREVER = 365 * 24 * 3600  # [s]
+# types worth compressing, other (images) are compressed already
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                'application/xml', 'image/svg+xml', 'image/x-icon',
+                'image/vnd.microsoft.icon')
+
+
+def make_asset(body, mimetype):
+    """Asset of body, with its compressed variants (if they are smaller)."""
+    encodings = {'identity': body}
+    if mimetype.startswith(COMPRESSIBLE):
+        compressed = {'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body)
+        encodings.update(
+            (name, data) for name, data in compressed.items()
+            if len(data) < len(body)
+        )
+    return Asset(mimetype, sha1(body).hexdigest()[:20], encodings)
+
+
+def respond(asset, immutable=False):
+    """Response with asset, in the best encoding accepted by the client;
+    304 if the client has it already."""
+    encoding = 'identity'
+    for name in ('br', 'gzip'):
+        if name in asset.encodings and request.accept_encodings[name]:
+            encoding = name
+            break
+    etag = asset.etag if encoding == 'identity' else \
+        '{}-{}'.format(asset.etag, encoding)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset.encodings[encoding],
+                            mimetype=asset.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = FOREVER
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+class StaticAssets:
+    """Files of directory, loaded into memory, by original and fingerprinted
+    (name.<hash>.ext) paths."""
+
+    def __init__(self, directory):
+        self.assets = {}  # path -> Asset
+        self.urls = {}  # path -> fingerprinted path
+        self.fingerprinted = {}  # fingerprinted path -> path
+        for root, _, files in os.walk(directory):
+            for name in files:
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, directory).replace(os.sep,
+                                                                     '/')
+                with open(full_path, 'rb') as source:
+                    body = source.read()
+                asset = make_asset(
+                    body,
+                    mimetypes.guess_type(name)[0] or
+                    'application/octet-stream'
+                )
+                base, ext = os.path.splitext(path)
+                fingerprinted = '{}.{}{}'.format(base, asset.etag[:10], ext)
+                self.assets[path] = asset
+                self.urls[path] = fingerprinted
+                self.fingerprinted[fingerprinted] = path
+        log.info('%d static files loaded', len(self.assets))
+
+    def url_path(self, path):
+        """Fingerprinted path of file (path itself if there is no such
+        file)."""
+        return self.urls.get(path.lstrip('/'), path)
+
+    def response(self, path):
+        """Response with file by (fingerprinted or original) path, None if
+        there is no such file. Fingerprinted ones may be kept forever."""
+        if path in self.fingerprinted:
+            return respond(self.assets[self.fingerprinted[path]],
+                           immutable=True)
+        if path in self.assets:
+            return respond(self.assets[path])
+        return None
+
+
+class PageCache:
+    """Pages rendered once for each version of what they show."""
+
+    def __init__(self):
+        self.pages = {}  # name -> (version, Asset)
+        self._lock = threading.Lock()
+
+    def get(self, name, version, render, mimetype='text/html'):
+        """Asset of page, rendered by render() if version changed."""
+        cached = self.pages.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with self._lock:
+            cached = self.pages.get(name)
+            if cached is None or cached[0] != version:
+                body = render()
+                if isinstance(body, str):
+                    body = body.encode()
+                cached = version, make_asset(body, mimetype)
+                self.pages[name] = cached
+        return cached[1]
@@ -0,0 +1,26 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmarks for cnt4gd77, run from the project root, e.g.:
+
+    python -m benchmarks.memory
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
@@ -0,0 +1,177 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Deterministic synthetic data for benchmarks, no network needed.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import random
+
+from lxml import etree
+import msgpack
+
+from przemienniki import PrzemiennikiWrapper
+from store import ContactRecord
+
+
+PREFIXES = ['SP', 'SQ', 'SO', 'SN', 'HF', '3Z', 'DL', 'OK', 'OE', 'G']
+NAMES = ['Jan', 'Adam', 'Piotr', 'Pawel', 'Krzysztof', 'Tomasz', 'Marek']
+COUNTRIES = [('Poland', 'PL'), ('Germany', 'DE'), ('Czech Republic', 'CZ')]
+LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def synthetic_records(count, seed=260):
+    """Generate ham-digital like records (as parsed from CSV)."""
+    rnd = random.Random(seed)
+    for num in range(count):
+        callsign = '{}{}{}'.format(
+            rnd.choice(PREFIXES),
+            rnd.randint(0, 9),
+            ''.join(rnd.choice(LETTERS) for _ in range(rnd.randint(1, 3)))
+        )
+        country, ctry = rnd.choice(COUNTRIES)
+        yield ContactRecord(
+            num=str(num + 1),
+            callsign=callsign,
+            dmrid=str(2600000 + num),
+            name=rnd.choice(NAMES),
+            country=country,
+            ctry=ctry
+        )
+
+
+def synthetic_repeaters(count, seed=260):
+    """Generate przemienniki.net like Repeater records."""
+    rnd = random.Random(seed)
+    for num in range(count):
+        band = rnd.choice(['2M', '70CM', '23CM'])
+        base, shift = {'2M': (145.0, -0.6), '70CM': (438.0, -7.6),
+                       '23CM': (1296.0, -28.0)}[band]
+        tx_freq = base + rnd.randint(0, 48) * 0.0125
+        modes = rnd.sample(['FM', 'MOTOTRBO', 'FMLINK', 'ECHOLINK'],
+                           rnd.randint(1, 2))
+        ctcss = rnd.random() < 0.5
+        yield PrzemiennikiWrapper.REP(
+            sign='SR{}{}'.format(
+                rnd.randint(0, 9),
+                ''.join(rnd.choice(LETTERS) for _ in range(3))
+            ) + (str(num // 1000) if num >= 1000 else ''),
+            modes=modes,
+            working=True,
+            bands=[band],
+            freqs=[{'rx': '{:.4f}'.format(tx_freq + shift)},
+                   {'tx': '{:.4f}'.format(tx_freq)}],
+            activation=['CTCSS'] if ctcss else ['1750'],
+            tones={'rx': '88.5', 'tx': '94.8'} if ctcss else {},
+            lat=round(rnd.uniform(49.0, 54.8), 4),
+            lon=round(rnd.uniform(14.1, 24.1), 4)
+        )
+
+
+def contacts_csv(count, seed=260):
+    """ham-digital user list (as served upstream) of count records."""
+    lines = ['Nr;Call;ID;Name;Country;Ctry']
+    for record in synthetic_records(count, seed):
+        lines.append(';'.join(record) + ';')
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def repeaters_xml(count, seed=260):
+    """przemienniki.net rxf.xml (as served upstream) of count repeaters."""
+    root = etree.Element('rxf')
+    repeaters = etree.SubElement(root, 'repeaters')
+    for rep in synthetic_repeaters(count, seed):
+        element = etree.SubElement(repeaters, 'repeater')
+        etree.SubElement(element, 'qra').text = rep.sign
+        for mode in rep.modes:
+            etree.SubElement(element, 'mode').text = mode
+        etree.SubElement(element, 'statusInt').text = '1'
+        for band in rep.bands:
+            etree.SubElement(element, 'band').text = band
+        for freq in rep.freqs:
+            for kind, value in freq.items():
+                etree.SubElement(element, 'qrg', type=kind).text = value
+        for activation in rep.activation:
+            etree.SubElement(element, 'activation').text = activation
+        for kind, value in sorted(rep.tones.items()):
+            etree.SubElement(element, 'ctcss', type=kind).text = value
+        etree.SubElement(element, 'latitude').text = str(rep.lat)
+        etree.SubElement(element, 'longitude').text = str(rep.lon)
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+
+ALL_AREAS = [str(area) for area in range(10)]
+SP_PREFIXES = ['HF', 'SN', 'SO', 'SP', 'SQ', '3Z']
+
+
+def _query(prefixes=(), areas=(), tgs=(), adds=(), prio='', igno='',
+           repeaters=None, services=None, apmr=(), dpmr=()):
+    return {
+        'contacts': {
+            'sp_prefix': list(prefixes),
+            'sp_area': list(areas),
+            'tgs': list(tgs),
+            'adds': list(adds),
+            'prio': prio,
+            'igno': igno
+        },
+        'channels': {
+            'repeaters': repeaters or {},
+            'services': services or {},
+            'apmr': list(apmr),
+            'dpmr': list(dpmr)
+        }
+    }
+
+
+# queries as sent by the main page, from the smallest to the biggest file
+QUERIES = {
+    'talkgroups': _query(tgs=['260', '2605'], adds=['sp5kab'], prio='SP5AB'),
+    'one_area': _query(
+        prefixes=['SP', 'SQ'], areas=['5'], tgs=['260', '2605'],
+        adds=['260097', 'sp5kab'], prio='SP5AB, SQ5XYZ', igno='SP5ABC'
+    ),
+    'one_area_zip': _query(
+        prefixes=['SP', 'SQ', 'SO'], areas=['5', '7'], tgs=['260', '2605'],
+        adds=['sp5kab'], prio='SP5AB',
+        repeaters={'bands': ['2m', '70cm'], 'modes': ['FM', 'MOTOTRBO'],
+                   'areas': ['5', '7'], 'digi_first': True,
+                   'digi_double': True},
+        services={'Metro': ['154.45']}, apmr=['446.00625', '446.01875']
+    ),
+    'whole_country': _query(prefixes=SP_PREFIXES, areas=ALL_AREAS,
+                            tgs=['260']),
+    'whole_country_zip': _query(
+        prefixes=SP_PREFIXES, areas=ALL_AREAS, tgs=['260'],
+        repeaters={'bands': ['2m', '70cm'],
+                   'modes': ['FM', 'MOTOTRBO', 'FMLINK', 'ECHOLINK'],
+                   'areas': ALL_AREAS, 'digi_first': False,
+                   'digi_double': False}
+    ),
+}
+
+
+def packed_queries():
+    """QUERIES msgpack-ed and hex encoded, as in /csv/<query> URLs."""
+    return {
+        name: msgpack.packb(query, use_bin_type=True).hex()
+        for name, query in QUERIES.items()
+    }
@@ -0,0 +1,470 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Load test of the app under gunicorn, with upstream replaced by local stubs.
+
+    python -m benchmarks.load [--worker-class sync gthread] [--workers 2 4]
+                              [--threads N] [--duration S] [--concurrency N]
+                              [--save FILE] [--compare FILE] [--max-errors R]
+
+Stand-ins for ham-digital, przemienniki.net and sp5kab.pl serve synthetic
+data (see fixtures) over HTTP on localhost, the app fetches it from them
+(upstream: urls in config). For every combination of worker class and
+number of workers gunicorn is started, loaded with a mix of requests, as
+made by browsers, from --concurrency clients for --duration seconds (after
+--warmup), and stopped:
+
+    /               the main page (--index part of requests)
+    /csv/<query>    queries of fixtures; --unique part of them with own
+                    priority list (not cached), --revalidate part of all
+                    requests conditional (If-None-Match), as on reload
+
+Reported: throughput (requests and megabytes per second), latency
+percentiles, error rate (neither 200 nor 304, or failed) and memory (rss) of
+the master and every worker after the test (Linux only). Results are saved
+as JSON (--save) and compared with previously saved ones (--compare); exits
+with 1 if throughput dropped or p95 latency rose by more than --threshold,
+or errors appeared, and whenever error rate is above --max-errors.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import argparse
+from datetime import datetime
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging as log
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import msgpack
+import requests
+import yaml
+
+from benchmarks.fixtures import (QUERIES, contacts_csv, repeaters_xml,
+                                 synthetic_records)
+from benchmarks.workers import children, memory
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OK = (200, 304)
+
+
+class Upstream:
+    """Upstream sources served from memory by a local HTTP server, with
+    ETags (so the app may revalidate them)."""
+
+    def __init__(self, contacts, repeaters, members):
+        self.files = {
+            '/contacts': (contacts_csv(contacts).encode(),
+                          'text/csv; charset=utf-8'),
+            '/repeaters': (repeaters_xml(repeaters), 'text/xml'),
+            '/kab': (self.kab_html(contacts, members).encode(),
+                     'text/html; charset=utf-8'),
+        }
+        self.requests = 0
+        self.server = None
+
+    @staticmethod
+    def kab_html(contacts, members):
+        """Members page of SP5KAB, with some of the contacts."""
+        items = ''.join(
+            '<li>{} {}</li>'.format(record.name, record.callsign)
+            for record in synthetic_records(min(members, contacts))
+        )
+        return '<html><body><div class="entry-content"><ul>{}</ul></div>' \
+               '</body></html>'.format(items)
+
+    def start(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=C0103
+                upstream.requests += 1
+                found = upstream.files.get(self.path)
+                if found is None:
+                    self.send_error(404)
+                    return
+                body, content_type = found
+                etag = '"{}"'.format(sha1(body).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def urls(self):
+        """Source name -> URL, as in upstream: urls of config."""
+        return {
+            name: 'http://127.0.0.1:{}/{}'.format(self.server.server_port,
+                                                  name)
+            for name in ('contacts', 'repeaters', 'kab')
+        }
+
+
+def prepare(directory, urls, refresh_interval):
+    """Write config (using upstream stubs) into directory."""
+    with open(os.path.join(PROJECT, 'config.yaml')) as cfg_file:
+        config = yaml.safe_load(cfg_file)
+    config.update({
+        'snapshot': None,  # every run starts from upstream
+        'refresh_interval': refresh_interval,
+        'presets_dir': os.path.join(directory, 'presets'),
+    })
+    config.setdefault('upstream', {})['urls'] = urls
+    config.setdefault('saved_queries', {})['directory'] = \
+        os.path.join(directory, 'queries')
+    config.setdefault('profiling', {})['directory'] = \
+        os.path.join(directory, 'profiles')
+    with open(os.path.join(directory, 'config.yaml'), 'w') as cfg_file:
+        yaml.safe_dump(config, cfg_file)
+
+
+def csv_path(query):
+    return '/csv/' + msgpack.packb(query, use_bin_type=True).hex()
+
+
+class Traffic:
+    """Requests (paths) as made by browsers, see module docs."""
+
+    def __init__(self, seed, index=0.2, unique=0.2):
+        self.rnd = random.Random(seed)
+        self.index = index
+        self.unique = unique
+        self.paths = [csv_path(query) for _, query in sorted(QUERIES.items())]
+        self.callsigns = [record.callsign
+                          for record in synthetic_records(1000, seed)]
+
+    def next_path(self):
+        if self.rnd.random() < self.index:
+            return '/'
+        if self.rnd.random() < self.unique:
+            query = dict(self.rnd.choice(list(QUERIES.values())))
+            query['contacts'] = dict(query['contacts'], prio=' '.join(
+                self.rnd.sample(self.callsigns, 3)))
+            return csv_path(query)
+        return self.rnd.choice(self.paths)
+
+
+def client(task):
+    """Make requests from threads, returns [(start, seconds, status,
+    bytes)] of requests started after warmup."""
+    url, threads, seed, options = task
+    start = time.perf_counter()
+    measured_from = start + options['warmup']
+    until = measured_from + options['duration']
+    results = []
+
+    def run(num):
+        session = requests.Session()
+        session.trust_env = False
+        traffic = Traffic(seed * 1000 + num, options['index'],
+                          options['unique'])
+        etags = {}
+        rnd = random.Random(seed * 1000 + num)
+        while True:
+            begin = time.perf_counter()
+            if begin >= until:
+                break
+            path = traffic.next_path()
+            headers = {'Accept-Encoding': 'gzip, br'}
+            if path in etags and rnd.random() < options['revalidate']:
+                headers['If-None-Match'] = etags[path]
+            try:
+                response = session.get(url + path, headers=headers,
+                                       timeout=60)
+                size = len(response.content)
+                status = response.status_code
+                if 'ETag' in response.headers:
+                    etags[path] = response.headers['ETag']
+            except requests.RequestException:
+                size, status = 0, 0
+            if begin >= measured_from:
+                results.append(
+                    (begin, time.perf_counter() - begin, status, size))
+
+    pool = [threading.Thread(target=run, args=(num,))
+            for num in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return results
+
+
+def load(url, options):
+    """Load server from client processes (each with some threads), returns
+    all [(start, seconds, status, bytes)]."""
+    processes = min(options['concurrency'], options['clients'])
+    tasks = [
+        (url, options['concurrency'] // processes +
+         (1 if num < options['concurrency'] % processes else 0), num,
+         options)
+        for num in range(processes)
+    ]
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        return [result for results in pool.map(client, tasks)
+                for result in results]
+
+
+def start_server(directory, worker_class, workers, threads, preload, port):
+    """Start gunicorn, wait until it serves data, returns the process."""
+    env = dict(
+        os.environ,
+        GD77_PRELOAD='1' if preload else '0',
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(directory, 'metrics'),
+        NO_PROXY='127.0.0.1,localhost',
+    )
+    env.pop('GD77_PRELOADED', None)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn',
+         '-c', os.path.join(PROJECT, 'gunicorn.conf.py'),
+         '--pythonpath', PROJECT, '-k', worker_class, '-w', str(workers),
+         '--threads', str(threads), '-b', '127.0.0.1:{}'.format(port),
+         '--timeout', '120', '--log-level', 'warning', 'main:app'],
+        cwd=directory, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    session = requests.Session()
+    session.trust_env = False
+    start = time.perf_counter()
+    while True:
+        if server.poll() is not None or time.perf_counter() - start > 300:
+            stop_server(server)
+            raise RuntimeError('gunicorn did not start')
+        try:
+            if session.get('http://127.0.0.1:{}/'.format(port),
+                           timeout=5).status_code == 200:
+                return server
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+
+
+def stop_server(server):
+    if server.poll() is None:
+        server.terminate()
+        server.wait()
+
+
+def summary(results, duration):
+    """Metrics of [(start, seconds, status, bytes)] of duration."""
+    latencies = sorted(seconds for _, seconds, _, _ in results)
+    errors = sum(1 for _, _, status, _ in results if status not in OK)
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = latencies[0] if latencies else 0
+    return {
+        'requests': len(results),
+        'throughput': len(results) / duration,
+        'megabytes_per_second':
+            sum(size for _, _, _, size in results) / duration / 2**20,
+        'p50_ms': p50 * 1000,
+        'p95_ms': p95 * 1000,
+        'p99_ms': p99 * 1000,
+        'error_rate': errors / len(results) if results else 1.0,
+    }
+
+
+def run_config(directory, name, worker_class, workers, options):
+    """Load test of one configuration, returns its metrics."""
+    server = start_server(directory, worker_class, workers,
+                          options['threads'], options['preload'],
+                          options['port'])
+    try:
+        results = load('http://127.0.0.1:{}'.format(options['port']),
+                       options)
+        metrics = summary(results, options['duration'])
+        metrics['rss_mib'] = {
+            process: values['rss'] / 2**20 for process, values in
+            [('master', memory(server.pid))] + [
+                ('worker {}'.format(num), memory(pid))
+                for num, pid in enumerate(children(server.pid), 1)
+            ]
+        }
+    finally:
+        stop_server(server)
+    report(name, metrics)
+    return metrics
+
+
+def report(name, metrics):
+    print('{}: {} requests, {:.1f} req/s, {:.1f} MiB/s, errors {:.2%}'.format(
+        name, metrics['requests'], metrics['throughput'],
+        metrics['megabytes_per_second'], metrics['error_rate']))
+    print('  latency [ms]  p50 {:.1f}  p95 {:.1f}  p99 {:.1f}'.format(
+        metrics['p50_ms'], metrics['p95_ms'], metrics['p99_ms']))
+    print('  rss [MiB]     {}\n'.format(', '.join(
+        '{} {:.1f}'.format(process, rss)
+        for process, rss in metrics['rss_mib'].items())))
+
+
+def compare(results, baseline, threshold):
+    """Print results against baseline, returns number of regressions."""
+    regressions = 0
+    print("{:<40} {:>12} {:>12} {:>8}".format(
+        'configuration', 'baseline', 'now', 'ratio'))
+    for name in sorted(results):
+        old = baseline.get(name)
+        if not old:
+            continue
+        for metric, lower_is_worse in (('throughput', True),
+                                       ('p95_ms', False)):
+            ratio = results[name][metric] / (old[metric] or 1)
+            worse = ratio < 1 - threshold if lower_is_worse else \
+                ratio > 1 + threshold
+            mark = ' !' if worse else ''
+            regressions += bool(mark)
+            print("{:<40} {:>12.4g} {:>12.4g} {:>7.2f}x{}".format(
+                '{} {}'.format(name, metric), old[metric],
+                results[name][metric], ratio, mark))
+        if results[name]['error_rate'] > old['error_rate']:
+            print("{:<40} {:>12.2%} {:>12.2%} {:>8} !".format(
+                '{} error_rate'.format(name), old['error_rate'],
+                results[name]['error_rate'], ''))
+            regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--worker-class', nargs='+', default=['gthread'],
+                        help='gunicorn worker classes')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4],
+                        help='numbers of workers')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='threads of gthread workers')
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='every worker loads data (GD77_PRELOAD=0)')
+    parser.add_argument('--contacts', type=int, default=300000)
+    parser.add_argument('--repeaters', type=int, default=3000)
+    parser.add_argument('--members', type=int, default=60,
+                        help='members of SP5KAB')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='measured time [s]')
+    parser.add_argument('--warmup', type=float, default=5,
+                        help='load before measuring [s]')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='clients making requests at once')
+    parser.add_argument('--clients', type=int,
+                        default=max(1, (os.cpu_count() or 2) // 2),
+                        help='processes the clients run in')
+    parser.add_argument('--index', type=float, default=0.2,
+                        help='part of requests for the main page')
+    parser.add_argument('--unique', type=float, default=0.2,
+                        help='part of exports with own priority list')
+    parser.add_argument('--revalidate', type=float, default=0.3,
+                        help='part of requests made with If-None-Match')
+    parser.add_argument('--refresh-interval', type=int, default=0,
+                        help='refresh of upstream data during the test [s]')
+    parser.add_argument('--port', type=int, default=8079)
+    parser.add_argument('--save', metavar='FILE', help='save results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with results saved before')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown, 0.1 means 10%%')
+    parser.add_argument('--max-errors', type=float, default=0.01,
+                        help='allowed error rate, 0.01 means 1%%')
+    args = parser.parse_args()
+    options = vars(args)
+    log.getLogger().setLevel(log.WARNING)  # not every request of clients
+
+    upstream = Upstream(args.contacts, args.repeaters, args.members).start()
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            prepare(directory, upstream.urls, args.refresh_interval)
+            for worker_class in args.worker_class:
+                for workers in args.workers:
+                    name = '{} x{}{}{}'.format(
+                        worker_class, workers,
+                        ' ({} threads)'.format(args.threads)
+                        if worker_class == 'gthread' else '',
+                        '' if args.preload else ' no preload'
+                    )
+                    try:
+                        results[name] = run_config(directory, name,
+                                                   worker_class, workers,
+                                                   options)
+                    except RuntimeError as error:  # e.g. no such worker
+                        print('{}: {}\n'.format(name, error))
+    finally:
+        upstream.stop()
+    print('{} upstream requests'.format(upstream.requests))
+    failed = sorted(name for name, metrics in results.items()
+                    if metrics['error_rate'] > args.max_errors)
+    for name in failed:
+        print('!!! {}: error rate {:.2%} above {:.2%}, results are not '
+              'valid'.format(name, results[name]['error_rate'],
+                             args.max_errors))
+
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump({
+                'meta': {
+                    'date': datetime.utcnow().isoformat(),
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'cpus': os.cpu_count(),
+                    'options': options,
+                },
+                'results': results
+            }, out, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline)['results'],
+                                  args.threshold)
+        print("{} regression(s)".format(regressions))
+        return 1 if regressions or failed else 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
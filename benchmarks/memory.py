@@ -0,0 +1,62 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Memory footprint of the contact storage engines.
+
+    python -m benchmarks.memory [number of contacts]
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from benchmarks.fixtures import synthetic_records
+from store import STORES
+
+
+def measure(store_cls, count):
+    """Return (retained bytes, load seconds) of store filled with count
+    records. Records are created while tracing, as they are when parsing."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = store_cls(synthetic_records(count))
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return size, elapsed
+
+
+def main(count):
+    print("{:<10} {:>10} {:>14} {:>10}".format(
+        'store', 'contacts', 'memory [MiB]', 'load [s]'))
+    for name, store_cls in sorted(STORES.items()):
+        size, elapsed = measure(store_cls, count)
+        print("{:<10} {:>10} {:>14.2f} {:>10.2f}".format(
+            name, count, size / 2**20, elapsed))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300000)
@@ -0,0 +1,144 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Rows per second of CSV rendering: formatting every row on each export (as
+done before rows were pre-rendered) against pre-rendered rows.
+
+    python -m benchmarks.rendering [contacts] [repeaters]
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import sys
+import time
+
+from benchmarks.fixtures import synthetic_records, synthetic_repeaters
+from channels import ChannelsFactory
+from contacts import ContactsFactory
+from przemienniki import PrzemiennikiWrapper
+from store import STORES
+import settings
+import utils
+
+
+def format_contacts(records):
+    """Contacts CSV formatted row by row, as it was before pre-rendering."""
+    line = "{num},{name},{dmrid:0>8},{type},On,1\r\n"
+    for i, record in enumerate(records):
+        yield line.format(
+            num=i,
+            name=' '.join([record.callsign, record.name]).strip(),
+            dmrid=record.dmrid,
+            type="Group All" if len(record.dmrid) <= 5 else "Private Call"
+        ).encode()
+
+
+def format_channels(channels):
+    """Channels CSV formatted row by row, as it was before pre-rendering."""
+    line = "{number},{name},\"{rx_freq:0<9}\",\"{tx_freq:0<9}\",{mode},"\
+           "{power},\"{rx_tone}\",\"{tx_tone}\",{color},{rx_group},"\
+           "{contact},{slot}\r\n"
+    for i, rec in enumerate(channels):
+        yield line.format(
+            number=i,
+            name=rec.name,
+            rx_freq=str(rec.rx_freq).replace('.', ','),
+            tx_freq=str(rec.tx_freq).replace('.', ','),
+            mode=rec.mode,
+            power=rec.power,
+            rx_tone=str(rec.rx_tone).replace('.', ','),
+            tx_tone=str(rec.tx_tone).replace('.', ','),
+            color=rec.color,
+            rx_group=rec.rx_group,
+            contact=rec.contact,
+            slot=rec.slot
+        ).encode()
+
+
+def rate(rows, rounds=5):
+    """Best rows per second of consuming rows() generator."""
+    best = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        count = sum(1 for _ in rows())
+        best = max(best, count / (time.perf_counter() - start))
+    return best
+
+
+def report(name, before, after):
+    print("{:<18} {:>14,.0f} {:>14,.0f} {:>8.1f}x".format(
+        name, before, after, after / before))
+
+
+def number_rows(rows):
+    """Pre-rendered rows numbered, as done by iter_csv()."""
+    for i, row in enumerate(rows):
+        yield b'%d,' % i + row
+
+
+def main(contacts_count, repeaters_count):
+    utils.CONFIG = settings.Config({'supported_bands': ['2m', '70cm']})
+    utils.REPS = PrzemiennikiWrapper(
+        repeaters=list(synthetic_repeaters(repeaters_count)))
+    print("{:<18} {:>14} {:>14} {:>9}".format(
+        'rows/s', 'formatted', 'pre-rendered', 'speedup'))
+
+    keys = [p + str(a) for p in ['SP', 'SQ', 'SO', 'SN', 'HF', '3Z']
+            for a in range(10)]
+    for name, store_cls in sorted(STORES.items()):
+        contacts = ContactsFactory(
+            store=store_cls(synthetic_records(contacts_count)))
+        selected = [contacts.records[rec_id]
+                    for rec_id, _, _ in contacts.records.sieve(keys)]
+        rows = [row for _, _, row in contacts.records.sieve(keys)]
+        report(
+            'contacts ({})'.format(name),
+            rate(lambda: format_contacts(selected)),
+            rate(lambda: number_rows(rows))
+        )
+
+    channels = ChannelsFactory()
+    selection = {'bands': ['2m', '70cm'], 'modes': ['FM', 'MOTOTRBO'],
+                 'areas': [str(a) for a in range(10)]}
+    rows = []
+    channels.add_repeaters(rows, digi_first=True, digi_double=False,
+                           **selection)
+    records = []
+    for pos in utils.REPS.index.select(**selection):
+        for band in selection['bands']:
+            params = utils.REPS.index.params.get((pos, band))
+            if params:
+                records.append(ChannelsFactory.ChannelRecord(
+                    utils.REPS.repeaters[pos].sign, params.tx, params.rx,
+                    "Digital" if params.digital else "Analog", 'High',
+                    params.tx_tone, params.rx_tone, int(params.digital),
+                    1, 1, 1))
+    report(
+        'channels',
+        rate(lambda: format_channels(records)),
+        rate(lambda: number_rows(rows))
+    )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    )
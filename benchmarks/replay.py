@@ -0,0 +1,223 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Replay a query against a snapshot and draw a flamegraph of it.
+
+    python -m benchmarks.replay QUERY [--snapshot FILE] [--repeat N] ...
+
+QUERY is a query file (msgpack): <name>.query written by profiling, or
+<id>.query of saved queries, or ID of a saved query. The file for the query
+is generated (as for presets, with the same content as /csv/<query>) repeat
+times, from data of the snapshot, while the stack of generating thread is
+sampled. Results:
+
+    <out>.folded    sampled stacks, one per line with count, as used by
+                    flamegraph.pl, speedscope, ...
+    <out>.svg       flamegraph, open in a browser
+
+With --as-csv only the CSV files are generated, by as_csv of contacts and
+channels (lines of the files as str, without the zip archive).
+
+Run from the project directory (config.yaml is loaded from there).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import argparse
+from collections import Counter
+from html import escape
+import os
+import sys
+import threading
+import time
+import zlib
+
+import msgpack
+
+from channels import ChannelsFactory
+from fetch import ConditionalFetcher
+from presets import build
+import snapshot
+import utils
+
+
+class Sampler:
+    """Stacks of thread sampled every interval seconds, as {stack: count}
+    where stack is tuple of 'module:function' from the outermost frame."""
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._switch_interval = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    @staticmethod
+    def _name(code):
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        return '{}:{}'.format(module, code.co_name)
+
+    def _sample(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(  # pylint: disable=W0212
+                self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self.interval, self._switch_interval))
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stop_event.set()
+        self._thread.join()
+        sys.setswitchinterval(self._switch_interval)
+
+
+def folded(stacks):
+    """Stacks in 'folded' format."""
+    return ''.join(
+        '{} {}\n'.format(';'.join(stack), count)
+        for stack, count in sorted(stacks.items())
+    )
+
+
+def flamegraph(stacks, title, width=1200, row=16):
+    """SVG flamegraph of {stack: count}."""
+    tree = {}  # name -> [count, children]
+    for stack, count in stacks.items():
+        level = tree
+        for name in stack:
+            node = level.setdefault(name, [0, {}])
+            node[0] += count
+            level = node[1]
+    total = sum(stacks.values()) or 1
+    depth = max((len(stack) for stack in stacks), default=0)
+    height = (depth + 2) * row
+    scale = width / total
+    rects = []
+
+    def draw(level, x, y):
+        for name, (count, children) in sorted(level.items()):
+            box = count * scale
+            if box >= 0.5:
+                hue = zlib.crc32(name.encode()) % 60
+                label = name if len(name) * 7 < box - 4 else \
+                    name[:max(0, int((box - 4) / 7) - 2)] + '..'
+                rects.append(
+                    '<g><title>{name} ({count} samples, {share:.1f}%)'
+                    '</title><rect x="{x:.1f}" y="{y}" width="{w:.1f}" '
+                    'height="{h}" fill="hsl({hue},90%,60%)"/>'
+                    '<text x="{tx:.1f}" y="{ty}">{label}</text></g>'.format(
+                        name=escape(name), count=count,
+                        share=100 * count / total, x=x, y=y, w=box,
+                        h=row - 1, hue=hue, tx=x + 3, ty=y + row - 4,
+                        label=escape(label) if len(label) > 2 else ''
+                    )
+                )
+                draw(children, x, y - row)
+            x += box
+
+    draw(tree, 0, height - 2 * row)
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}" '
+        'font-family="monospace" font-size="11">\n'
+        '<text x="4" y="{ty}">{title} ({total} samples)</text>\n{rects}\n'
+        '</svg>\n'
+    ).format(w=width, h=height, ty=height - 4, title=escape(title),
+             total=total, rects='\n'.join(rects))
+
+
+def query_path(query):
+    """Path of query file, given as path or ID of saved query."""
+    if os.path.exists(query):
+        return query
+    return os.path.join(
+        utils.CONFIG.get('saved_queries', {}).get('directory', 'queries'),
+        '{}.query'.format(query)
+    )
+
+
+def as_csv(query, channels):
+    """CSV files for query by as_csv, joined: returns (body, mimetype,
+    extension) as build."""
+    lines = utils.CONTACTS.as_csv(query['contacts'])
+    if utils.are_channels_requested(query):
+        lines += channels.as_csv(query['channels'])
+    return ''.join(lines).encode(), 'text/csv', 'csv'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('query', help='query file or ID of saved query')
+    parser.add_argument('--snapshot',
+                        help='snapshot file (default: from config)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=0.001,
+                        help='sampling interval [s]')
+    parser.add_argument('--out', help='output files name (default: name '
+                                      'of query file)')
+    parser.add_argument('--as-csv', action='store_true',
+                        help='generate the files by as_csv')
+    args = parser.parse_args()
+
+    utils.load_config()
+    path = query_path(args.query)
+    with open(path, 'rb') as source:
+        query = msgpack.unpackb(source.read(), raw=False)
+    snapshot_path = args.snapshot or utils.CONFIG.get('snapshot')
+    if not snapshot_path or \
+            not snapshot.load(snapshot_path, ConditionalFetcher()):
+        print('Cannot load snapshot {}'.format(snapshot_path))
+        return 1
+
+    channels = ChannelsFactory()
+    generate = as_csv if args.as_csv else build
+    generate(query, channels)  # warm up
+    start = time.perf_counter()
+    with Sampler(threading.get_ident(), args.interval) as sampler:
+        for _ in range(args.repeat):
+            body, _, _ = generate(query, channels)
+    seconds = (time.perf_counter() - start) / args.repeat
+
+    out = args.out or os.path.splitext(os.path.basename(path))[0]
+    with open(out + '.folded', 'w') as folded_file:
+        folded_file.write(folded(sampler.stacks))
+    with open(out + '.svg', 'w') as svg_file:
+        svg_file.write(flamegraph(
+            sampler.stacks,
+            '{}: {:.3f} s, {} bytes'.format(os.path.basename(path), seconds,
+                                           len(body))
+        ))
+    print('{:.3f} s per export ({} bytes), {} samples written to {}.svg '
+          'and {}.folded'.format(seconds, len(body),
+                                 sum(sampler.stacks.values()), out, out))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
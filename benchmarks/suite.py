@@ -0,0 +1,253 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmarks of the export hot paths on synthetic data, no network needed.
+
+    python -m benchmarks.suite [--contacts N ...] [--repeaters N]
+                               [--save FILE] [--compare FILE]
+
+For every contact list size and store engine it measures:
+
+    ingest.*    parsing upstream CSV / rxf.xml into stores (time, peak memory)
+    decode      unpacking of /csv/<query> queries
+    select      choosing contacts and channels (iter_csv of both factories)
+    render      joining selected rows into file chunks
+    zip         packing both files into the zip archive
+    export      all of the above for one query (time, peak memory)
+
+Times are the best of --rounds runs, in seconds. Results are saved as JSON
+(--save) and compared with previously saved ones (--compare); exits with 1
+if anything got slower (or bigger) than --threshold. Times below a
+millisecond are too noisy to be compared and are only shown.
+
+Run from the project directory (config.yaml is loaded from there).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import argparse
+from datetime import datetime
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import msgpack
+
+from benchmarks.fixtures import (QUERIES, contacts_csv, packed_queries,
+                                 repeaters_xml)
+from channels import ChannelsFactory
+from contacts import ContactsFactory
+from przemienniki import PrzemiennikiWrapper
+from store import STORES
+import utils
+
+
+def best_time(func, rounds):
+    """Best wall time of rounds calls of func."""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_memory(func):
+    """Peak of memory (in bytes) allocated while running func."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def export_stages(query, channels):
+    """Generate file of query stage by stage, as main.stream_export does."""
+    lines = list(utils.CONTACTS.iter_csv(query['contacts']))
+    if not utils.are_channels_requested(query):
+        return b''.join(utils.chunked(lines))
+    channel_lines = list(channels.iter_csv(query['channels']))
+    return b''.join(utils.iter_zip([
+        ('contacts.csv', utils.chunked(lines)),
+        ('channels.csv', utils.chunked(channel_lines))
+    ]))
+
+
+def bench_ingest(results, prefix, text, xml, rounds):
+    """Parse upstream data into stores, leaves the last ones in utils."""
+    for name in sorted(STORES):
+        utils.CONFIG = utils.CONFIG.replace(contact_store=name)
+        key = '{}.ingest.contacts.{}'.format(prefix, name)
+        results[key] = {
+            'seconds': best_time(lambda: ContactsFactory(text=text), rounds),
+            'peak_bytes': peak_memory(lambda: ContactsFactory(text=text))
+        }
+
+    def ingest_repeaters():
+        reps = PrzemiennikiWrapper(content=xml)
+        ChannelsFactory.prerender(reps)
+        return reps
+
+    results[prefix + '.ingest.repeaters'] = {
+        'seconds': best_time(ingest_repeaters, rounds),
+        'peak_bytes': peak_memory(ingest_repeaters)
+    }
+    utils.REPS = ingest_repeaters()
+
+
+def bench_exports(results, prefix, channels, rounds):
+    """Measure every stage of export of each of QUERIES."""
+    for name, packed in sorted(packed_queries().items()):
+        key = '{}.{}'.format(prefix, name)
+        query = msgpack.unpackb(bytearray.fromhex(packed), raw=False)
+        results[key + '.decode'] = {'seconds': best_time(
+            lambda: msgpack.unpackb(bytearray.fromhex(packed), raw=False),
+            rounds
+        )}
+
+        with_channels = utils.are_channels_requested(query)
+        contact_lines = []
+        channel_lines = []
+
+        def select():
+            contact_lines[:] = utils.CONTACTS.iter_csv(query['contacts'])
+            if with_channels:
+                channel_lines[:] = channels.iter_csv(query['channels'])
+        results[key + '.select'] = {'seconds': best_time(select, rounds)}
+
+        results[key + '.render'] = {'seconds': best_time(
+            lambda: (list(utils.chunked(contact_lines)),
+                     list(utils.chunked(channel_lines))),
+            rounds
+        )}
+
+        if with_channels:
+            results[key + '.zip'] = {'seconds': best_time(
+                lambda: b''.join(utils.iter_zip([
+                    ('contacts.csv', utils.chunked(contact_lines)),
+                    ('channels.csv', utils.chunked(channel_lines))
+                ])),
+                rounds
+            )}
+
+        results[key + '.export'] = {
+            'seconds': best_time(lambda: export_stages(query, channels),
+                                 rounds),
+            'peak_bytes': peak_memory(lambda: export_stages(query, channels)),
+            'output_bytes': len(export_stages(query, channels))
+        }
+
+
+def run(contact_counts, repeaters_count, rounds):
+    """Run all benchmarks, returns {name: {metric: value}}."""
+    utils.load_config()
+    utils.KAB = ['SP5AB', 'SQ5XYZ', 'SO5X', 'HF5JN']
+    channels = ChannelsFactory()
+    xml = repeaters_xml(repeaters_count)
+    results = {}
+    for count in contact_counts:
+        text = contacts_csv(count)
+        prefix = 'contacts_{}'.format(count)
+        bench_ingest(results, prefix, text, xml, rounds)
+        for name in sorted(STORES):
+            utils.CONFIG = utils.CONFIG.replace(contact_store=name)
+            utils.CONTACTS = ContactsFactory(text=text)
+            bench_exports(results, '{}.{}'.format(prefix, name), channels,
+                          rounds)
+        utils.CONTACTS = None
+    return results
+
+
+NOISE = 0.001  # seconds
+
+
+def compare(results, baseline, threshold):
+    """Print results against baseline, returns number of regressions."""
+    regressions = 0
+    print("{:<58} {:>12} {:>12} {:>8}".format(
+        'benchmark', 'baseline', 'now', 'ratio'))
+    for name in sorted(results):
+        for metric, value in sorted(results[name].items()):
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+            ratio = value / old
+            mark = ''
+            if ratio > 1 + threshold and metric != 'output_bytes' and \
+                    not (metric == 'seconds' and old < NOISE):
+                mark = ' !'
+                regressions += 1
+            print("{:<58} {:>12.4g} {:>12.4g} {:>7.2f}x{}".format(
+                '{} {}'.format(name, metric), old, value, ratio, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--contacts', type=int, nargs='+',
+                        default=[50000, 300000], help='contact list sizes')
+    parser.add_argument('--repeaters', type=int, default=3000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--save', metavar='FILE', help='save results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with results saved before')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown, 0.1 means 10%%')
+    args = parser.parse_args()
+
+    results = run(args.contacts, args.repeaters, args.rounds)
+
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump({
+                'meta': {
+                    'date': datetime.utcnow().isoformat(),
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'contacts': args.contacts,
+                    'repeaters': args.repeaters,
+                    'queries': sorted(QUERIES)
+                },
+                'results': results
+            }, out, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline)['results'],
+                                  args.threshold)
+        print("{} regression(s)".format(regressions))
+        return 1 if regressions else 0
+
+    for name in sorted(results):
+        print("{:<58} {}".format(name, ', '.join(
+            '{}={:.4g}'.format(metric, value)
+            for metric, value in sorted(results[name].items()))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
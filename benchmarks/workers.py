@@ -0,0 +1,200 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Memory of gunicorn workers with data loaded by every worker and loaded once
+by the master (GD77_PRELOAD, see gunicorn.conf.py).
+
+    python -m benchmarks.workers [--workers N] [--contacts N] ...
+
+The app runs in a temporary directory, from a snapshot of synthetic data,
+with upstream made unreachable (through a dead proxy). After --requests
+exports (so workers touch the data) it reports, from /proc (Linux only),
+for the master and every worker:
+
+    rss         resident memory, shared pages included
+    pss         resident memory, shared pages divided among sharing processes
+    private     pages of the process only (e.g. copied on write)
+
+Sum of pss is the memory really used by the whole app.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import yaml
+
+from benchmarks.fixtures import contacts_csv, packed_queries, repeaters_xml
+from contacts import ContactsFactory
+from fetch import ConditionalFetcher
+from przemienniki import PrzemiennikiWrapper
+import settings
+import snapshot
+import utils
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prepare(directory, contacts, repeaters):
+    """Write config and snapshot of synthetic data into directory."""
+    with open(os.path.join(PROJECT, 'config.yaml')) as cfg_file:
+        config = yaml.safe_load(cfg_file)
+    config.update({
+        'snapshot': os.path.join(directory, 'snapshot.msgpack'),
+        'refresh_interval': 0,
+        'presets_dir': os.path.join(directory, 'presets'),
+    })
+    config.setdefault('saved_queries', {})['directory'] = \
+        os.path.join(directory, 'queries')
+    with open(os.path.join(directory, 'config.yaml'), 'w') as cfg_file:
+        yaml.safe_dump(config, cfg_file)
+
+    utils.CONFIG = settings.compile_config(config)
+    utils.KAB = ['SP5AB', 'SQ5XYZ', 'SO5X', 'HF5JN']
+    utils.CONTACTS = ContactsFactory(text=contacts_csv(contacts))
+    utils.REPS = PrzemiennikiWrapper(content=repeaters_xml(repeaters))
+    utils.LAST_DATA_UPDATE = utils.timestamp()
+    snapshot.save(config['snapshot'], ConditionalFetcher())
+    utils.CONTACTS = utils.REPS = utils.KAB = None
+
+
+def memory(pid):
+    """{rss, pss, private} of process in bytes."""
+    values = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as smaps:
+        for line in smaps:
+            name, _, value = line.partition(':')
+            if value.strip().endswith('kB'):
+                values[name] = int(value.split()[0]) * 1024
+    return {
+        'rss': values['Rss'],
+        'pss': values['Pss'],
+        'private': values['Private_Clean'] + values['Private_Dirty'],
+    }
+
+
+def children(pid):
+    with open('/proc/{0}/task/{0}/children'.format(pid)) as source:
+        return [int(child) for child in source.read().split()]
+
+
+def settle(pid, workers, timeout=120):
+    """Wait until all workers run and their memory stops growing (they may
+    still be loading data), returns their pids."""
+    last = None
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        time.sleep(1)
+        pids = children(pid)
+        total = sum(memory(child)['rss'] for child in pids)
+        if len(pids) == workers and last and abs(total - last) < 0.01 * last:
+            break
+        last = total
+    return pids
+
+
+def measure(directory, preload, workers, port, requests_count):
+    """Run gunicorn, returns [(process, memory)] of master and workers."""
+    env = dict(
+        os.environ,
+        GD77_PRELOAD='1' if preload else '0',
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(directory, 'metrics'),
+        HTTP_PROXY='http://127.0.0.1:9', HTTPS_PROXY='http://127.0.0.1:9',
+    )
+    env.pop('GD77_PRELOADED', None)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn',
+         '-c', os.path.join(PROJECT, 'gunicorn.conf.py'),
+         '--pythonpath', PROJECT, '-w', str(workers),
+         '-b', '127.0.0.1:{}'.format(port), '--log-level', 'warning',
+         'main:app'],
+        cwd=directory, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    session = requests.Session()
+    session.trust_env = False
+    url = 'http://127.0.0.1:{}'.format(port)
+    try:
+        start = time.perf_counter()
+        while True:
+            if server.poll() is not None or time.perf_counter() - start > 300:
+                raise RuntimeError('gunicorn did not start')
+            try:
+                session.get(url + '/metrics', timeout=5)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        queries = sorted(packed_queries().values())
+        for num in range(requests_count):
+            session.get('{}/csv/{}'.format(url, queries[num % len(queries)]),
+                        timeout=60).raise_for_status()
+        pids = settle(server.pid, workers)
+        return [('master', memory(server.pid))] + [
+            ('worker {}'.format(num), memory(pid))
+            for num, pid in enumerate(pids, 1)
+        ]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(title, processes):
+    print(title)
+    print("{:<12} {:>12} {:>12} {:>12}".format(
+        '', 'rss [MiB]', 'pss [MiB]', 'private [MiB]'))
+    for name, values in processes:
+        print("{:<12} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+            name, *(values[key] / 2**20 for key in ('rss', 'pss', 'private'))))
+    print("{:<12} {:>12.1f} {:>12.1f} {:>12.1f}\n".format(
+        'total', *(sum(values[key] for _, values in processes) / 2**20
+                   for key in ('rss', 'pss', 'private'))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--contacts', type=int, default=300000)
+    parser.add_argument('--repeaters', type=int, default=3000)
+    parser.add_argument('--requests', type=int, default=50,
+                        help='exports made before measuring')
+    parser.add_argument('--port', type=int, default=8077)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        prepare(directory, args.contacts, args.repeaters)
+        for preload in (False, True):
+            report(
+                'Data loaded by {} ({} workers, {} contacts)'.format(
+                    'the master' if preload else 'every worker',
+                    args.workers, args.contacts),
+                measure(directory, preload, args.workers, args.port,
+                        args.requests)
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
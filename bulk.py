@@ -0,0 +1,158 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Bulk export: many queries at once, one zip file with folder per query.
+
+Files are generated (and compressed) by a pool of processes forked from the
+worker when it starts (BulkExporter.start), so they share its (already
+loaded) data, and zipped as they come.
+Contacts and channels parts of queries are generated once for each distinct
+part, so e.g. members of a club who differ only in their priority lists share
+the channels file.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import logging as log
+import multiprocessing
+import os
+import re
+
+from cache import query_key
+from channels import ChannelsFactory
+import utils
+
+
+log.basicConfig(level=log.DEBUG)
+
+_CHANNELS = ChannelsFactory()
+
+
+def _render(task):
+    """Generate (compressed) file of task, given as (kind, part of
+    query)."""
+    kind, part = task
+    utils.reload_config()  # the file may have changed since the fork
+    if kind == 'contacts':
+        return utils.deflate(b''.join(utils.CONTACTS.iter_csv(part)))
+    return utils.deflate(b''.join(_CHANNELS.iter_csv(part)))
+
+
+def folder_names(names):
+    """Safe and unique folder names for given names."""
+    used = set()
+    for pos, name in enumerate(names):
+        folder = re.sub(r'[^\w.-]+', '_', str(name)).strip('._')[:64] or \
+            str(pos + 1)
+        unique, num = folder, 1
+        while unique in used:
+            num += 1
+            unique = '{}_{}'.format(folder, num)
+        used.add(unique)
+        yield unique
+
+
+class BulkExporter:
+    """Generate zip file of many queries with a pool of processes.
+
+    The pool has to be forked (start) before the worker starts any thread:
+    a thread holding a lock at fork would leave it locked forever in the
+    processes. So it is never forked again: once data changes, the pool
+    (with the old data) is closed and files are generated by the worker
+    itself. Under gunicorn with preload_app workers are replaced instead,
+    with new pools."""
+
+    def __init__(self, processes=2):
+        self.processes = processes
+        self.pool = None
+        self.version = None  # of data of the pool
+
+    def start(self):
+        """Fork the pool, from current data."""
+        if self.processes > 1:
+            self.version = utils.DATA_VERSION
+            self.pool = multiprocessing.get_context('fork').Pool(
+                self.processes, utils.default_signals
+            )
+
+    def close(self):
+        """Let processes finish their work and exit (e.g. when data
+        changed)."""
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+            log.info('Pool of bulk exports closed')
+
+    @staticmethod
+    def plan(queries):
+        """Split queries into distinct tasks, returns (tasks, folders) where
+        folders are (folder name, contacts task, channels task or None)."""
+        tasks = {}
+        folders = []
+
+        def task(kind, part):
+            return tasks.setdefault((kind, query_key(part)),
+                                    (len(tasks), (kind, part)))[0]
+
+        for folder, query in zip(folder_names([name for name, _ in queries]),
+                                 [query for _, query in queries]):
+            folders.append((
+                folder,
+                task('contacts', query['contacts']),
+                task('channels', query['channels'])
+                if utils.are_channels_requested(query) else None
+            ))
+        return [task for _, task in sorted(tasks.values())], folders
+
+    @staticmethod
+    def entries(folders, files):
+        """(name, file) entries of zip archive for folders, taking files (of
+        tasks, in order) as they come, each kept only until its last
+        entry. Tasks are numbered in order of their first entry (see plan),
+        so the next file is always the one needed first."""
+        last = {}
+        for pos, (_, *tasks) in enumerate(folders):
+            last.update((task, pos) for task in tasks)
+        files = iter(files)
+        kept = {}
+
+        def take(task, pos):
+            if task not in kept:
+                kept[task] = next(files)
+            return kept[task] if last[task] > pos else kept.pop(task)
+
+        for pos, (folder, contacts, channels) in enumerate(folders):
+            yield '{}/contacts.csv'.format(folder), take(contacts, pos)
+            if channels is not None:
+                yield '{}/channels.csv'.format(folder), take(channels, pos)
+
+    def iter_zip(self, queries):
+        """Generate zip archive for (name, query) pairs, piece by piece."""
+        tasks, folders = self.plan(queries)
+        log.debug('Bulk export of %d queries, %d distinct files',
+                  len(folders), len(tasks))
+        pool = self.pool
+        if pool is not None and self.version == utils.DATA_VERSION and \
+                len(tasks) > 1:
+            files = pool.imap(_render, tasks)
+        else:
+            files = map(_render, tasks)
+        return utils.iter_deflated_zip(self.entries(folders, files))
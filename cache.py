@@ -0,0 +1,219 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Cache of generated exports, keyed by canonical form of the query.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+import itertools
+import logging as log
+import threading
+
+import msgpack
+
+import utils
+
+
+log.basicConfig(level=log.DEBUG)
+
+# lists where order of items does not change the generated file
+UNORDERED_LISTS = {
+    ('contacts', 'sp_prefix'),
+    ('contacts', 'sp_area'),
+    ('channels', 'repeaters', 'areas'),
+    ('channels', 'repeaters', 'modes'),
+}
+# dicts where order of keys does change the generated file
+ORDERED_DICTS = {
+    ('channels', 'services'),
+}
+
+
+def canonical(obj, path=()):
+    """Canonical form of decoded query: key order of dicts is ignored, lists
+    are sorted, unless the order matters for the generated file."""
+    if isinstance(obj, dict):
+        items = [[key, canonical(value, path + (key,))]
+                 for key, value in obj.items()]
+        if path not in ORDERED_DICTS:
+            items.sort(key=lambda item: str(item[0]))
+        return items
+    if isinstance(obj, (list, tuple)):
+        items = [canonical(value, path) for value in obj]
+        if path in UNORDERED_LISTS:
+            items.sort(key=str)
+        return items
+    return obj
+
+
+def query_key(query):
+    """Short, stable key of decoded query."""
+    return sha1(
+        msgpack.packb(canonical(query), use_bin_type=True)
+    ).hexdigest()[:20]
+
+
+class _Flight:
+    """Result being built by one thread, waited for by the others."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """Thread safe LRU cache of (body, mimetype, filename) results, bound by
+    number of entries, size of single body and total size of bodies.
+    Concurrent requests for the same key are coalesced, so the result is
+    built only once (unless that takes longer than flight_timeout seconds).
+    All entries are dropped when data version changes."""
+
+    def __init__(self, max_entries=256, max_bytes=64 * 2**20,
+                 max_entry_bytes=4 * 2**20, flight_timeout=30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.flight_timeout = flight_timeout
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._size = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self._version:
+            self._entries.clear()
+            self._size = 0
+            self._version = version
+
+    def _store(self, key, value):
+        size = len(value[0])
+        if size > self.max_entry_bytes or not self.max_entries:
+            return
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key)[0])
+        self._entries[key] = value
+        self._size += size
+        while len(self._entries) > self.max_entries or \
+                self._size > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self._size -= len(old[0])
+
+    def lookup(self, key, version):
+        """Return cached result for key or None."""
+        with self._lock:
+            self._check_version(version)
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, version, value):
+        """Cache result for key (unless data version has changed since)."""
+        with self._lock:
+            if version == self._version:
+                self._store(key, value)
+
+    def _board(self, key, version):
+        """(value, flight, leader): cached result for key or, if there is
+        none, the flight building it, started (and led) by the caller if
+        leader."""
+        with self._lock:
+            self._check_version(version)
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value, None, False
+            flight = self._flights.get((version, key))
+            if flight is not None:
+                return None, flight, False
+            flight = self._flights[(version, key)] = _Flight()
+            return None, flight, True
+
+    def _land(self, key, version, flight):
+        """End flight, cache its result (if any)."""
+        with self._lock:
+            del self._flights[(version, key)]
+            if flight.value is not None and version == self._version:
+                self._store(key, flight.value)
+        flight.done.set()
+
+    def get(self, key, version, build):
+        """Return cached result for key, call build() to create it if it is
+        not cached yet."""
+        value, flight, leader = self._board(key, version)
+        if value is not None:
+            return value
+
+        if not leader:
+            if flight.done.wait(self.flight_timeout):
+                if flight.error is not None:
+                    raise flight.error
+                if flight.value is not None:
+                    return flight.value
+            return build()  # taking too long or built too big to keep
+
+        try:
+            flight.value = build()
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            self._land(key, version, flight)
+        return flight.value
+
+    def stream(self, key, version, chunks, mimetype, filename):
+        """Return chunks of result for key: of the cached one, or the given
+        chunks (caching them, unless too big). Like get(), concurrent streams
+        of the same key are coalesced, but only while chunks are generated:
+        they are collected up to max_entry_bytes before anything is
+        returned, then every caller sends its own copy, so a slow client
+        does not hold the others. When the result is too big, collected
+        chunks are returned followed by the rest, and the others generate
+        their own chunks. Errors of generation are raised here (at least
+        those of the first chunk), before any response is sent."""
+        value, flight, leader = self._board(key, version)
+        if value is None and not leader and \
+                flight.done.wait(self.flight_timeout):
+            value = flight.value
+        if value is not None:
+            return [value[0]]
+        if not leader:
+            return utils.primed(chunks)
+
+        chunks = iter(chunks)
+        kept, size = [], 0
+        try:
+            for chunk in chunks:
+                kept.append(chunk)
+                size += len(chunk)
+                if size > self.max_entry_bytes:
+                    return itertools.chain(kept, chunks)
+            flight.value = (b''.join(kept), mimetype, filename)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            self._land(key, version, flight)
+        return [flight.value[0]]
@@ -26,6 +26,8 @@ License: GNU AGPLv3
 import logging as log
 from collections import namedtuple
 
+import metrics
+from przemienniki import resolve_freqs
 import utils
 
 log.basicConfig(level=log.DEBUG)
@@ -39,50 +41,9 @@ class ChannelsFactory:
         ",contact,slot"
     )
 
-    def __init__(self):
-        self.records = []
-
-    def _filter_rxtx(self, freqs, rx=True):
-        return filter(lambda r: (rx and 'rx' or 'tx') in r, freqs)
-
-    def _is_in_band(self, freq, boundaries):
-        if not isinstance(freq, float):
-            f = float(freq)
-        else:
-            f = freq
-
-        return f >= boundaries[0] and f <= boundaries[1]
-
-    def _is_2m(self, freq):
-        return self._is_in_band(freq, (144.0, 146.0))
-
-    def _is_70cm(self, freq):
-        return self._is_in_band(freq, (430.0, 440.0))
-
     def filter_rep_freqs(self, freqs:list, band:str):
         """Exctract correct frequencies from repeater record."""
-        rxs = map(lambda r: r.get('rx', 0), self._filter_rxtx(freqs))
-        txs = map(
-            lambda r: r.get('tx', 0),
-            self._filter_rxtx(freqs, False)
-        )
-
-        if band.lower() == '2m':
-            rx = list(filter(lambda f: self._is_2m(f), rxs))
-            tx = list(filter(lambda f: self._is_2m(f), txs))
-        elif band.lower() == '70cm':
-            rx = list(filter(lambda f: self._is_70cm(f), rxs))
-            tx = list(filter(lambda f: self._is_70cm(f), txs))
-        else:
-            return {}
-
-        if not all([rx, tx]):
-            return {}
-
-        return {
-            'rx': rx[0],
-            'tx': tx[0]
-        }
+        return resolve_freqs(freqs, band)
 
     @staticmethod
     def duplicate_channel(channel, updated):
@@ -91,82 +52,119 @@ class ChannelsFactory:
         return ChannelsFactory.ChannelRecord(**orig)
 
 
-    def add_repeaters(self, bands: list, modes: list, areas: list,
-                      digi_first: bool, digi_double: bool):
-        """Add Repeaters by given criterion."""
-        digital_reps = []
-        analog_reps = []
-        sack = []
+    @staticmethod
+    def render(channel):
+        """Line of GD-77 channels CSV for channel, without the leading Number
+        column, utf-8 encoded."""
+        line = "{name},\"{rx_freq:0<9}\",\"{tx_freq:0<9}\",{mode},{power},"\
+               "\"{rx_tone}\",\"{tx_tone}\",{color},{rx_group},{contact},{slot}\r\n"
+        return line.format(
+            name=channel.name,
+            rx_freq=str(channel.rx_freq).replace('.', ','),
+            tx_freq=str(channel.tx_freq).replace('.', ','),
+            mode=channel.mode,
+            power=channel.power,
+            rx_tone=str(channel.rx_tone).replace('.', ','),
+            tx_tone=str(channel.tx_tone).replace('.', ','),
+            color=channel.color,
+            rx_group=channel.rx_group,
+            contact=channel.contact,
+            slot=channel.slot
+        ).encode()
+
+    @staticmethod
+    def prerender(reps):
+        """Render rows of every repeater/band/slot variant of given
+        PrzemiennikiWrapper once, keyed by (position, band, slot) where slot
+        0 means single channel for both slots."""
+        if reps.index.rows is not None:
+            return reps.index.rows
+
+        rows = {}
+        for (pos, band), params in reps.index.params.items():
+            sign = reps.repeaters[pos].sign
+            channel = ChannelsFactory.ChannelRecord(
+                name=sign,
+                rx_freq=params.tx,
+                tx_freq=params.rx,
+                mode="Digital" if params.digital else "Analog",
+                power='High',
+                rx_tone=params.tx_tone,
+                tx_tone=params.rx_tone,
+                color=1 if params.digital else 0,
+                rx_group=1,
+                contact=1,
+                slot=1
+            )
+            rows[(pos, band, 0)] = ChannelsFactory.render(channel)
 
-        for repeater in utils.REPS.repeaters:
-            band_match = any([band.upper() in repeater.bands for band in bands])
-            mode_match = any([mode.upper() in repeater.modes for mode in modes])
-            area_match = any([repeater.sign.startswith("SR{}".format(area))
-                              for area in areas])
-
-            if all([band_match, mode_match, area_match]):
-                for band in bands:
-                    if band.lower() not in utils.CONFIG['supported_bands']:
-                        continue
-                    # one channel for each band
-                    freqs = self.filter_rep_freqs(repeater.freqs, band)
-                    if not freqs:
-                        continue
-
-                    if 'CTCSS' in repeater.activation:
-                        tx_tone = repeater.tones.get('tx', 'None')
-                        rx_tone = repeater.tones.get('rx', 'None')
-                    else:
-                        tx_tone = rx_tone = 'None'
-
-                    digital = "MOTOTRBO" in repeater.modes
-
-                    channel = ChannelsFactory.ChannelRecord(
-                        name=repeater.sign,
-                        rx_freq=freqs['tx'],
-                        tx_freq=freqs['rx'],
-                        mode="Digital" if digital else "Analog",
-                        power='High',
-                        rx_tone=tx_tone,
-                        tx_tone=rx_tone,
-                        color=1 if digital else 0,
-                        rx_group=1,
-                        contact=1,
-                        slot=1
+            if params.digital: # additional channel for 2 slot
+                rows[(pos, band, 1)] = ChannelsFactory.render(
+                    ChannelsFactory.duplicate_channel(
+                        channel,
+                        {'name': sign + ' [1]'}
                     )
+                )
+                rows[(pos, band, 2)] = ChannelsFactory.render(
+                    ChannelsFactory.duplicate_channel(
+                        channel,
+                        {
+                            'name': sign + " [2]",
+                            'slot': 2
+                        }
+                    )
+                )
+
+        reps.index.rows = rows
+        return rows
 
-                    if digital and digi_double: # additional channel for 2 slot
-                        channel2 = ChannelsFactory.duplicate_channel(
-                            channel,
-                            {
-                                'name': channel.name + " [2]",
-                                'slot': 2
-                            }
-                        )
-
-                        channel = ChannelsFactory.duplicate_channel(
-                            channel,
-                            {'name': repeater.sign + ' [1]'}
-                        )
-
-                    if digi_first:
-                        if digital:
-                            digital_reps.append(channel)
-                            if digi_double:
-                                digital_reps.append(channel2)
-                        else:
-                            analog_reps.append(channel)
-                    else:
-                        sack.append(channel)
-                        if digital and digi_double:
-                            sack.append(channel2)
+    def add_repeaters(self, rows: list, bands: list, modes: list,
+                      areas: list, digi_first: bool, digi_double: bool,
+                      near: dict = None, reps=None, limit: int = None):
+        """Add (rendered rows of) Repeaters (of reps, utils.REPS by default)
+        by given criterion, see RepeaterIndex.select, until there are limit
+        rows."""
+        digital_reps = []
+        analog_reps = []
+        sack = []
+        room = None if limit is None else max(0, limit - len(rows))
+
+        reps = reps or utils.REPS
+        rendered = self.prerender(reps)
+        for pos in reps.index.select(bands, modes, areas, near):
+            if room is not None and \
+                    len(sack if not digi_first else digital_reps) >= room:
+                break  # no more room, even for digital ones
+            for band in bands:
+                if band.lower() not in utils.CONFIG.supported_bands:
+                    continue
+                # one channel for each band
+                key = (pos, band.lower())
+                params = reps.index.params.get(key)
+                if not params:
+                    continue
+
+                if params.digital and digi_double:
+                    channels = [rendered[key + (1,)], rendered[key + (2,)]]
+                else:
+                    channels = [rendered[key + (0,)]]
+
+                if not digi_first:
+                    sack.extend(channels)
+                elif params.digital:
+                    digital_reps.extend(channels)
+                else:
+                    analog_reps.extend(channels)
         if digi_first:
-            self.records.extend(digital_reps)
-            self.records.extend(analog_reps)
+            rows.extend(digital_reps)
+            rows.extend(analog_reps)
         else:
-            self.records.extend(sack)
+            rows.extend(sack)
+        if limit is not None:
+            del rows[limit:]
 
-    def add_regular_freqs(self, name:str, freqs: list):
+    def add_regular_freqs(self, rows: list, name:str, freqs: list):
+        """Add (rendered rows of) simple analog channels."""
         for i, freq in enumerate(freqs):
             channel = ChannelsFactory.ChannelRecord(
                 name="{} {}".format(name, i+1),
@@ -181,55 +179,96 @@ class ChannelsFactory:
                 contact=0,
                 slot=1
             )
-            self.records.append(channel)
-
-
-    def as_csv(self, query_json: dict):
-        """Convert to CSV file accepted by GD-77 software."""
-        head = "Number,Name,Rx Freq,Tx Freq,Ch Mode,Power,Rx Tone,Tx Tone,"\
-               "Color Code,Rx Group List,Contact,Repeater Slot\r\n"
-
-        line = "{number},{name},\"{rx_freq:0<9}\",\"{tx_freq:0<9}\",{mode},{power},"\
-               "\"{rx_tone}\",\"{tx_tone}\",{color},{rx_group},{contact},{slot}\r\n"
-        buf = [head]
-
-        self.records.clear()
+            rows.append(self.render(channel))
+
+
+    def select(self, query_json: dict, reps=None):
+        """Rows of selected channels (of reps, utils.REPS by default), in
+        order of the file, at most as many as fit into the radio (profile
+        named by 'radio' of query). Services and PMR channels, chosen one by
+        one, take precedence over repeaters: room is kept for them."""
+        limit = utils.radio_limit(query_json, 'channels')
+        regular = []
+        with metrics.stage('channels.regular'):
+            # add gov services
+            for service in query_json.get('services', []):
+                self.add_regular_freqs(
+                    regular,
+                    service,
+                    query_json.get('services',{}).get(service, [])
+                )
+
+            # add PMR
+            self.add_regular_freqs(regular, 'PMR', query_json.get('apmr',[]))
+            # add digital PMR
+            self.add_regular_freqs(regular, 'PMR Digi',
+                                   query_json.get('dpmr',[]))
+
+        rows = []
         # add repeaters
         rep = query_json.get('repeaters', {})
-        self.add_repeaters(
-            bands=rep.get('bands', []),
-            modes=rep.get('modes', []),
-            areas=rep.get('areas', []),
-            digi_first=rep.get('digi_first', True),
-            digi_double=rep.get('digi_double'),
-        )
-
-        # add gov services
-        for service in query_json.get('services', []):
-            self.add_regular_freqs(
-                service,
-                query_json.get('services',{}).get(service, [])
+        with metrics.stage('channels.repeaters'):
+            self.add_repeaters(
+                rows,
+                bands=rep.get('bands', []),
+                modes=rep.get('modes', []),
+                areas=rep.get('areas', []),
+                digi_first=rep.get('digi_first', True),
+                digi_double=rep.get('digi_double'),
+                near=rep.get('near'),
+                reps=reps,
+                limit=None if limit is None else max(0, limit - len(regular))
             )
+        rows.extend(regular)
+        if limit is not None and len(rows) > limit:
+            log.debug('Channels limited to %d', limit)
+            del rows[limit:]
+        return rows
 
-        # add PMR
-        self.add_regular_freqs('PMR', query_json.get('apmr',[]))
-        # add digital PMR
-        self.add_regular_freqs('PMR Digi', query_json.get('dpmr',[]))
-
-        for i, rec in enumerate(self.records):
-            buf.append(line.format(
-                number=i,
-                name=rec.name,
-                rx_freq=str(rec.rx_freq).replace('.', ','),
-                tx_freq=str(rec.tx_freq).replace('.', ','),
-                mode=rec.mode,
-                power=rec.power,
-                rx_tone=str(rec.rx_tone).replace('.', ','),
-                tx_tone=str(rec.tx_tone).replace('.', ','),
-                color=rec.color,
-                rx_group=rec.rx_group,
-                contact=rec.contact,
-                slot=rec.slot
-            ))
-
-        return buf
+    def as_csv(self, query_json: dict):
+        """Convert to CSV file accepted by GD-77 software."""
+        return [line.decode() for line in self.iter_csv(query_json)]
+
+    def iter_csv(self, query_json: dict):
+        """Generate (utf-8 encoded) lines of CSV file accepted by GD-77
+        software."""
+        head = b"Number,Name,Rx Freq,Tx Freq,Ch Mode,Power,Rx Tone,Tx Tone,"\
+               b"Color Code,Rx Group List,Contact,Repeater Slot\r\n"
+        rows = self.select(query_json)
+        metrics.rows('channels', len(rows))
+
+        yield head
+        for i, row in enumerate(rows):
+            yield b'%d,' % i + row
+
+    def iter_delta_csv(self, query_json: dict, reps, old_reps):
+        """Generate (utf-8 encoded) lines of CSV file with rows added,
+        changed or removed between channels of old_reps and reps. Rows of
+        channels with the same name (but e.g. other frequency) are
+        changed."""
+        head = b"Change,Name,Rx Freq,Tx Freq,Ch Mode,Power,Rx Tone,Tx Tone,"\
+               b"Color Code,Rx Group List,Contact,Repeater Slot\r\n"
+        # which rows would not fit into the radio depends on all of them
+        query_json = dict(query_json, radio=None)
+        rows = self.select(query_json, reps)
+        old_rows = self.select(query_json, old_reps)
+        row_set, old_row_set = set(rows), set(old_rows)
+        added = [row for row in rows if row not in old_row_set]
+        removed = [row for row in old_rows if row not in row_set]
+
+        def name(row):
+            return row.split(b',', 1)[0]
+        added_names = [name(row) for row in added]
+        removed_names = [name(row) for row in removed]
+
+        yield head
+        for row in removed:
+            if removed_names.count(name(row)) != 1 or \
+                    added_names.count(name(row)) != 1:
+                yield b'removed,' + row
+        for row in added:
+            if removed_names.count(name(row)) == 1 and \
+                    added_names.count(name(row)) == 1:
+                yield b'changed,' + row
+            else:
+                yield b'added,' + row
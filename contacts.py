@@ -23,74 +23,108 @@ Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
 License: GNU AGPLv3
 """
 
-from collections import namedtuple, OrderedDict
-from itertools import product
+from collections import OrderedDict
+from itertools import islice, product
+import csv
+import io
 import logging as log
 import sys
 import re
 
-from requests import get
-
+import fetch
+import metrics
+from store import ContactRecord, DictContactStore, STORES, \
+    canonical_dmrid, contact_row
 import utils
 
 log.basicConfig(level=log.DEBUG)
 
 
+class _Full(Exception):
+    """Radio has no room for more contacts."""
+
+
+class _BoundedRows(OrderedDict):
+    """Rows by DMR id, raising _Full when a row over the limit is added."""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def __setitem__(self, key, value):
+        if len(self) >= self.limit and key not in self:
+            raise _Full()
+        super().__setitem__(key, value)
+
+
 class ContactsFactory:
     """Process raw CSV from ham-digital."""
 
     URL = "http://dmr.ham-digital.net/user_by_call.php?id=260"
-    ContactRecord = namedtuple(
-        "ContactRecord",
-        "num,callsign,dmrid,name,country,ctry"
-    )
+    ContactRecord = ContactRecord
 
-    def __init__(self):
+    def __init__(self, text=None, store=None):
         self.records = {}
-        self.ignored_contacts = []
-        self._get_records()
-
-    def _get_records(self):
-        """Retrieve CSV file from DMR site and save them as dict of records."""
-        result = get(self.URL)
-        if result.status_code != 200:
-            self.records = {}
-
-        for line in result.text.split("\r\n")[1:]:
-            items = list(map(str.strip, filter(None, line.split(";"))))
+        if store is None:
+            self._get_records(text)
+        else:
+            self.records = store
+
+    def _get_records(self, text=None):
+        """Retrieve CSV file from DMR site (unless already retrieved text or
+        text file is given) and save them in contact store.
+
+        The file is parsed while it is being read, so only the store is
+        kept in memory."""
+        store = STORES.get(utils.CONFIG.get('contact_store'), DictContactStore)
+        if text is None:
+            result = fetch.SESSION.get(self.URL, stream=True,
+                                       timeout=fetch.TIMEOUT)
+            if result.status_code != 200:
+                self.records = store([])
+                return
+            result.raw.decode_content = True
+            text = io.TextIOWrapper(result.raw, newline='',
+                                    encoding=result.encoding or 'utf-8',
+                                    errors='replace')
+
+        self.records = store(self._parse_records(text))
+        log.debug('%d contacts loaded into %s', len(self.records),
+                  store.__name__)
+
+    def _parse_records(self, text):
+        if isinstance(text, str):
+            text = io.StringIO(text, newline='')
+        lines = csv.reader(text, delimiter=';', quoting=csv.QUOTE_NONE)
+        for line in islice(lines, 1, None):  # skip header
+            items = list(map(str.strip, filter(None, line)))
             if len(items) < 6:
                 continue
-            dmr_rec = self.ContactRecord(*items)
-            self.records[dmr_rec.dmrid] = dmr_rec
+            record = self.ContactRecord(*items)
+            dmrid = canonical_dmrid(record.dmrid)
+            if dmrid is None:
+                log.warning('Skipping contact with wrong DMR id: %s', record)
+                continue
+            yield record._replace(dmrid=dmrid)
 
     def _sieve(self, prefixes, areas):
-        """Filter by given prefixes."""
-        selected = list(
+        """Filter by given prefixes, returns (DMR id, callsign, row) sorted by
+        callsign[2:]."""
+        return self.records.sieve(
             map(lambda x: x[0]+x[1], product(prefixes, map(str, areas)))
         )
 
-        return filter(  # returns DMR ids of selected records
-            lambda r: self.records[r].callsign[0:3] in selected,
-            self.records
-        )
-
-    def _read_special_group(self, name):
-        # special case for SP5KAB
-        if name.lower() == 'sp5kab':
-            group = utils.CONFIG['sp5kab']
-        else:
-            group = utils.CONFIG.get(name)
-
-        if not group:
-            return None
-
-        return sorted(group, key=lambda sign: sign[2:])
+    @staticmethod
+    def _read_special_group(name):
+        """Callsigns of group (of additional contacts), sorted by
+        callsign[2:], None if there is no such group."""
+        # special case for SP5KAB: members fetched by DataRefresher
+        if name.lower() == 'sp5kab' and utils.KAB:
+            return sorted(utils.KAB, key=lambda sign: sign[2:])
+        return utils.CONFIG.groups.get(name.lower()) or None
 
     def _get_rec_by_call(self, callsign):
-        for rec in self.records:
-            if self.records[rec].callsign == callsign:
-                return self.records[rec]
-        return None
+        return self.records.by_callsign(callsign)
 
     def _get_rec_by_id(self, dmr_id):
         return self.records.get(dmr_id, None)
@@ -106,110 +140,203 @@ class ContactsFactory:
         )
 
     def add_additional_contacts_numeric(self, rec_set: dict,
-                                        additionals: list):
+                                        additionals: list,
+                                        ignored: set = frozenset()):
         """From given list of additional contacts filter these that are numeric
-        and are present in config file. Add them to given rec_set dict."""
-        records_to_add = filter(
-            lambda r: str(r['id']) in additionals and str(r['id']).isnumeric(),
-            utils.CONFIG['additional_contacts']
-        )
-
-        for record in records_to_add:
-            if record['id'] in self.ignored_contacts:
+        and are present in config file. Add (rows of) them to given rec_set
+        dict."""
+        wanted = set(additionals)
+        for dmrid, (rec_id, name) in utils.CONFIG.numeric_contacts.items():
+            if dmrid not in wanted or rec_id in ignored:
                 continue
-            rec_set[record['id']] = self._simple_dmr_rec(record['id'],
-                                                         record['name'])
+            rec_set[rec_id] = contact_row(self._simple_dmr_rec(rec_id, name))
 
 
     def add_priority_contacts(self, rec_set: dict, prio_list: str):
-        """From given string, exctract list of call sign and add them to
-        rec_set if they exists in main DMR list."""
+        """From given string, exctract list of call sign and add (rows of)
+        them to rec_set if they exists in main DMR list."""
 
         for contact in map(str.upper, re.split('[,|.| |;]', prio_list)):
-            if contact.isnumeric() and contact in self.records: # just dmr id
-                rec_set[contact] = self.records[contact]
+            dmrid = canonical_dmrid(contact)
+            if dmrid is not None and dmrid in self.records: # just dmr id
+                rec_set[dmrid] = self.records.row(dmrid)
             else:  # call sign
                 rec = self._get_rec_by_call(contact)
                 if rec:
-                    rec_set[rec.dmrid] = rec
+                    rec_set[rec.dmrid] = self.records.row(rec.dmrid)
 
-    def add_additional_contacts_alpha(self, rec_set: dict, additionals: list):
-        """Add additional contacts by name of its group (defined in config)."""
+    def add_additional_contacts_alpha(self, rec_set: dict, additionals: list,
+                                      ignored: set = frozenset()):
+        """Add (rows of) additional contacts by name of its group (defined in
+        config)."""
         for addrec in filter(lambda r_id: r_id.isalnum(), additionals):
             spec_group = self._read_special_group(addrec)
             if not spec_group:
                 continue
             for callsign in spec_group:
-                if callsign in self.ignored_contacts:
+                if callsign in ignored:
                     continue
                 rec = self._get_rec_by_call(callsign)
                 if rec:
-                    rec_set[rec.dmrid] = rec
+                    rec_set[rec.dmrid] = self.records.row(rec.dmrid)
 
     def add_areatalkgroups(self, rec_set: dict, tg_list: list):
-        """Add TG for areas."""
-
-        available_tgs = sorted(
-            utils.CONFIG['sp_talk_groups'].get('items', []) +
-            utils.CONFIG['additional_talkgroups'],
-            key=lambda r: r['id']
-        )
+        """Add (rows of) TG for areas."""
 
         for tg_id in map(int, tg_list):
-            a_tg = list(filter(lambda r: r['id'] == tg_id, available_tgs))
-            if not a_tg:
+            name = utils.CONFIG.talkgroups.get(tg_id)
+            if name is None:
                 continue
-
-            a_tg = a_tg[0]
-            rec_set[a_tg['id']] = \
-                self._simple_dmr_rec(a_tg['id'], a_tg['name'])
+            rec_set[tg_id] = contact_row(self._simple_dmr_rec(tg_id, name))
 
     def add_contacts_by_area_and_prefix(self, rec_set: dict, prfxs: list,
-                                        areas: list):
-        """Add contacts by area and callsign prefix."""
-        rec_ids_sorted = sorted(
-            self._sieve(prfxs, areas),
-            key=lambda rid: self.records[rid].callsign[2:]
-        )
-
-        for rec_id in filter(lambda rec_id: rec_id not in rec_set,
-                             rec_ids_sorted):
-            a_record = self.records[rec_id]
-            if a_record.callsign in self.ignored_contacts:
+                                        areas: list,
+                                        ignored: set = frozenset()):
+        """Add (rows of) contacts by area and callsign prefix."""
+        for rec_id, callsign, row in self._sieve(prfxs, areas):
+            if rec_id in rec_set or callsign in ignored:
                 continue
-            rec_set[rec_id] = a_record
-
+            rec_set[rec_id] = row
+
+
+    @staticmethod
+    def _near(text: str):
+        """Variants of (partially typed) text with one typo fixed: a
+        character dropped (but the last one, which may be still typed),
+        adjacent characters swapped, digit changed or 0 and O confused."""
+        variants = set()
+        for pos, char in enumerate(text):
+            head, tail = text[:pos], text[pos + 1:]
+            if tail:
+                variants.add(head + tail)
+                variants.add(head + tail[0] + char + tail[1:])
+            if char.isdigit():
+                variants.update(head + digit + tail for digit in '0123456789')
+            if char in '0O':
+                variants.add(head + ('O' if char == '0' else '0') + tail)
+        variants.discard(text)
+        return variants
+
+    def suggest(self, text: str, limit: int = 10):
+        """Records for (partially typed) callsign or DMR id: these starting
+        with it, then (for callsigns) these starting with its variants with
+        one typo fixed. Returns [(record, exact)]."""
+        text = text.strip().upper()
+        if not text:
+            return []
+        if text.isdigit():
+            return [(record, True) for record in
+                    islice(self.records.by_id_prefix(text), limit)]
+
+        found = [(record, True) for record in
+                 islice(self.records.by_callsign_prefix(text), limit)]
+        if len(found) < limit and len(text) >= 3:
+            near = {}
+            for variant in self._near(text):
+                for record in islice(self.records.by_callsign_prefix(variant),
+                                     limit - len(found)):
+                    if not record.callsign.startswith(text):
+                        near[record.callsign, record.dmrid] = record
+            found.extend((record, False) for _, record in
+                         sorted(near.items())[:limit - len(found)])
+        return found
+
+    @staticmethod
+    def _callsigns(text: str):
+        """Upper-cased callsigns (or DMR ids) of comma/space/etc. separated
+        list."""
+        return frozenset(map(str.upper, re.split('[,|.| |;]', text or "")))
+
+    def selects(self, record, query_json: dict):
+        """Whether record would be selected (by select()) from contact
+        list, judging by the record alone (other records with the same
+        callsign are not taken into account)."""
+        priority = self._callsigns(query_json.get('prio'))
+        if record.callsign in priority or \
+                record.dmrid in map(canonical_dmrid, priority):
+            return True
+        if record.callsign in self._callsigns(query_json.get('igno')):
+            return False
+        for addrec in filter(lambda r_id: r_id.isalnum(),
+                             query_json.get('adds', [])):
+            if record.callsign in (self._read_special_group(addrec) or ()):
+                return True
+        if all(map(query_json.get, ['sp_area', 'sp_prefix'])):
+            return record.callsign[0:3] in {
+                prefix + str(area) for prefix in query_json['sp_prefix']
+                for area in query_json['sp_area']
+            }
+        return False
+
+    def select(self, query_json: dict):
+        """Rows of selected contacts by DMR id, in order of the file, which
+        is order of priority: selection stops once the radio (profile named
+        by 'radio' of query) is full."""
+        limit = utils.radio_limit(query_json, 'contacts')
+        records_set = OrderedDict() if limit is None else _BoundedRows(limit)
+        try:
+            self._select(records_set, query_json)
+        except _Full:
+            log.debug('Contacts limited to %d', limit)
+        return records_set
+
+    def _select(self, records_set: dict, query_json: dict):
+        ignored = self._callsigns(query_json.get('igno'))
+
+        with metrics.stage('contacts.additional_numeric'):
+            self.add_additional_contacts_numeric(records_set,
+                                                 query_json['adds'], ignored)
+        with metrics.stage('contacts.talkgroups'):
+            self.add_areatalkgroups(records_set, query_json['tgs'] or [])
+        with metrics.stage('contacts.priority'):
+            self.add_priority_contacts(records_set, query_json['prio'])
+        with metrics.stage('contacts.additional_alpha'):
+            self.add_additional_contacts_alpha(records_set,
+                                               query_json['adds'], ignored)
+        if all(map(query_json.get, ['sp_area', 'sp_prefix'])):
+            with metrics.stage('contacts.area_and_prefix'):
+                self.add_contacts_by_area_and_prefix(
+                    records_set,
+                    query_json.get('sp_prefix'),
+                    query_json.get('sp_area'),
+                    ignored
+                )
 
     def as_csv(self, query_json: dict):
         """Convert to CSV file accepted by GD-77 software."""
-        head = "Number,Name,Call ID,Type,Ring Style,Call Receive Tone\r\n"
-        line = "{num},{name},{dmrid:0>8},{type},On,1\r\n"
-        buf = [head]
-
-        records_set = OrderedDict()
-        self.ignored_contacts = list(map(
-            str.upper,
-            re.split('[,|.| |;]', query_json.get('igno',""))
-        ))
-
-        self.add_additional_contacts_numeric(records_set, query_json['adds'])
-        self.add_areatalkgroups(records_set, query_json['tgs'] or [])
-        self.add_priority_contacts(records_set, query_json['prio'])
-        self.add_additional_contacts_alpha(records_set, query_json['adds'])
-        if all(map(query_json.get, ['sp_area', 'sp_prefix'])):
-            self.add_contacts_by_area_and_prefix(
-                records_set,
-                query_json.get('sp_prefix'),
-                query_json.get('sp_area')
-            )
-
-        for i, rec_id in enumerate(records_set):
-            record = records_set[rec_id]
-            buf.append(line.format(
-                num=i,
-                name=' '.join([record.callsign, record.name]).strip(),
-                dmrid=record.dmrid,
-                type="Group All" if len(record.dmrid) <= 5 else "Private Call"
-            ))
-
-        return buf
+        return [line.decode() for line in self.iter_csv(query_json)]
+
+    def iter_csv(self, query_json: dict):
+        """Generate (utf-8 encoded) lines of CSV file accepted by GD-77
+        software."""
+        head = b"Number,Name,Call ID,Type,Ring Style,Call Receive Tone\r\n"
+        records_set = self.select(query_json)
+        metrics.rows('contacts', len(records_set))
+
+        yield head
+        for i, row in enumerate(records_set.values()):
+            yield b'%d,' % i + row
+
+    def iter_delta_csv(self, query_json: dict, changes: dict):
+        """Generate (utf-8 encoded) lines of CSV file with rows added,
+        changed or removed since contact list given by changes (DMR id ->
+        record as it was then, None if there was none, see
+        history.DataHistory), in order of DMR ids."""
+        head = b"Change,Name,Call ID,Type,Ring Style,Call Receive Tone\r\n"
+        # which rows would not fit into the radio depends on all of them
+        query_json = dict(query_json, radio=None)
+        records_set = self.select(query_json)
+
+        yield head
+        for dmrid in sorted(changes, key=lambda rec_id: (len(rec_id), rec_id)):
+            old = changes[dmrid]
+            old_row = None
+            if old is not None and self.selects(old, query_json):
+                old_row = contact_row(old)
+            row = records_set.get(dmrid)
+            if row is not None and old_row is None:
+                yield b'added,' + row
+            elif row is None and old_row is not None:
+                yield b'removed,' + old_row
+            elif row is not None and row != old_row:
+                yield b'changed,' + row
@@ -0,0 +1,132 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Fetching of upstream data: one pooled HTTP session with retries (with
+backoff) shared by all sources, and conditional requests.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from collections import namedtuple
+from hashlib import sha1
+import logging as log
+import tempfile
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
+
+
+log.basicConfig(level=log.DEBUG)
+
+TIMEOUT = (5, 60)  # connect, read [s]
+SESSION = Session()
+
+
+def configure(config: dict):
+    """Set up the shared session from "upstream" config section."""
+    global TIMEOUT
+
+    TIMEOUT = tuple(config.get('timeout', TIMEOUT))
+    retry = Retry(
+        total=config.get('retries', 3),
+        backoff_factor=config.get('backoff', 0.5),
+        status_forcelist=[500, 502, 503, 504]
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                          max_retries=retry)
+    SESSION.mount('http://', adapter)
+    SESSION.mount('https://', adapter)
+
+
+class ConditionalFetcher:
+    """HTTP GET remembering validators (ETag/Last-Modified) and content
+    digests of previous responses, so unchanged resources are skipped."""
+
+    CHUNK = 64 * 1024
+    Download = namedtuple('Download', 'body,encoding')
+
+    def __init__(self):
+        self.validators = {}
+        self.digests = {}
+
+    def fetch(self, url, headers=None, timeout=None):
+        """Return Download (binary file with body and its encoding) if
+        resource changed since the last fetch, None otherwise (not modified,
+        same content or error).
+
+        Body is spooled to a temporary file while its digest is computed,
+        so it is never held in memory as a whole."""
+        headers = dict(headers or {})
+        etag, modified = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+
+        body = tempfile.TemporaryFile()
+        digest = sha1()
+        try:
+            resp = SESSION.get(url, headers=headers, stream=True,
+                               timeout=timeout or TIMEOUT)
+            if resp.status_code == 200:
+                for chunk in resp.iter_content(self.CHUNK):
+                    digest.update(chunk)
+                    body.write(chunk)
+            resp.close()
+        except RequestException as error:
+            log.error('Cannot retrieve %s: %s', url, error)
+            body.close()
+            return None
+
+        if resp.status_code != 200:
+            if resp.status_code == 304:
+                log.debug('%s not modified', url)
+            else:
+                log.error('Cannot retrieve %s: HTTP %s', url,
+                          resp.status_code)
+            body.close()
+            return None
+
+        self.validators[url] = (
+            resp.headers.get('ETag'),
+            resp.headers.get('Last-Modified')
+        )
+        digest = digest.hexdigest()
+        if self.digests.get(url) == digest:
+            log.debug('%s unchanged', url)
+            body.close()
+            return None
+        self.digests[url] = digest
+        body.seek(0)
+        return self.Download(body, resp.encoding)
+
+    def version(self):
+        """Identifier of fetched data, the same in every process which has
+        fetched the same content."""
+        return sha1(
+            ''.join(sorted(self.digests.values())).encode()
+        ).hexdigest()[:12]
+
+    def forget(self, url):
+        """Drop what is known about url, so next fetch gets it again."""
+        self.validators.pop(url, None)
+        self.digests.pop(url, None)
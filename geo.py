@@ -0,0 +1,137 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Geography helpers: Maidenhead locators, distances and spatial index.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from collections import defaultdict
+from math import asin, cos, floor, isfinite, pi, radians, sin, sqrt
+
+
+EARTH_RADIUS = 6371.0088  # [km]
+HALF_CIRCUMFERENCE = pi * EARTH_RADIUS  # [km], farthest any point can be
+KM_PER_DEGREE = 111.195  # of latitude
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great circle distance [km] between two points (haversine)."""
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat / 2) ** 2 + \
+        cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+
+def locator_to_latlon(locator: str):
+    """(lat, lon) of the center of Maidenhead locator square (2, 4, 6 or 8
+    characters, e.g. "KO02md"), None if locator is wrong."""
+    locator = (locator or '').strip().upper()
+    if len(locator) not in (2, 4, 6, 8):
+        return None
+
+    lon, lat = -180.0, -90.0
+    lon_size, lat_size = 20.0, 10.0
+    for pos in range(0, len(locator), 2):
+        pair = locator[pos:pos + 2]
+        if pos in (0, 4):  # field (A-R) and subsquare (A-X) letters
+            top = 'R' if pos == 0 else 'X'
+            if not ('A' <= pair[0] <= top and 'A' <= pair[1] <= top):
+                return None
+            digits = ord(pair[0]) - ord('A'), ord(pair[1]) - ord('A')
+        else:  # square and extended square digits
+            if not pair.isdigit():
+                return None
+            digits = int(pair[0]), int(pair[1])
+        if pos:
+            lon_size /= 24 if pos == 4 else 10
+            lat_size /= 24 if pos == 4 else 10
+        lon += digits[0] * lon_size
+        lat += digits[1] * lat_size
+    return lat + lat_size / 2, lon + lon_size / 2
+
+
+class GridIndex:
+    """Points bucketed in a grid of CELL x CELL degrees, so only the cells
+    overlapping the searched circle are scanned. Longitude does not wrap
+    around at 180 degrees."""
+
+    CELL = 0.5  # [deg], about 55 x 35 km in Poland
+
+    def __init__(self, points):
+        """Index points given as (key, lat, lon)."""
+        self.cells = defaultdict(list)
+        for key, lat, lon in points:
+            self.cells[self._cell(lat, lon)].append((lat, lon, key))
+        self.cells = dict(self.cells)
+        # cells with any points are within these (inclusive) bounds
+        self.bounds = (
+            min(self.cells, default=(0, 0))[0],
+            min((lon for _, lon in self.cells), default=0),
+            max(self.cells, default=(-1, -1))[0],
+            max((lon for _, lon in self.cells), default=-1),
+        )
+
+    def __len__(self):
+        return sum(map(len, self.cells.values()))
+
+    def _cell(self, lat, lon):
+        return floor(lat / self.CELL), floor(lon / self.CELL)
+
+    def within(self, lat, lon, radius, accept=None):
+        """(distance, key) of points within radius [km] of (lat, lon), for
+        which accept(key) is true, sorted by distance. Radius is clamped to
+        HALF_CIRCUMFERENCE (any point is within it)."""
+        if not isfinite(radius) or radius > HALF_CIRCUMFERENCE:
+            radius = HALF_CIRCUMFERENCE
+        dlat = radius / KM_PER_DEGREE
+        edge = min(89.9, abs(lat) + dlat)
+        dlon = min(180.0, dlat / cos(radians(edge)))
+        low_lat, low_lon = map(max, self._cell(lat - dlat, lon - dlon),
+                               self.bounds[:2])
+        high_lat, high_lon = map(min, self._cell(lat + dlat, lon + dlon),
+                                 self.bounds[2:])
+
+        found = []
+        for cell_lat in range(low_lat, high_lat + 1):
+            for cell_lon in range(low_lon, high_lon + 1):
+                for p_lat, p_lon, key in self.cells.get((cell_lat, cell_lon),
+                                                        ()):
+                    if accept is not None and not accept(key):
+                        continue
+                    dist = distance(lat, lon, p_lat, p_lon)
+                    if dist <= radius:
+                        found.append((dist, key))
+        found.sort()
+        return found
+
+    def nearest(self, lat, lon, count, radius=None, accept=None):
+        """(distance, key) of count points nearest to (lat, lon), (only
+        within radius [km] if given), for which accept(key) is true."""
+        limit = HALF_CIRCUMFERENCE
+        if radius and isfinite(radius):
+            limit = min(radius, limit)
+        search = min(limit, 25.0)
+        while True:
+            found = self.within(lat, lon, search, accept)
+            if len(found) >= count or search >= limit:
+                return found[:count]
+            search = min(limit, search * 2)
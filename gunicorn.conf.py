@@ -0,0 +1,114 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+gunicorn settings, use with: gunicorn -c gunicorn.conf.py main:app
+
+Data is loaded once, by the master (preload_app), and forked workers share
+its memory pages copy-on-write. Workers never refresh data: a process forked
+from the master does (and saves the snapshot), and once the data changed it
+sends HUP to the master, which reloads it and replaces workers with ones
+forked from the new data. To keep the pages shared, objects loaded by the
+master are frozen (moved out of reach of the garbage collector, which would
+write to every one of them) and the compact contact store should be used: it
+keeps the contact list in a few big arrays, so reading it does not touch (and
+copy) pages of many small objects. With GD77_PRELOAD=0 every worker loads data on its own
+and HUP reloads the code too (see restart.sh).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import gc
+import os
+import shutil
+import signal
+import tempfile
+
+
+# metrics of all workers are kept there, so any of them can serve /metrics;
+# must be set before prometheus_client is imported
+METRICS_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), 'gd77-metrics')
+)
+# the master writes metrics too, while preloading the app (before
+# on_starting), but they are dropped with the rest by on_starting
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+
+preload_app = os.environ.get('GD77_PRELOAD', '1') != '0'
+# this file is read again on HUP, when data is already loaded
+if preload_app and not os.environ.get('GD77_PRELOADED'):
+    os.environ['GD77_PRELOADED'] = '1'  # see main.py
+    gc.disable()  # no collections (nor holes they leave) while loading data
+
+
+def _freeze():
+    """Keep the garbage collector off objects allocated until now."""
+    if hasattr(gc, 'freeze'):  # Python 3.7+
+        gc.freeze()
+
+
+def when_ready(server):
+    """Start refreshing data loaded by the master, in a forked process."""
+    if preload_app:
+        _freeze()
+        gc.enable()
+        import main  # pylint: disable=C0415
+        main.refresher.fork(lambda: os.kill(server.pid, signal.SIGHUP))
+
+
+def on_exit(server):  # pylint: disable=W0613
+    """Stop the refreshing process."""
+    if preload_app:
+        import main  # pylint: disable=C0415
+        main.refresher.stop()
+
+
+def on_reload(server):  # pylint: disable=W0613
+    """Load data changed by the refreshing process, before new workers are
+    forked."""
+    if preload_app:
+        import main  # pylint: disable=C0415
+        main.refresher.reload()
+
+
+def pre_fork(server, worker):  # pylint: disable=W0613
+    """Keep the garbage collector of workers off objects of the master."""
+    if preload_app:
+        _freeze()
+
+
+def post_fork(server, worker):  # pylint: disable=W0613
+    """Start worker forked from the master which loaded data."""
+    if preload_app:
+        import main  # pylint: disable=C0415
+        main.after_fork()
+
+
+def on_starting(server):  # pylint: disable=W0613
+    """Start with no metrics left by previous run."""
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR)
+
+
+def child_exit(server, worker):  # pylint: disable=W0613
+    """Drop live gauges of dead worker."""
+    from prometheus_client import multiprocess  # pylint: disable=C0415
+    multiprocess.mark_process_dead(worker.pid)
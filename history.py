@@ -0,0 +1,178 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+History of data versions, for delta exports.
+
+Only the current data is kept in memory, plus compact diffs between recent
+versions (utils.DATA_VERSION): the previous records of contacts (by DMR id)
+and repeaters (by sign) which changed. Data of an older version is the
+current one with these diffs reverted.
+
+History is not saved in snapshots, so after restart deltas are available
+only since versions loaded afterwards. Changes of groups defined in config
+(e.g. members of SP5KAB) are not tracked.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from collections import namedtuple
+import logging as log
+import threading
+
+from channels import ChannelsFactory
+from przemienniki import PrzemiennikiWrapper
+import utils
+
+
+log.basicConfig(level=log.DEBUG)
+
+_END = (float('inf'), '')
+
+
+def _order(dmrid):
+    """Order of store.iter_rows()."""
+    return len(dmrid), dmrid
+
+
+def contacts_diff(old, new):
+    """Changes between ContactsFactory old and new: {DMR id: old record or
+    None if it was added}."""
+    changes = {}
+    old_rows, new_rows = old.records.iter_rows(), new.records.iter_rows()
+    old_id, old_row = next(old_rows, (None, None))
+    new_id, new_row = next(new_rows, (None, None))
+    while old_id is not None or new_id is not None:
+        old_key = _END if old_id is None else _order(old_id)
+        new_key = _END if new_id is None else _order(new_id)
+        if old_key < new_key:  # removed
+            changes[old_id] = old.records.get(old_id)
+            old_id, old_row = next(old_rows, (None, None))
+        elif new_key < old_key:  # added
+            changes[new_id] = None
+            new_id, new_row = next(new_rows, (None, None))
+        else:
+            if old_row != new_row:
+                changes[old_id] = old.records.get(old_id)
+            old_id, old_row = next(old_rows, (None, None))
+            new_id, new_row = next(new_rows, (None, None))
+    return changes
+
+
+def _by_sign(reps):
+    signs = {}
+    for repeater in reps.repeaters:
+        signs.setdefault(repeater.sign, []).append(repeater)
+    return signs
+
+
+def repeaters_diff(old, new):
+    """Changes between PrzemiennikiWrapper old and new: {sign: old
+    repeaters with the sign (empty if added)}."""
+    old_signs, new_signs = _by_sign(old), _by_sign(new)
+    return {
+        sign: old_signs.get(sign, [])
+        for sign in set(old_signs) | set(new_signs)
+        if old_signs.get(sign) != new_signs.get(sign)
+    }
+
+
+class DataHistory:
+    """Diffs between the current and up to depth previous data versions."""
+
+    Delta = namedtuple('Delta', 'version,contacts,contact_changes,reps,'
+                                'old_reps')
+
+    def __init__(self, depth=8, max_changes=0.1):
+        self.depth = depth
+        # history is dropped when more than this part of records changed
+        self.max_changes = max_changes
+        self.versions = []  # oldest first, the last one is current
+        self.diffs = []  # (contacts, repeaters) diffs to the next version
+        self.contacts = None
+        self.reps = None
+        self._old_reps = {}  # version -> rebuilt PrzemiennikiWrapper
+        self._lock = threading.Lock()
+
+    def update(self):
+        """Note current data (utils.CONTACTS, utils.REPS) as a new
+        version, data change listener."""
+        version, contacts, reps = \
+            utils.DATA_VERSION, utils.CONTACTS, utils.REPS
+        if version is None or contacts is None or reps is None or \
+                (self.versions and self.versions[-1] == version):
+            return
+        versions, diffs = [], []
+        if self.versions:
+            contact_changes = contacts_diff(self.contacts, contacts)
+            repeater_changes = repeaters_diff(self.reps, reps)
+            if len(contact_changes) > self.max_changes * max(
+                    len(contacts.records), len(self.contacts.records)):
+                log.info('Too many changes (%d contacts) since %s, '
+                         'dropping history', len(contact_changes),
+                         self.versions[-1])
+            else:
+                versions = self.versions[-self.depth:]
+                diffs = self.diffs[len(self.versions) - len(versions):]
+                diffs.append((contact_changes, repeater_changes))
+                log.info('Data version %s: %d contacts and %d repeaters '
+                         'changed', version, len(contact_changes),
+                         len(repeater_changes))
+        with self._lock:
+            self.versions = versions + [version]
+            self.diffs = diffs
+            self.contacts = contacts
+            self.reps = reps
+            self._old_reps = {}
+
+    def delta(self, since):
+        """Delta between version since and the current one, None if the
+        version is unknown (or too old)."""
+        with self._lock:
+            if since not in self.versions:
+                return None
+            diffs = self.diffs[self.versions.index(since):]
+            version, contacts, reps = \
+                self.versions[-1], self.contacts, self.reps
+            old_reps = self._old_reps.get(since)
+
+        contact_changes = {}
+        repeater_changes = {}
+        for contacts_step, repeaters_step in diffs:
+            for dmrid, record in contacts_step.items():
+                contact_changes.setdefault(dmrid, record)
+            for sign, repeaters in repeaters_step.items():
+                repeater_changes.setdefault(sign, repeaters)
+
+        if old_reps is None:
+            old_reps = reps
+            if repeater_changes:
+                old_reps = PrzemiennikiWrapper(repeaters=[
+                    repeater for repeater in reps.repeaters
+                    if repeater.sign not in repeater_changes
+                ] + [
+                    repeater for repeaters in repeater_changes.values()
+                    for repeater in repeaters
+                ])
+                ChannelsFactory.prerender(old_reps)
+            with self._lock:
+                if self.reps is reps:
+                    self._old_reps[since] = old_reps
+
+        return self.Delta(version, contacts, contact_changes, reps, old_reps)
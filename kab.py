@@ -24,10 +24,11 @@ License: GNU AGPLv3
 """
 
 import logging as log
-from requests import get
 
 from pyquery import PyQuery as pq
 
+import fetch
+
 
 log.basicConfig(level=log.DEBUG)
 
@@ -36,18 +37,18 @@ class KAB:
     """Extract data from SP5KAB website."""
 
     __URL__ = 'https://sp5kab.pl/czlonkowie/'
+    HEADERS = {
+        "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537." \
+                      "36 (KHTML, like Gecko) Chrome/63.0.3239.84 Safar" \
+                      "i/537.36"
+    }
 
 
     @staticmethod
     def _retrieve(url):
         """Retrieve website of given url."""
-        headers = {
-            "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537." \
-                          "36 (KHTML, like Gecko) Chrome/63.0.3239.84 Safar" \
-                          "i/537.36"
-        }
-
-        req = get(url, headers=headers)
+        req = fetch.SESSION.get(url, headers=KAB.HEADERS,
+                                timeout=fetch.TIMEOUT)
         if req.status_code != 200:
             log.error('Cannot retrieve data from KAB site!')
             return None
@@ -55,10 +56,11 @@ class KAB:
         return req.content.decode()
 
     @staticmethod
-    def retrieve_members():
-        """Parse club site to get callsigns of club members."""
+    def retrieve_members(html=None):
+        """Parse club site (retrieve it unless html is given) to get callsigns
+        of club members."""
         members = []
-        parser = pq(KAB._retrieve(KAB.__URL__))
+        parser = pq(html or KAB._retrieve(KAB.__URL__))
 
         for member in map(lambda li: li.text.split(), parser('.entry-content li')):
             if len(member) > 1:
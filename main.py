@@ -24,41 +24,138 @@ License: GNU AGPLv3
 """
 
 import logging as log
-import io
-import zipfile
-from datetime import datetime
+import os
+import threading
 
-from flask import Flask, Response, render_template, abort
+from flask import (Flask, Response, render_template, abort, jsonify,
+                   request, send_file)
 import msgpack
 
-from contacts import ContactsFactory
+from assets import PageCache, StaticAssets, respond
+from bulk import BulkExporter
+from cache import ResultCache, query_key
 from channels import ChannelsFactory
+from history import DataHistory
+from presets import Presets
+from queries import SavedQueries
+from refresher import DataRefresher
+import fetch
+import metrics
+import profiling
 import utils
 
-now = datetime.utcnow()
 __VERSION__ = 0,9,4
 __LAST_UPDATE__ = "2018-01-14"
-__LAST_DATA_UPDATE__ = "{d} {h:02d}:{m:02d}".format(
-    d=now.date().isoformat(),
-    h=now.time().hour,
-    m=now.time().minute
-)
 
 
 utils.load_config()
+fetch.configure(utils.CONFIG.get('upstream', {}))
 
 log.basicConfig(level=log.DEBUG)
 
-app = Flask(__name__)  # pylint: disable=C0103
-contacts = ContactsFactory()  # pylint: disable=C0103
+# static files are served by get_static_file (fingerprinted, compressed)
+app = Flask(__name__, static_folder=None)  # pylint: disable=C0103
+static_assets = StaticAssets(  # pylint: disable=C0103
+    os.path.join(app.root_path, 'static')
+)
+pages = PageCache()  # pylint: disable=C0103
+# let the web server send files from disk (presets), see Flask docs
+app.config['USE_X_SENDFILE'] = utils.CONFIG.get('x_sendfile', False)
+# factories keep all state of an export local, so threads generate many files
+# from one of them (this one and utils.CONTACTS) at the same time
 channels = ChannelsFactory()  # pylint: disable=C0103
 
+presets = Presets(  # pylint: disable=C0103
+    utils.CONFIG.get('presets_dir', 'presets'),
+    utils.CONFIG.get('presets')
+)
+
+saved_queries = SavedQueries(  # pylint: disable=C0103
+    utils.CONFIG.get('saved_queries', {}).get('directory', 'queries'),
+    utils.CONFIG.get('saved_queries', {}).get('keep_days', 90),
+    utils.CONFIG.get('saved_queries', {}).get('precompute_days', 7),
+    utils.CONFIG.get('saved_queries', {}).get('max_files', 10000)
+)
+
+refresher = DataRefresher(  # pylint: disable=C0103
+    utils.CONFIG.get('refresh_interval', 0),
+    utils.CONFIG.get('snapshot'),
+    utils.CONFIG.get('upstream', {}).get('timeouts'),
+    utils.CONFIG.get('upstream', {}).get('urls')
+)
+history = DataHistory(  # pylint: disable=C0103
+    utils.CONFIG.get('delta', {}).get('versions', 8),
+    utils.CONFIG.get('delta', {}).get('max_changes', 0.1)
+)
+refresher.listeners.append(history.update)
+refresher.listeners.append(presets.render)
+refresher.listeners.append(saved_queries.render)
+# under gunicorn with preload_app (see gunicorn.conf.py) data is loaded and
+# refreshed by the master only, workers are replaced when it changes;
+# otherwise every process refreshes its data, once the pool of bulk exports
+# is forked (below)
+refresher.boot(revalidate=bool(os.environ.get('GD77_PRELOADED')))
+
+results = ResultCache(  # pylint: disable=C0103
+    utils.CONFIG.get('result_cache', {}).get('entries', 256),
+    utils.CONFIG.get('result_cache', {}).get('megabytes', 64) * 2**20,
+    utils.CONFIG.get('result_cache', {}).get('entry_megabytes', 4) * 2**20
+)
+
+bulk = BulkExporter(  # pylint: disable=C0103
+    utils.CONFIG.get('bulk', {}).get('processes', 2)
+)
+refresher.listeners.append(bulk.close)  # its pool has the old data
+if not os.environ.get('GD77_PRELOADED'):
+    bulk.start()  # before any thread
+    refresher.start_refreshing()
+
+
+
+def config_changed():
+    """Apply config reloaded while running (see check_config). Other
+    settings (directories, caches, processes, intervals) need restart."""
+    fetch.configure(utils.CONFIG.get('upstream', {}))
+    presets.configure(utils.CONFIG.get('presets'))
+    presets.render()
+    saved_queries.render()
+
+
+def after_fork():
+    """Start worker forked from the master which loaded data."""
+    fetch.SESSION.close()  # connections of the master are not shared
+    metrics.data_updated(utils.LAST_DATA_UPDATE)
+    bulk.start()  # before any thread of the worker
+
+
 flasklog = log.getLogger('werkzeug')
 flasklog.setLevel(log.ERROR)
 
+@app.before_request
+def check_config():
+    """Pick up changes of config file, without restarting."""
+    if utils.reload_config():
+        threading.Thread(target=config_changed, daemon=True).start()
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """url_for('static', filename=...) gives fingerprinted URL."""
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.url_path(values['filename'])
+
+
 @app.route("/", methods=["GET"])
 def index():
-    """Serve the main page."""
+    """Serve the main page, rendered once for data (config and
+    presets)."""
+    version = (utils.output_version(), utils.LAST_DATA_UPDATE,
+               tuple(sorted(presets.bundles)))
+    return respond(pages.get('index', version, render_index))
+
+
+def render_index():
+    """Render the main page."""
     return render_template(
         'index.html',
         prefixy=utils.CONFIG['sp_prefixy'],
@@ -72,47 +169,302 @@ def index():
         gov_services=utils.CONFIG['gov_services'],
         pmr=utils.CONFIG['pmr'],
         pmr_digi=utils.CONFIG['pmr-digi'],
+        radio_profiles=utils.CONFIG.radio_profiles,
         version='.'.join(map(str, list(__VERSION__))),
         last_update=__LAST_UPDATE__,
-        last_data=__LAST_DATA_UPDATE__
+        last_data=utils.LAST_DATA_UPDATE,
+        presets=[preset for name, preset in presets.presets.items()
+                 if presets.get(name)]
     )
 
 
-@app.route("/csv/<query>", methods=["GET"])
-def get_csv_file(query):
-    """Serve the file."""
+def stream_export(query):
+    """Generate file for decoded query, returns (chunks, mimetype,
+    filename)."""
+    contacts_csv = metrics.timed('render.contacts', utils.chunked(
+        utils.CONTACTS.iter_csv(query['contacts'])
+    ))
+    if utils.are_channels_requested(query):
+        channels_csv = metrics.timed('render.channels', utils.chunked(
+            channels.iter_csv(query['channels'])
+        ))
+        zip_file = metrics.timed('zip', utils.iter_zip([
+            ('contacts.csv', contacts_csv),
+            ('channels.csv', channels_csv)
+        ]))
+        return zip_file, "application/zip", "gd77.zip"
+
+    return contacts_csv, "text/csv", "gd77-contacts.csv"
+
+
+def build_export(query):
+    """Generate file for decoded query, returns (body, mimetype, filename)."""
+    chunks, mimetype, filename = stream_export(query)
+    return b''.join(chunks), mimetype, filename
+
+
+def decode_query(query):
+    """Decode (hex encoded msgpack) query, aborts with 404 if it is
+    wrong."""
     try:
-        query = msgpack.unpackb(bytearray.fromhex(query), encoding='utf-8')
-        # log.debug(query)
+        with metrics.stage('decode'):
+            query = msgpack.unpackb(bytearray.fromhex(query), raw=False)
     except (msgpack.exceptions.UnpackValueError, ValueError) as error:
         log.error("Wrong query: %s", error)
         abort(404)
+    if not utils.is_valid_query(query):
+        log.error("Wrong query: parts missing")
+        abort(404)
+    return query
+
 
-    contacts_csv = contacts.as_csv(query['contacts'])
+def stream_delta(query, delta):
+    """Generate file of rows changed since delta.version for decoded query,
+    returns (chunks, mimetype, filename)."""
+    contacts_csv = metrics.timed('render.delta', utils.chunked(
+        delta.contacts.iter_delta_csv(query['contacts'],
+                                      delta.contact_changes)
+    ))
     if utils.are_channels_requested(query):
-        channels_csv = channels.as_csv(query['channels'])
-        a_mem_file = io.BytesIO()
-        with zipfile.ZipFile(a_mem_file,'w') as zip_file:
-            zip_file.writestr('contacts.csv', ''.join(contacts_csv))
-            zip_file.writestr('channels.csv', ''.join(channels_csv))
-
-        return Response(
-            a_mem_file.getvalue(),
-            mimetype="application/zip",
-            headers={"Content-disposition": "attachment; filename=gd77.zip"}
+        channels_csv = metrics.timed('render.delta', utils.chunked(
+            channels.iter_delta_csv(query['channels'], delta.reps,
+                                    delta.old_reps)
+        ))
+        zip_file = metrics.timed('zip', utils.iter_zip([
+            ('contacts-delta.csv', contacts_csv),
+            ('channels-delta.csv', channels_csv)
+        ]))
+        return zip_file, "application/zip", "gd77-delta.zip"
+
+    return contacts_csv, "text/csv", "gd77-contacts-delta.csv"
+
+
+def profiled_export(query):
+    """Serve file for decoded query generated under profiler (see
+    profiling), never from cache."""
+    name, (body, mimetype, filename) = profiling.run(
+        query, lambda: build_export(query)
+    )
+    metrics.EXPORT_REQUESTS.labels(
+        'profiled' if name else 'generated').inc()
+    response = Response(
+        metrics.served(body, mimetype),
+        mimetype=mimetype,
+        headers={
+            "Content-disposition": "attachment; filename=" + filename
+        }
+    )
+    if name:
+        response.headers[profiling.HEADER] = name
+    response.headers["X-Data-Version"] = utils.DATA_VERSION or ''
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/csv/<query>", methods=["GET"])
+def get_csv_file(query):
+    """Serve the file."""
+    query = decode_query(query)
+    if profiling.wanted(request.headers):
+        return profiled_export(query)
+    key = query_key(query)
+    version = utils.output_version()
+    etag = '{}-{}'.format(version, key)
+    if request.if_none_match.contains(etag):
+        metrics.EXPORT_REQUESTS.labels('not_modified').inc()
+        response = Response(status=304)
+    else:
+        cached = results.lookup(key, version)
+        if cached:
+            metrics.EXPORT_REQUESTS.labels('cached').inc()
+            body, mimetype, filename = cached
+        elif utils.CONFIG.get('stream_exports'):
+            metrics.EXPORT_REQUESTS.labels('generated').inc()
+            body, mimetype, filename = stream_export(query)
+            body = results.stream(key, version, body, mimetype, filename)
+        else:
+            metrics.EXPORT_REQUESTS.labels('generated').inc()
+            body, mimetype, filename = results.get(
+                key, version, lambda: build_export(query)
+            )
+        response = Response(
+            metrics.served(body, mimetype),
+            mimetype=mimetype,
+            headers={
+                "Content-disposition": "attachment; filename=" + filename
+            }
         )
+    response.set_etag(etag)
+    response.headers["X-Data-Version"] = utils.DATA_VERSION or ''
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/delta/<since>/<query>", methods=["GET"])
+def get_delta_file(since, query):
+    """Serve rows of the file added, changed or removed since data version
+    (X-Data-Version of the file downloaded before). 410 Gone if the version
+    is too old, the whole file has to be downloaded again."""
+    query = decode_query(query)
+    delta = history.delta(since)
+    if delta is None:
+        metrics.EXPORT_REQUESTS.labels('delta_gone').inc()
+        abort(410)
+
+    etag = '{}.{}-{}-{}'.format(delta.version, utils.CONFIG.version, since,
+                                query_key(query))
+    if request.if_none_match.contains(etag):
+        metrics.EXPORT_REQUESTS.labels('not_modified').inc()
+        response = Response(status=304)
+    else:
+        metrics.EXPORT_REQUESTS.labels('delta').inc()
+        body, mimetype, filename = stream_delta(query, delta)
+        body = utils.primed(body)  # errors as 500, not a cut-off file
+        response = Response(
+            metrics.served(body, mimetype),
+            mimetype=mimetype,
+            headers={
+                "Content-disposition": "attachment; filename=" + filename
+            }
+        )
+    response.set_etag(etag)
+    response.headers["X-Data-Version"] = delta.version
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/preset/<name>", methods=["GET"])
+def get_preset_file(name):
+    """Serve the (pre-rendered) file of preset."""
+    bundle = presets.get(name)
+    if bundle is None:
+        abort(404)
+
+    if request.if_none_match.contains(bundle.etag):
+        metrics.EXPORT_REQUESTS.labels('not_modified').inc()
+        response = Response(status=304)
+    else:
+        metrics.EXPORT_REQUESTS.labels('preset').inc()
+        metrics.EXPORT_BYTES.labels(bundle.mimetype).inc(bundle.size)
+        response = send_file(bundle.path, mimetype=bundle.mimetype)
+        response.headers["Content-disposition"] = \
+            "attachment; filename=" + bundle.filename
+    response.set_etag(bundle.etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def decode_posted():
+    """Decode posted (msgpack or JSON) body, aborts with 400 if it is
+    wrong."""
+    try:
+        if request.is_json:
+            return request.get_json()
+        return msgpack.unpackb(request.get_data(), raw=False)
+    except (msgpack.exceptions.UnpackValueError, ValueError) as error:
+        log.error("Wrong posted query: %s", error)
+        abort(400)
+
+
+@app.route("/q", methods=["POST"])
+def save_query():
+    """Save posted (msgpack or JSON) query, returns its ID and URL."""
+    query = decode_posted()
+    if not utils.is_valid_query(query):
+        abort(400)
+    try:
+        qid = saved_queries.save(query)
+    except (KeyError, TypeError, AttributeError, ValueError) as error:
+        log.error("Wrong posted query: %s", error)
+        abort(400)
+    return jsonify(id=qid, url='/q/' + qid), 201
+
+
+@app.route("/q/<qid>", methods=["GET"])
+def get_saved_query_file(qid):
+    """Serve the (pre-rendered) file of saved query."""
+    bundle = saved_queries.get(qid)
+    if bundle is None:
+        abort(404)
+
+    if request.if_none_match.contains(bundle.etag):
+        metrics.EXPORT_REQUESTS.labels('not_modified').inc()
+        response = Response(status=304)
+    else:
+        metrics.EXPORT_REQUESTS.labels('saved').inc()
+        response = send_file(bundle.path, mimetype=bundle.mimetype)
+        metrics.EXPORT_BYTES.labels(bundle.mimetype).inc(
+            response.content_length or 0)
+        response.headers["Content-disposition"] = \
+            "attachment; filename=" + bundle.filename
+    response.set_etag(bundle.etag)
+    response.headers["X-Data-Version"] = utils.DATA_VERSION or ''
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/bulk", methods=["POST"])
+def get_bulk_file():
+    """Serve zip file with folder for each of posted queries, given (as
+    msgpack or JSON) as map of folder names to queries or list of them."""
+    queries = decode_posted()
+
+    if isinstance(queries, dict):
+        queries = list(queries.items())
+    elif isinstance(queries, list):
+        queries = list(enumerate(queries, 1))
+    else:
+        abort(400)
+    if not queries or not all(utils.is_valid_query(query)
+                              for _, query in queries):
+        abort(400)
+    if len(queries) > utils.CONFIG.get('bulk', {}).get('max_queries', 100):
+        abort(413)
 
     return Response(
-        contacts_csv,
-        mimetype="text/csv",
+        metrics.served(utils.primed(bulk.iter_zip(queries)),
+                       "application/zip"),
+        mimetype="application/zip",
         headers={
-            "Content-disposition": "attachment; filename=gd77-contacts.csv"
+            "Content-disposition": "attachment; filename=gd77-bulk.zip"
         }
     )
 
-@app.route('/static/<path:path>')
-def getStaticFile(path):
-    return send_from_directory('static', path, cache_timeout=0)
+@app.route("/suggest", methods=["GET"])
+def get_suggestions():
+    """Callsigns (or DMR ids) for (partially typed) ?q= text, for priority
+    and ignored contacts fields, see ContactsFactory.suggest."""
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), 50))
+    except ValueError:
+        abort(400)
+    with metrics.stage('suggest'):
+        found = utils.CONTACTS.suggest(request.args.get('q', '')[:16], limit)
+    response = jsonify(suggestions=[
+        {
+            'callsign': record.callsign,
+            'dmrid': record.dmrid,
+            'name': record.name,
+            'exact': exact
+        } for record, exact in found
+    ])
+    response.cache_control.max_age = 60
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Serve metrics (of all workers) in Prometheus format."""
+    body, mimetype = metrics.exposition()
+    return Response(body, headers={"Content-Type": mimetype})
+
+@app.route('/static/<path:filename>', endpoint='static')
+def get_static_file(filename):
+    """Serve static file, fingerprinted ones may be kept forever."""
+    response = static_assets.response(filename)
+    if response is None:
+        abort(404)
+    return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,187 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Prometheus metrics of export pipeline and upstream refreshes.
+
+Time of every stage is exclusive: when stages are nested (e.g. rows are
+selected while the zip archive is being generated), time of the inner stage
+is not counted to the outer one.
+
+Under gunicorn every worker keeps its own metrics, PROMETHEUS_MULTIPROC_DIR
+(see gunicorn.conf.py) must point to a directory shared by all of them, so
+/metrics served by any worker reports all of them.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from datetime import timezone
+import os
+import threading
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+
+import utils
+
+
+STAGE_SECONDS = Histogram(
+    'gd77_export_stage_seconds',
+    'Time spent in stage of file generation',
+    ['stage'],
+    buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1,
+             .25, .5, 1, 2.5, 5, 10)
+)
+EXPORT_ROWS = Counter(
+    'gd77_export_rows', 'Rows of generated CSV files', ['file']
+)
+EXPORT_BYTES = Counter(
+    'gd77_export_bytes', 'Bytes of served files', ['mimetype']
+)
+EXPORT_REQUESTS = Counter(
+    'gd77_export_requests', 'Requests for files', ['result']
+)
+REFRESH_SECONDS = Histogram(
+    'gd77_refresh_seconds',
+    'Time of upstream data refresh',
+    ['source'],
+    buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+DATA_UPDATED = Gauge(
+    'gd77_data_updated_timestamp_seconds',
+    'When the oldest data served by any worker changed upstream',
+    multiprocess_mode='livemin'
+)
+
+_LOCAL = threading.local()
+
+
+def _enter():
+    """Start timing a stage, pausing the enclosing one."""
+    now = time.perf_counter()
+    stack = _LOCAL.__dict__.setdefault('stack', [])
+    if stack:
+        stack[-1][1] += now - stack[-1][0]
+    stack.append([now, 0.0])  # running since, elapsed before
+
+
+def _leave():
+    """Stop timing the current stage, resume the enclosing one, returns
+    (exclusive) time of the stage."""
+    now = time.perf_counter()
+    stack = _LOCAL.stack
+    started, elapsed = stack.pop()
+    if stack:
+        stack[-1][0] = now
+    return elapsed + now - started
+
+
+class stage:  # pylint: disable=C0103
+    """Context manager observing (exclusive) time of the block as stage."""
+
+    __slots__ = ['histogram']
+
+    def __init__(self, name):
+        self.histogram = STAGE_SECONDS.labels(name)
+
+    def __enter__(self):
+        _enter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(_leave())
+
+
+def timed(name, iterable):
+    """Iterate over iterable, observing (exclusive) time spent generating
+    its items, as stage name, once it is exhausted (or abandoned)."""
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            _enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += _leave()
+            yield item
+    finally:
+        STAGE_SECONDS.labels(name).observe(elapsed)
+
+
+def rows(name, count):
+    """Count rows of generated CSV file."""
+    EXPORT_ROWS.labels(name).inc(count)
+
+
+def served(body, mimetype):
+    """Count bytes of body (bytes or iterable of them) while it is sent."""
+    if isinstance(body, bytes):
+        EXPORT_BYTES.labels(mimetype).inc(len(body))
+        return body
+
+    def counting():
+        counter = EXPORT_BYTES.labels(mimetype)
+        for chunk in body:
+            counter.inc(len(chunk))
+            yield chunk
+    return counting()
+
+
+def data_updated(stamp):
+    """Note time of data change, given as utils.timestamp() string."""
+    updated = utils.parse_timestamp(stamp)
+    if updated:
+        DATA_UPDATED.set(updated.replace(tzinfo=timezone.utc).timestamp())
+
+
+class _WithDataAge:
+    """Metrics of source collector, with age of data computed at scrape."""
+
+    def __init__(self, source):
+        self.source = source
+
+    def collect(self):
+        now = time.time()
+        for metric in self.source.collect():
+            yield metric
+            if metric.name == 'gd77_data_updated_timestamp_seconds':
+                updated = [sample.value for sample in metric.samples
+                           if sample.value]
+                if updated:
+                    yield GaugeMetricFamily(
+                        'gd77_data_age_seconds',
+                        'Age of the oldest data served by any worker',
+                        value=now - min(updated)
+                    )
+
+
+def exposition():
+    """Current metrics (of all workers), returns (body, mimetype)."""
+    registry = CollectorRegistry()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        source = multiprocess.MultiProcessCollector(CollectorRegistry())
+    else:
+        source = REGISTRY
+    registry.register(_WithDataAge(source))
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,144 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Presets: named queries (defined in config) rendered into files on disk
+whenever data changes, so they are served without generating anything.
+
+Files are named after their content hash (which is also their ETag), so
+workers which rendered the same file share it.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from collections import namedtuple
+from collections.abc import Mapping
+from hashlib import sha1
+import logging as log
+import os
+import re
+import time
+
+from channels import ChannelsFactory
+import utils
+
+
+log.basicConfig(level=log.DEBUG)
+
+
+def build(query, channels):
+    """File for query, as served by /csv/<query>: returns (body, mimetype,
+    extension)."""
+    contacts = b''.join(utils.CONTACTS.iter_csv(query['contacts']))
+    if not utils.are_channels_requested(query):
+        return contacts, 'text/csv', 'csv'
+    channels_csv = b''.join(channels.iter_csv(query['channels']))
+    body = b''.join(utils.iter_deflated_zip(
+        [
+            ('contacts.csv', utils.deflate(contacts)),
+            ('channels.csv', utils.deflate(channels_csv))
+        ],
+        utils.parse_timestamp(utils.LAST_DATA_UPDATE)
+    ))
+    return body, 'application/zip', 'zip'
+
+
+def write(path, body):
+    """Write file atomically (so other workers never see it half written),
+    only touch it if it already exists."""
+    if os.path.exists(path):
+        os.utime(path)  # still in use
+        return
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as out:
+        out.write(body)
+    os.replace(tmp_path, path)
+
+
+class Presets:
+    """Files of presets, rendered into directory."""
+
+    Bundle = namedtuple('Bundle', 'path,etag,mimetype,filename,size')
+    NAME = re.compile(r'^[\w-]+$')
+    KEEP = 24 * 3600  # [s] files not used any more are removed after that
+
+    def __init__(self, directory, presets):
+        self.directory = directory
+        self.presets = {}
+        self.bundles = {}  # name -> Bundle, swapped as a whole
+        self.channels = ChannelsFactory()
+        self.configure(presets)
+
+    def configure(self, presets):
+        """Set presets (from config), rendered by the next render()."""
+        named = {}
+        for preset in presets or []:
+            if not self.NAME.match(str(preset.get('name', ''))) or \
+                    not isinstance(preset.get('query'), Mapping):
+                log.warning('Skipping wrong preset: %s', preset)
+                continue
+            named[preset['name']] = preset
+        self.presets = named
+
+    def get(self, name):
+        """Bundle of preset, None if there is no such (rendered) preset."""
+        return self.bundles.get(name)
+
+    def render(self):
+        """Render all presets from current data."""
+        if not self.presets:
+            return
+        start = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        bundles = {}
+        for name, preset in self.presets.items():
+            try:
+                body, mimetype, ext = build(preset['query'], self.channels)
+                etag = sha1(body).hexdigest()[:20]
+                path = os.path.join(
+                    self.directory, '{}-{}.{}'.format(name, etag, ext)
+                )
+                write(path, body)
+            except (KeyError, TypeError, IOError, OSError) as error:
+                log.error('Cannot render preset %s: %s', name, error)
+                continue
+            bundles[name] = self.Bundle(
+                path=os.path.abspath(path),
+                etag=etag,
+                mimetype=mimetype,
+                filename='gd77-{}.{}'.format(name, ext),
+                size=len(body)
+            )
+        self.bundles = bundles
+        log.info('%d presets rendered in %.3f s', len(bundles),
+                 time.perf_counter() - start)
+        self._cleanup()
+
+    def _cleanup(self):
+        """Remove files not used (by any worker) for a long time."""
+        used = {bundle.path for bundle in self.bundles.values()}
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if os.path.abspath(entry.path) in used or not entry.is_file():
+                continue
+            try:
+                if now - entry.stat().st_mtime > self.KEEP:
+                    os.remove(entry.path)
+            except OSError:
+                pass
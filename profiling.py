@@ -0,0 +1,121 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Opt-in profiling of exports.
+
+An export (/csv/<query>) is profiled (with cProfile) when the request has
+header X-Profile with the token from config (profiling: token) or, at
+random, for sample_rate part of requests. Profiled files are generated
+again (not served from cache) and the profile is written, with the query,
+to the profiling directory:
+
+    <name>.prof     cProfile stats (python -m pstats, snakeviz, ...)
+    <name>.query    the query (msgpack), see python -m benchmarks.replay
+
+Only the latest profiles (keep) are kept. Name of the profile is sent back
+in X-Profile header. One export is profiled at a time (a profiler is
+global to the process since Python 3.12), others are only generated.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import cProfile
+import hmac
+import logging as log
+import os
+import random
+import threading
+import time
+
+import msgpack
+
+from cache import query_key
+from presets import write
+import utils
+
+
+log.basicConfig(level=log.DEBUG)
+
+HEADER = 'X-Profile'
+_LOCK = threading.Lock()  # held while an export is profiled
+
+
+def _config():
+    return utils.CONFIG.get('profiling', {})
+
+
+def wanted(headers):
+    """Whether request (with given headers) should be profiled."""
+    config = _config()
+    token = config.get('token')
+    given = headers.get(HEADER)
+    if token and given and \
+            hmac.compare_digest(given.encode(), token.encode()):
+        return True
+    return random.random() < config.get('sample_rate', 0)
+
+
+def run(query, func):
+    """Call func() under profiler, write the profile of decoded query,
+    returns (name of profile, result of func). If another export is being
+    profiled, func() is just called and the name is None."""
+    if not _LOCK.acquire(blocking=False):
+        log.info('Another export is being profiled, not profiling')
+        return None, func()
+    try:
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        result = profile.runcall(func)
+        seconds = time.perf_counter() - start
+    finally:
+        _LOCK.release()
+
+    config = _config()
+    directory = config.get('directory', 'profiles')
+    name = '{}-{}-{}'.format(
+        time.strftime('%Y%m%d-%H%M%S', time.gmtime()), os.getpid(),
+        query_key(query)[:8]
+    )
+    try:
+        os.makedirs(directory, exist_ok=True)
+        write(os.path.join(directory, name + '.query'),
+              msgpack.packb(query, use_bin_type=True))
+        profile.dump_stats(os.path.join(directory, name + '.prof'))
+        rotate(directory, config.get('keep', 50))
+    except (IOError, OSError) as error:
+        log.error('Cannot write profile %s: %s', name, error)
+    log.info('Export profiled as %s in %.3f s', name, seconds)
+    return name, result
+
+
+def rotate(directory, keep):
+    """Remove all but the latest keep profiles (and their queries)."""
+    profiles = sorted(
+        (entry for entry in os.scandir(directory)
+         if entry.name.endswith('.prof')),
+        key=lambda entry: entry.stat().st_mtime, reverse=True
+    )
+    for entry in profiles[keep:]:
+        base = entry.path[:-len('.prof')]
+        for path in (entry.path, base + '.query'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -24,29 +24,164 @@ License: GNU AGPLv3
 """
 
 
+import io
 import logging as log
 
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 
 from lxml import etree
-from requests import get
+
+import fetch
+import geo
 
 
 log.basicConfig(level=log.DEBUG)
 
+BAND_LIMITS = {
+    '2m': (144.0, 146.0),
+    '70cm': (430.0, 440.0),
+}
+
+
+def resolve_freqs(freqs: list, band: str):
+    """Exctract first rx and tx frequency (as given by API) within band
+    from Repeater's freqs, returns {} if any of them is missing."""
+    limits = BAND_LIMITS.get(band.lower())
+    if not limits:
+        return {}
+
+    def in_band(freq):
+        return limits[0] <= float(freq) <= limits[1]
+
+    rx = [f['rx'] for f in freqs if 'rx' in f and in_band(f['rx'])]
+    tx = [f['tx'] for f in freqs if 'tx' in f and in_band(f['tx'])]
+    if not all([rx, tx]):
+        return {}
+
+    return {
+        'rx': rx[0],
+        'tx': tx[0]
+    }
+
+
+class RepeaterIndex:
+    """Repeaters indexed by band, mode, area (e.g. "SR5") and location, with
+    channel parameters resolved for each of BAND_LIMITS bands."""
+
+    NEAR_RADIUS = 50  # [km] default for "near" selection
+
+    Params = namedtuple('ChannelParams', 'rx,tx,rx_tone,tx_tone,digital')
+
+    def __init__(self, repeaters: list):
+        self.repeaters = repeaters
+        self.by_band = defaultdict(set)
+        self.by_mode = defaultdict(set)
+        self.by_area = defaultdict(set)
+        self.params = {}  # (position, band) -> Params
+        self.rows = None  # pre-rendered CSV rows, see ChannelsFactory
+        self.grid = geo.GridIndex(
+            (pos, repeater.lat, repeater.lon)
+            for pos, repeater in enumerate(repeaters)
+            if repeater.lat is not None and repeater.lon is not None
+        )
+
+        for pos, repeater in enumerate(repeaters):
+            for band in repeater.bands:
+                self.by_band[band].add(pos)
+            for mode in repeater.modes:
+                self.by_mode[mode].add(pos)
+            self.by_area[repeater.sign[0:3]].add(pos)
+
+            tones = repeater.tones if isinstance(repeater.tones, dict) else {}
+            if 'CTCSS' in repeater.activation:
+                rx_tone = tones.get('rx', 'None')
+                tx_tone = tones.get('tx', 'None')
+            else:
+                rx_tone = tx_tone = 'None'
+
+            for band in BAND_LIMITS:
+                try:
+                    freqs = resolve_freqs(repeater.freqs, band)
+                except (TypeError, ValueError):
+                    log.warning('Wrong frequency of %s', repeater.sign)
+                    continue
+                if freqs:
+                    self.params[(pos, band)] = self.Params(
+                        rx=freqs['rx'],
+                        tx=freqs['tx'],
+                        rx_tone=rx_tone,
+                        tx_tone=tx_tone,
+                        digital="MOTOTRBO" in repeater.modes
+                    )
+
+    def _area(self, area):
+        prefix = "SR{}".format(area)
+        if len(prefix) == 3:
+            return self.by_area.get(prefix, set())
+        return {pos for pos, repeater in enumerate(self.repeaters)
+                if repeater.sign.startswith(prefix)}
+
+    @staticmethod
+    def _point(near: dict):
+        """(lat, lon) of "near" selection, given by locator or lat and
+        lon."""
+        if near.get('locator'):
+            return geo.locator_to_latlon(near['locator'])
+        try:
+            return float(near['lat']), float(near['lon'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def near(self, near: dict, accept=None):
+        """Positions (nearest first) of repeaters for which accept(position)
+        is true, within "radius" [km] and/or "count" nearest of point given
+        as "locator" or "lat" and "lon" of near."""
+        point = self._point(near)
+        if point is None:
+            return []
+        try:
+            radius = float(near.get('radius') or 0)
+            count = int(near.get('count') or 0)
+        except (TypeError, ValueError):
+            return []
+        if count > 0:
+            found = self.grid.nearest(*point, count, radius or None, accept)
+        else:
+            found = self.grid.within(*point, radius or self.NEAR_RADIUS,
+                                     accept)
+        return [pos for _, pos in found]
+
+    def select(self, bands: list, modes: list, areas: list,
+               near: dict = None):
+        """Positions of repeaters working in any of given bands, in any of
+        given modes, in any of given areas (in list order) or, if near is
+        given, near given point (nearest first, see near())."""
+        band_match = set().union(
+            *[self.by_band.get(band.upper(), ()) for band in bands])
+        mode_match = set().union(
+            *[self.by_mode.get(mode.upper(), ()) for mode in modes])
+        if near:
+            return self.near(near, (band_match & mode_match).__contains__)
+        area_match = set().union(*map(self._area, areas))
+        return sorted(band_match & mode_match & area_match)
+
 
 class PrzemiennikiWrapper:
     """Simple wrapper for https://przemienniki.net API."""
 
     API_URL = 'https://przemienniki.net/export/rxf.xml?country=pl&onlyworking'
     REP = namedtuple('Repeater', 'sign,modes,working,bands,freqs,activation,'\
-                                 'tones')
+                                 'tones,lat,lon')
 
-    def __init__(self):
+    def __init__(self, content=None, repeaters=None):
         self.repeaters = []
         self.bands = set()
         self.modes = set()
-        self.get_repeaters()
+        self.index = RepeaterIndex([])
+        if repeaters is None:
+            self.get_repeaters(content)
+        else:
+            self.set_repeaters(repeaters)
 
     @staticmethod
     def _ext_many(obj, field):
@@ -66,6 +201,17 @@ class PrzemiennikiWrapper:
         else:
             return dicts
 
+    @staticmethod
+    def _ext_location(obj):
+        """(lat, lon) of repeater, from its coordinates or (less precise)
+        locator, (None, None) if unknown."""
+        try:
+            return float(obj.findtext('latitude')), \
+                float(obj.findtext('longitude'))
+        except (TypeError, ValueError):
+            pass
+        return geo.locator_to_latlon(obj.findtext('locator')) or (None, None)
+
     @staticmethod
     def _extract_repeater_data(obj):
 
@@ -77,6 +223,7 @@ class PrzemiennikiWrapper:
         else:
             tones = {}
 
+        lat, lon = PrzemiennikiWrapper._ext_location(obj)
         return PrzemiennikiWrapper.REP(
             sign=obj.find('qra').text,
             modes=PrzemiennikiWrapper._ext_many(obj, 'mode'),
@@ -84,28 +231,51 @@ class PrzemiennikiWrapper:
             bands=PrzemiennikiWrapper._ext_many(obj, 'band'),
             freqs=PrzemiennikiWrapper._ext_many_attr(obj, 'qrg', 'type'),
             activation=PrzemiennikiWrapper._ext_many(obj, 'activation'),
-            tones=tones
+            tones=tones,
+            lat=lat,
+            lon=lon
         )
 
-    def get_repeaters(self):
-        """Get and parse XML from API, extract Repeater's data."""
-        parser = etree.XMLParser(recover=True)
+    @staticmethod
+    def _iter_repeaters(source):
+        """Parse XML incrementally, dropping every processed element, so the
+        whole document is never kept in memory."""
+        for _, element in etree.iterparse(source, tag='repeater',
+                                          recover=True):
+            yield PrzemiennikiWrapper._extract_repeater_data(element)
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def get_repeaters(self, content=None):
+        """Get and parse XML from API (unless already retrieved content or
+        binary file is given), extract Repeater's data."""
         try:
-            root = etree.fromstring(
-                get(self.API_URL).content,
-                parser=parser
-            )
+            if not content:
+                result = fetch.SESSION.get(self.API_URL, stream=True,
+                                           timeout=fetch.TIMEOUT)
+                result.raw.decode_content = True
+                content = result.raw
+            elif isinstance(content, bytes):
+                content = io.BytesIO(content)
+            repeaters = list(self._iter_repeaters(content))
         except:
             log.error('Cannot retrieve or parse XML!')
             return 0
 
-        self.repeaters.clear()
-        for repeater in root.iter('repeater'):
-            data = self._extract_repeater_data(repeater)
+        return self.set_repeaters(repeaters)
+
+    def set_repeaters(self, repeaters):
+        """Replace repeaters with given (already parsed) Repeater records."""
+        self.repeaters = []
+        self.bands = set()
+        self.modes = set()
+        for data in repeaters:
             self.bands.update(set(map(str.lower, data.bands)))
             self.modes.update(set(data.modes))
             self.repeaters.append(data)
 
         self.bands = sorted(list(self.bands))
         self.modes = sorted(list(self.modes))
+        self.index = RepeaterIndex(self.repeaters)
         return len(self.repeaters)
@@ -0,0 +1,203 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Saved queries: queries posted once and downloaded by short ID (/q/<id>).
+
+Queries and their files are kept in a directory shared by all workers:
+
+    <id>.query              the query (msgpack), touched on every download
+    <id>-<version>.<ext>    file of the query for data (and config) version
+
+Files are rendered when the query is saved and, for queries downloaded
+recently, again whenever data changes, so downloads are only a lookup. At
+most max_files queries are kept: the least recently downloaded ones (with
+their files) make room for new ones.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from base64 import urlsafe_b64encode
+from collections import namedtuple
+from hashlib import sha1
+import logging as log
+import os
+import re
+import time
+
+import msgpack
+
+from cache import canonical
+from channels import ChannelsFactory
+from presets import build, write
+import utils
+
+
+log.basicConfig(level=log.DEBUG)
+
+
+def query_id(query):
+    """Short (12 characters), stable ID of decoded query."""
+    digest = sha1(
+        msgpack.packb(canonical(query), use_bin_type=True)
+    ).digest()
+    return urlsafe_b64encode(digest[:9]).decode()
+
+
+class SavedQueries:
+    """Saved queries and their files, rendered into directory."""
+
+    Bundle = namedtuple('Bundle', 'path,etag,mimetype,filename')
+    ID = re.compile(r'^[\w-]{12}$')
+    MIMETYPES = {'csv': 'text/csv', 'zip': 'application/zip'}
+    KEEP_FILES = 3600  # [s] files of previous data versions are removed after
+    MAX_QUERY_BYTES = 64 * 1024  # of packed query
+
+    def __init__(self, directory, keep_days=90, precompute_days=7,
+                 max_files=10000):
+        self.directory = directory
+        self.keep = keep_days * 24 * 3600
+        self.precompute = precompute_days * 24 * 3600
+        self.max_files = max_files
+        self.channels = ChannelsFactory()
+
+    def _path(self, qid, ext='query', version=None):
+        name = qid if version is None else '{}-{}'.format(qid, version)
+        return os.path.join(self.directory, '{}.{}'.format(name, ext))
+
+    @staticmethod
+    def _ext(query):
+        return 'zip' if utils.are_channels_requested(query) else 'csv'
+
+    def save(self, query):
+        """Render file of decoded query and, once it is rendered, save the
+        query, returns its ID. Raises ValueError if the query is too big (and
+        whatever rendering raises)."""
+        packed = msgpack.packb(query, use_bin_type=True)
+        if len(packed) > self.MAX_QUERY_BYTES:
+            raise ValueError('query of {} bytes'.format(len(packed)))
+        qid = query_id(query)
+        os.makedirs(self.directory, exist_ok=True)
+        self._render(qid, query)
+        if not os.path.exists(self._path(qid)):
+            self._evict(self.max_files - 1)
+        write(self._path(qid), packed)
+        return qid
+
+    def _evict(self, keep):
+        """Remove least recently downloaded (or saved) queries and their
+        files, so at most keep queries are left."""
+        used, files = [], []
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith('.query'):
+                    used.append((entry.stat().st_mtime, entry.name[:-6]))
+                else:
+                    files.append(entry)
+            except OSError:  # removed meanwhile
+                pass
+        if len(used) <= keep:
+            return
+        used.sort()
+        evicted = {qid for _, qid in used[:len(used) - max(keep, 0)]}
+        for qid in evicted:
+            self._remove(self._path(qid))
+        for entry in files:
+            if entry.name[:12] in evicted:
+                self._remove(entry.path)
+        log.info('%d saved queries removed to make room', len(evicted))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:  # removed by another worker
+            pass
+
+    def _load(self, qid):
+        with open(self._path(qid), 'rb') as source:
+            return msgpack.unpackb(source.read(), raw=False)
+
+    def _render(self, qid, query):
+        """Render file of query for the current data (unless it exists),
+        returns its path."""
+        path = self._path(qid, self._ext(query), utils.output_version())
+        if os.path.exists(path):
+            return path
+        body, _, _ = build(query, self.channels)
+        write(path, body)
+        return path
+
+    def get(self, qid):
+        """Bundle of saved query for the current data, rendered if needed,
+        None if there is no such query."""
+        if not self.ID.match(qid):
+            return None
+        version = utils.output_version()
+        try:
+            ext = 'csv'
+            path = self._path(qid, ext, version)
+            if not os.path.exists(path):
+                ext = 'zip'
+                path = self._path(qid, ext, version)
+            if not os.path.exists(path):
+                query = self._load(qid)
+                ext = self._ext(query)
+                path = self._render(qid, query)
+            os.utime(self._path(qid))  # downloaded recently
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                msgpack.exceptions.UnpackException) as error:
+            if not isinstance(error, FileNotFoundError):
+                log.error('Cannot load saved query %s: %s', qid, error)
+            return None
+        return self.Bundle(
+            path=os.path.abspath(path),
+            etag='{}-{}'.format(version, qid),
+            mimetype=self.MIMETYPES[ext],
+            filename='gd77-{}.{}'.format(qid, ext)
+        )
+
+    def render(self):
+        """Render files of queries downloaded recently from current data
+        (and config), remove old files and queries not downloaded for a long
+        time, data change listener."""
+        if not os.path.isdir(self.directory):
+            return
+        start = time.perf_counter()
+        now = time.time()
+        current = '-{}.'.format(utils.output_version())
+        rendered = 0
+        for entry in os.scandir(self.directory):
+            try:
+                age = now - entry.stat().st_mtime
+                if entry.name.endswith('.query'):
+                    qid = entry.name[:-len('.query')]
+                    if age > self.keep:
+                        os.remove(entry.path)
+                    elif age <= self.precompute:
+                        self._render(qid, self._load(qid))
+                        rendered += 1
+                elif age > self.KEEP_FILES and current not in entry.name:
+                    os.remove(entry.path)
+            except (IOError, OSError, ValueError, KeyError, TypeError,
+                    msgpack.exceptions.UnpackException) as error:
+                log.error('Cannot render saved query %s: %s', entry.name,
+                          error)
+        log.info('%d saved queries rendered in %.3f s', rendered,
+                 time.perf_counter() - start)
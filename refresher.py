@@ -0,0 +1,239 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Background refresh of upstream data (ham-digital, przemienniki.net, SP5KAB).
+
+Resources are re-fetched concurrently with conditional requests, new
+datasets are built off the request path and swapped in by rebinding module
+globals in utils.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging as log
+import os
+import signal
+import threading
+import time
+
+from channels import ChannelsFactory
+from contacts import ContactsFactory
+import fetch
+from kab import KAB
+import metrics
+from przemienniki import PrzemiennikiWrapper
+import snapshot
+import utils
+
+
+log.basicConfig(level=log.DEBUG)
+
+
+class DataRefresher(threading.Thread):
+    """Periodically refresh upstream data in a daemon thread."""
+
+    Source = namedtuple('Source', 'name,url,headers,update')
+
+    def __init__(self, interval, snapshot_path=None, timeouts=None,
+                 urls=None):
+        super().__init__(name='data-refresher', daemon=True)
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.revalidate = False
+        self.pid = None  # of forked refreshing process, see fork
+        self.fetcher = fetch.ConditionalFetcher()
+        urls = urls or {}  # source name -> URL used instead of the default
+        self.sources = [
+            self.Source('contacts', urls.get('contacts', ContactsFactory.URL),
+                        None, self._update_contacts),
+            self.Source('repeaters',
+                        urls.get('repeaters', PrzemiennikiWrapper.API_URL),
+                        None, self._update_repeaters),
+            self.Source('kab', urls.get('kab', KAB.__URL__), KAB.HEADERS,
+                        self._update_kab),
+        ]
+        self.timeouts = {
+            name: tuple(timeout) for name, timeout in (timeouts or {}).items()
+        }
+        self.timings = {}  # source name -> seconds of last refresh
+        self.listeners = []  # called (with no arguments) when data changes
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def _update_contacts(download):
+        contacts = ContactsFactory(text=io.TextIOWrapper(
+            download.body,
+            encoding=download.encoding or 'utf-8',
+            errors='replace',
+            newline=''
+        ))
+        if not contacts.records:
+            raise ValueError('empty contact list')
+        utils.CONTACTS = contacts
+
+    @staticmethod
+    def _update_repeaters(download):
+        reps = PrzemiennikiWrapper(content=download.body)
+        if not reps.repeaters:
+            raise ValueError('empty repeater list')
+        ChannelsFactory.prerender(reps)
+        utils.REPS = reps
+
+    @staticmethod
+    def _update_kab(download):
+        members = KAB.retrieve_members(html=download.body.read().decode())
+        if not members:
+            raise ValueError('empty member list')
+        utils.KAB = members
+
+    def _refresh_source(self, source):
+        """Fetch source, rebuild and swap in its data if it has changed."""
+        start = time.perf_counter()
+        download = self.fetcher.fetch(source.url, source.headers,
+                                      self.timeouts.get(source.name))
+        changed = False
+        if download is not None:
+            try:
+                source.update(download)
+                changed = True
+            except Exception as error:  # pylint: disable=W0703
+                log.error('Cannot update data from %s: %s', source.url,
+                          error)
+                self.fetcher.forget(source.url)
+            finally:
+                download.body.close()
+
+        self.timings[source.name] = time.perf_counter() - start
+        metrics.REFRESH_SECONDS.labels(source.name).observe(
+            self.timings[source.name])
+        log.info('Source %s refreshed in %.3f s (%s)', source.name,
+                 self.timings[source.name],
+                 'updated' if changed else 'not updated')
+        return changed
+
+    def refresh(self):
+        """Fetch all sources at once, rebuild and swap in these that
+        changed."""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(len(self.sources)) as pool:
+            changed = any(list(pool.map(self._refresh_source, self.sources)))
+        metrics.REFRESH_SECONDS.labels('all').observe(
+            time.perf_counter() - start)
+
+        # never leave the app without data, even if upstream is down
+        if utils.CONTACTS is None:
+            utils.CONTACTS = ContactsFactory(text='')
+        if utils.REPS is None:
+            utils.REPS = PrzemiennikiWrapper(content=b'<rxf/>')
+
+        if changed:
+            utils.LAST_DATA_UPDATE = utils.timestamp()
+            utils.DATA_VERSION = self.fetcher.version()
+            metrics.data_updated(utils.LAST_DATA_UPDATE)
+            if self.snapshot_path:
+                snapshot.save(self.snapshot_path, self.fetcher)
+            self._notify()
+        return changed
+
+    def _notify(self):
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception as error:  # pylint: disable=W0703
+                log.error('Data change listener %s failed: %s', listener,
+                          error)
+
+    def boot(self, revalidate=False):
+        """Load data from snapshot (warm start) or from upstream (cold
+        start). Snapshot data is checked with upstream once refreshing
+        starts (see start_refreshing) or, if revalidate, at once."""
+        start = time.perf_counter()
+        if self.snapshot_path and \
+                snapshot.load(self.snapshot_path, self.fetcher):
+            log.info('Warm start: data loaded from snapshot in %.3f s',
+                     time.perf_counter() - start)
+            metrics.data_updated(utils.LAST_DATA_UPDATE)
+            self._notify()
+            if revalidate:
+                self.refresh()
+            else:
+                self.revalidate = True  # snapshot may be stale
+        else:
+            self.refresh()
+            log.info('Cold start: data loaded from upstream in %.3f s',
+                     time.perf_counter() - start)
+
+    def start_refreshing(self):
+        """Start refreshing in background, if needed."""
+        if self.interval or self.revalidate:
+            self.start()
+
+    def fork(self, notify):
+        """Start refreshing in a process forked from this one (if needed),
+        instead of a thread, so this one stays single threaded and safe to
+        fork again (e.g. gunicorn master forking workers). The process saves
+        the snapshot and calls notify() when data changed, then this one
+        should reload() it."""
+        if not self.interval:
+            return
+        parent = os.getpid()
+        pid = os.fork()
+        if pid:
+            self.pid = pid
+            return
+        try:
+            utils.default_signals()
+            fetch.SESSION.close()  # connections of the parent are not shared
+            self.listeners = [notify]
+            while not self._stop_event.wait(self.interval) and \
+                    os.getppid() == parent:
+                self.refresh()
+        finally:
+            os._exit(0)  # pylint: disable=W0212
+
+    def reload(self):
+        """Take data changed by the forked refresher (see fork): load the
+        snapshot or, without one, refresh."""
+        version = utils.DATA_VERSION
+        if not self.snapshot_path or \
+                not snapshot.load(self.snapshot_path, self.fetcher):
+            return self.refresh()
+        if utils.DATA_VERSION == version:
+            return False
+        log.info('Data version %s reloaded from snapshot', utils.DATA_VERSION)
+        metrics.data_updated(utils.LAST_DATA_UPDATE)
+        self._notify()
+        return True
+
+    def run(self):
+        if self.revalidate:
+            self.refresh()
+        while self.interval and not self._stop_event.wait(self.interval):
+            self.refresh()
+
+    def stop(self):
+        """Stop refreshing."""
+        self._stop_event.set()
+        if self.pid:
+            os.kill(self.pid, signal.SIGTERM)
+            self.pid = None
@@ -0,0 +1,243 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Config (config.yaml) compiled into an immutable object.
+
+The file is validated against SCHEMA, its data frozen (dicts become read-only
+mappings, lists tuples) and lookup tables used by exports are built once, so
+the config is shared by threads and replaced as a whole (see
+utils.reload_config), never changed in place.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from collections.abc import Mapping
+from hashlib import sha1
+import json
+import logging as log
+from types import MappingProxyType
+
+import yaml
+
+
+log.basicConfig(level=log.DEBUG)
+
+# Schema: a type (or tuple of types) is checked with isinstance, a frozenset
+# lists allowed values, [spec] is a list of items matching spec, {str: spec}
+# a dict of any keys with values matching spec and any other dict a dict with
+# given keys (optional ones end with '?', other keys are allowed).
+NUMBER = (int, float)
+TIMEOUT = [NUMBER]
+TALKGROUP = {'name': str, 'description?': str, 'id': int}
+# numeric (DMR id) or name of group: list of callsigns of the same name
+CONTACT = {'name': str, 'description?': str, 'id': (int, str)}
+QUERY = {'contacts': dict, 'channels?': dict}
+
+SCHEMA = {
+    'contact_store?': frozenset(['dict', 'compact']),
+    'refresh_interval?': NUMBER,
+    'reload_interval?': NUMBER,
+    'upstream?': {
+        'retries?': int,
+        'backoff?': NUMBER,
+        'timeout?': TIMEOUT,
+        'timeouts?': {str: TIMEOUT},
+        'urls?': {str: str},
+    },
+    'snapshot?': (str, type(None)),
+    'result_cache?': {
+        'entries?': int,
+        'megabytes?': NUMBER,
+        'entry_megabytes?': NUMBER,
+    },
+    'x_sendfile?': bool,
+    'stream_exports?': bool,
+    'bulk?': {'processes?': int, 'max_queries?': int},
+    'saved_queries?': {
+        'directory?': str,
+        'keep_days?': NUMBER,
+        'precompute_days?': NUMBER,
+        'max_files?': int,
+    },
+    'radio_profiles?': {str: {'name': str, 'contacts?': int,
+                              'channels?': int}},
+    'delta?': {'versions?': int, 'max_changes?': NUMBER},
+    'profiling?': {
+        'token?': (str, type(None)),
+        'sample_rate?': NUMBER,
+        'directory?': str,
+        'keep?': int,
+    },
+    'supported_bands': [str],
+    'supported_modes': [[str]],
+    'sp_prefixy': [str],
+    'sp_talk_groups': {'name': str, 'description?': str,
+                       'items': [TALKGROUP]},
+    'presets_dir?': str,
+    'presets?': [{'name': str, 'description?': str, 'query': QUERY}],
+    'additional_talkgroups': [TALKGROUP],
+    'additional_contacts': [CONTACT],
+    'sp5kab?': [str],
+    'gov_services': [{'name': str, 'freqs': [NUMBER]}],
+    'pmr': [NUMBER],
+    'pmr-digi': [NUMBER],
+}
+
+
+class ConfigError(ValueError):
+    """Config does not match SCHEMA."""
+
+
+def _type_names(types):
+    if isinstance(types, type):
+        return types.__name__
+    return ' or '.join(kind.__name__ for kind in types)
+
+
+def check(value, spec, path='config'):
+    """Raise ConfigError if value does not match spec (see SCHEMA)."""
+    if isinstance(spec, (type, tuple)):
+        if not isinstance(value, spec):
+            raise ConfigError('{}: {} expected, got {!r}'.format(
+                path, _type_names(spec), value))
+    elif isinstance(spec, frozenset):
+        if value not in spec:
+            raise ConfigError('{}: one of {} expected, got {!r}'.format(
+                path, ', '.join(sorted(spec)), value))
+    elif isinstance(spec, list):
+        check(value, list, path)
+        for pos, item in enumerate(value):
+            check(item, spec[0], '{}[{}]'.format(path, pos))
+    elif list(spec) == [str]:
+        check(value, dict, path)
+        for key, item in value.items():
+            check(key, str, '{} key'.format(path))
+            check(item, spec[str], '{}.{}'.format(path, key))
+    else:
+        check(value, dict, path)
+        for key, item_spec in spec.items():
+            name = key.rstrip('?')
+            if name in value:
+                check(value[name], item_spec, '{}.{}'.format(path, name))
+            elif not key.endswith('?'):
+                raise ConfigError('{}: {} missing'.format(path, name))
+
+
+def freeze(value):
+    """Read-only copy of (loaded from YAML) value."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item)
+                                 for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def compile_config(raw):
+    """Config of raw (loaded from YAML) data, raise ConfigError if it is
+    wrong."""
+    if not raw:
+        raise ConfigError('config is empty')
+    check(raw, SCHEMA)
+    for pos, pair in enumerate(raw['supported_modes']):
+        if len(pair) != 2:
+            raise ConfigError('config.supported_modes[{}]: [mode, name] '
+                              'expected, got {!r}'.format(pos, pair))
+    for contact in raw['additional_contacts']:
+        group = str(contact['id'])
+        if not group.isnumeric() and group in raw:
+            check(raw.get(group), [str], 'config.{}'.format(group))
+    for name in set(raw) - {key.rstrip('?') for key in SCHEMA}:
+        log.warning('Unknown config option %s', name)
+    return Config(raw)
+
+
+def load(path):
+    """Config of YAML file, raise ConfigError if it is wrong (and IOError if
+    it cannot be read)."""
+    with open(path) as cfg_file:
+        try:
+            raw = yaml.safe_load(cfg_file)
+        except yaml.YAMLError as error:
+            raise ConfigError(str(error))
+    return compile_config(raw)
+
+
+class Config(Mapping):
+    """Immutable config: a read-only mapping of its options, plus lookup
+    tables built from them.
+
+    version changes whenever any option does (formatting and comments of
+    the file do not count)."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._options = freeze(raw)
+        self.version = sha1(json.dumps(
+            raw, sort_keys=True, default=str
+        ).encode()).hexdigest()[:10]
+
+        options = self._options
+        # [mode, name] pairs -> {mode: name}
+        self._options = MappingProxyType(dict(
+            options,
+            supported_modes=MappingProxyType(
+                dict(options.get('supported_modes', ()))
+            )
+        ))
+        # lower case bands
+        self.supported_bands = frozenset(
+            band.lower() for band in options.get('supported_bands', ())
+        )
+        # TG id -> name, talk groups of areas first
+        talkgroups = {}
+        for group in options.get('sp_talk_groups', {}).get('items', ()) + \
+                options.get('additional_talkgroups', ()):
+            talkgroups.setdefault(group['id'], group['name'])
+        self.talkgroups = MappingProxyType(talkgroups)
+        # additional contacts: DMR id (str) -> (id, name) of numeric ones,
+        # name -> members sorted by callsign[2:] of groups
+        numeric, groups = {}, {}
+        for contact in options.get('additional_contacts', ()):
+            contact_id = str(contact['id'])
+            if contact_id.isnumeric():
+                numeric.setdefault(contact_id,
+                                   (contact['id'], contact['name']))
+            elif isinstance(options.get(contact_id), tuple):
+                groups[contact_id.lower()] = tuple(sorted(
+                    options[contact_id], key=lambda sign: sign[2:]
+                ))
+        self.numeric_contacts = MappingProxyType(numeric)
+        self.groups = MappingProxyType(groups)
+        self.radio_profiles = options.get('radio_profiles',
+                                          MappingProxyType({}))
+
+    def __getitem__(self, name):
+        return self._options[name]
+
+    def __iter__(self):
+        return iter(self._options)
+
+    def __len__(self):
+        return len(self._options)
+
+    def replace(self, **options):
+        """Config with given options changed."""
+        return compile_config(dict(self._raw, **options))
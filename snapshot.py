@@ -0,0 +1,126 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+On-disk snapshot of parsed upstream data, for fast (and offline) start.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from array import array
+import logging as log
+import os
+import sys
+
+import msgpack
+
+from channels import ChannelsFactory
+from contacts import ContactsFactory
+from przemienniki import PrzemiennikiWrapper
+from store import STORES
+import utils
+
+
+log.basicConfig(level=log.DEBUG)
+
+FORMAT_VERSION = 3
+# compact store arrays are dumped as raw machine bytes
+PLATFORM = [sys.byteorder, array('I').itemsize, array('H').itemsize]
+
+
+def save(path, fetcher):
+    """Write current data (and fetcher state) to snapshot file."""
+    store = utils.CONTACTS.records
+    store_name = [name for name, cls in STORES.items()
+                  if isinstance(store, cls)][0]
+    data = {
+        'version': FORMAT_VERSION,
+        'platform': PLATFORM,
+        'last_data_update': utils.LAST_DATA_UPDATE,
+        'contacts': {'store': store_name, 'data': store.to_snapshot()},
+        'repeaters': [list(rep) for rep in utils.REPS.repeaters],
+        'kab': utils.KAB or [],
+        'validators': fetcher.validators,
+        'digests': fetcher.digests,
+    }
+
+    # own file of process, as processes (workers) may save at the same time
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as snap_file:
+            snap_file.write(msgpack.packb(data, use_bin_type=True))
+        os.replace(tmp_path, path)
+    except (IOError, OSError) as error:
+        log.error('Cannot write snapshot %s: %s', path, error)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    log.debug('Snapshot saved to %s', path)
+    return True
+
+
+def load(path, fetcher):
+    """Load data (and fetcher state) from snapshot file, return True if
+    succeeded."""
+    try:
+        with open(path, 'rb') as snap_file:
+            data = msgpack.unpackb(snap_file.read(), raw=False)
+    except FileNotFoundError:
+        log.info('No snapshot at %s', path)
+        return False
+    except (IOError, OSError, ValueError,
+            msgpack.exceptions.UnpackException) as error:
+        log.error('Cannot read snapshot %s: %s', path, error)
+        return False
+
+    if not isinstance(data, dict) or \
+            data.get('version') != FORMAT_VERSION or \
+            data.get('platform') != PLATFORM:
+        log.warning('Snapshot %s is outdated or incompatible', path)
+        return False
+
+    try:
+        store = STORES[data['contacts']['store']].from_snapshot(
+            data['contacts']['data']
+        )
+        wanted = STORES.get(utils.CONFIG.get('contact_store'), type(store))
+        if not isinstance(store, wanted):
+            store = wanted(map(store.__getitem__, store))
+        repeaters = PrzemiennikiWrapper(repeaters=[
+            PrzemiennikiWrapper.REP(*rep) for rep in data['repeaters']
+        ])
+        ChannelsFactory.prerender(repeaters)
+    except (KeyError, TypeError, ValueError) as error:
+        log.error('Broken snapshot %s: %s', path, error)
+        return False
+
+    utils.CONTACTS = ContactsFactory(store=store)
+    utils.REPS = repeaters
+    if data['kab']:
+        utils.KAB = data['kab']
+    utils.LAST_DATA_UPDATE = data['last_data_update']
+    fetcher.validators = {
+        url: tuple(validators)
+        for url, validators in data['validators'].items()
+    }
+    fetcher.digests = dict(data['digests'])
+    utils.DATA_VERSION = fetcher.version()
+    return True
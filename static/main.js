@@ -93,6 +93,35 @@ if (typeof(Storage) !== "undefined") {
     }
 }
 
+// Suggestions of callsigns for the last one typed into the list
+function suggest(input) {
+    var datalist = document.getElementById(input.id + "_suggestions");
+    var head = input.value.replace(/[^,.;| ]*$/, "");
+    var typed = input.value.slice(head.length);
+    if (typed.length < 2) {
+        datalist.innerHTML = "";
+        return;
+    }
+    var request = new XMLHttpRequest();
+    request.open("GET", "/suggest?q=" + encodeURIComponent(typed));
+    request.onload = function() {
+        if (request.status !== 200 || input.value !== head + typed) {
+            return;
+        }
+        datalist.innerHTML = "";
+        JSON.parse(request.responseText).suggestions.forEach(function(found) {
+            var option = document.createElement("option");
+            option.value = head + (/^[0-9]+$/.test(typed) ? found.dmrid : found.callsign);
+            option.label = found.callsign + " " + found.dmrid + " " + found.name;
+            datalist.appendChild(option);
+        });
+    };
+    request.send();
+}
+[priocals, ignocals].forEach(function(input) {
+    input.addEventListener("input", function() { suggest(input); });
+});
+
 
 //Generate!
 var send = document.getElementById("submit");
@@ -135,6 +164,21 @@ send.addEventListener("click", function(){
         services[service_name] = service_checkboxes.filter(cb=>cb.getAttribute('service')===service_name && cb.checked).map(cb=>cb.value);
     });
 
+    var near_locator = document.getElementById('near_locator').value.trim();
+    if (near_locator) {
+        payload.channels.repeaters.near = {
+            locator: near_locator,
+            radius: parseFloat(document.getElementById('near_radius').value) || 0,
+            count: parseInt(document.getElementById('near_count').value) || 0
+        };
+    }
+
+    var radio = document.getElementById('radio');
+    if (radio && radio.value) {
+        payload.contacts.radio = radio.value;
+        payload.channels.radio = radio.value;
+    }
+
     payload.channels.services = services;
     payload.channels.apmr = Array.from(document.getElementsByClassName('apmr_checkbox')).filter(cb=>cb.checked).map(cb=>cb.value);
     payload.channels.dpmr = Array.from(document.getElementsByClassName('dpmr_checkbox')).filter(cb=>cb.checked).map(cb=>cb.value);
@@ -154,5 +198,20 @@ send.addEventListener("click", function(){
             sel_toggle(error_modal, "is-active");
         }
     }
-    window.open("/csv/" + msgpack.encode(payload).toString('hex'));
+    // save the query on the server, long queries make too long URLs
+    var encoded = msgpack.encode(payload);
+    var request = new XMLHttpRequest();
+    request.open("POST", "/q");
+    request.setRequestHeader("Content-Type", "application/x-msgpack");
+    request.onload = function() {
+        if (request.status === 201) {
+            window.location.href = JSON.parse(request.responseText).url;
+        } else {
+            window.open("/csv/" + encoded.toString('hex'));
+        }
+    };
+    request.onerror = function() {
+        window.open("/csv/" + encoded.toString('hex'));
+    };
+    request.send(encoded);
 });
\ No newline at end of file
@@ -0,0 +1,417 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Storage engines for the ham-digital contact list.
+
+Both stores expose the same lookup API: mapping access by DMR id (as str),
+lookup by callsign, by prefix of callsign or DMR id (for suggestions) and
+selection by prefix+area key (e.g. "SP5"). Given the same records, with
+canonical DMR ids (see canonical_dmrid), they give the same results.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from heapq import merge
+import logging as log
+
+
+log.basicConfig(level=log.DEBUG)
+
+ContactRecord = namedtuple(
+    "ContactRecord",
+    "num,callsign,dmrid,name,country,ctry"
+)
+
+
+def canonical_dmrid(dmrid: str):
+    """DMR id (str) without leading zeros, None if it is not a number (or
+    does not fit into 32 bits)."""
+    if not dmrid or not all('0' <= char <= '9' for char in dmrid):
+        return None
+    number = int(dmrid)
+    return str(number) if number < 2**32 else None
+
+
+def contact_row(record):
+    """Line of GD-77 contacts CSV for record, without the leading Number
+    column, utf-8 encoded."""
+    return "{name},{dmrid:0>8},{type},On,1\r\n".format(
+        name=' '.join([record.callsign, record.name]).strip(),
+        dmrid=record.dmrid,
+        type="Group All" if len(record.dmrid) <= 5 else "Private Call"
+    ).encode()
+
+
+class DictContactStore:
+    """Plain dict of ContactRecord namedtuples, indexed by callsign and by
+    prefix+area."""
+
+    def __init__(self, records):
+        self.records = {}
+        for record in records:
+            self.records[record.dmrid] = record
+        self.rows = {
+            dmrid: contact_row(record)
+            for dmrid, record in self.records.items()
+        }
+
+        self.callsigns = {}
+        areas = defaultdict(list)
+        for pos, (rec_id, record) in enumerate(self.records.items()):
+            self.callsigns.setdefault(record.callsign, record)
+            areas[record.callsign[0:3]].append(
+                (record.callsign[2:], pos, rec_id)
+            )
+        # sorted (callsign[2:], position) so buckets can be merged without
+        # re-sorting and ties keep the order of the original list
+        self.areas = {key: sorted(bucket) for key, bucket in areas.items()}
+        # for lookup by prefix, built on first use
+        self._calls_sorted = None
+        self._ids_sorted = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __contains__(self, dmrid):
+        return dmrid in self.records
+
+    def __getitem__(self, dmrid):
+        return self.records[dmrid]
+
+    def get(self, dmrid, default=None):
+        """Get record by DMR id."""
+        return self.records.get(dmrid, default)
+
+    def by_callsign(self, callsign):
+        """Get (first) record with given callsign."""
+        return self.callsigns.get(callsign, None)
+
+    def by_callsign_prefix(self, prefix):
+        """Records with callsign starting with prefix, ordered by
+        callsign."""
+        if self._calls_sorted is None:
+            self._calls_sorted = sorted(
+                (record.callsign, pos, rec_id)
+                for pos, (rec_id, record) in enumerate(self.records.items())
+            )
+        pos = bisect_left(self._calls_sorted, (prefix,))
+        while pos < len(self._calls_sorted) and \
+                self._calls_sorted[pos][0].startswith(prefix):
+            yield self.records[self._calls_sorted[pos][2]]
+            pos += 1
+
+    def by_id_prefix(self, prefix):
+        """Records with DMR id starting with prefix, ordered by DMR id."""
+        if self._ids_sorted is None:
+            self._ids_sorted = sorted(
+                (len(rec_id), rec_id) for rec_id in self.records
+            )
+        longest = self._ids_sorted[-1][0] if self._ids_sorted else 0
+        for length in range(len(prefix), longest + 1):
+            pos = bisect_left(self._ids_sorted, (length, prefix))
+            while pos < len(self._ids_sorted) and \
+                    self._ids_sorted[pos][0] == length and \
+                    self._ids_sorted[pos][1].startswith(prefix):
+                yield self.records[self._ids_sorted[pos][1]]
+                pos += 1
+
+    def row(self, dmrid):
+        """Pre-rendered CSV row (see contact_row) of record."""
+        return self.rows[dmrid]
+
+    def sieve(self, keys):
+        """(DMR id, callsign, row) of records with callsign[0:3] in keys,
+        sorted by callsign[2:]."""
+        buckets = [self.areas[key] for key in set(keys) if key in self.areas]
+        for _, _, rec_id in merge(*buckets):
+            yield rec_id, self.records[rec_id].callsign, self.rows[rec_id]
+
+    def iter_rows(self):
+        """(DMR id, row) of all records, ordered by (length, DMR id), which
+        is numeric order for numeric ids."""
+        for rec_id in sorted(self.rows, key=lambda dmrid: (len(dmrid), dmrid)):
+            yield rec_id, self.rows[rec_id]
+
+    def to_snapshot(self):
+        """Plain (msgpack friendly) representation of the store."""
+        return {'rows': [list(record) for record in self.records.values()]}
+
+    @classmethod
+    def from_snapshot(cls, data):
+        """Recreate store from to_snapshot() representation."""
+        return cls(ContactRecord(*row) for row in data['rows'])
+
+
+class CompactContactStore:
+    """Column oriented, array backed contact store.
+
+    DMR ids are kept as integers, num/callsign/name are packed into a single
+    utf-8 buffer addressed by offsets and the country fields are interned.
+    Records are materialized as ContactRecord on access only. Pre-rendered
+    CSV rows are packed the same way."""
+
+    SEP = '\x1f'
+    SAMPLE = 64
+    ARRAYS = ['_ids', '_country', '_offsets', '_row_offsets', '_sorted_ids',
+              '_sorted_id_rows', '_calls_sorted', '_by_rank']
+
+    def __init__(self, records):
+        rows = {}  # dmrid -> row, only while building
+        fields = []
+        countries = {}
+
+        self._ids = array('I')
+        self._country = array('H')
+        self._countries = []
+
+        for record in records:
+            if canonical_dmrid(record.dmrid) != record.dmrid:
+                # ContactsFactory gives canonical ones only
+                log.warning('Skipping contact with odd DMR id: %s', record)
+                continue
+            ctry = (record.country, record.ctry)
+            if ctry not in countries:
+                countries[ctry] = len(self._countries)
+                self._countries.append(ctry)
+            packed = self.SEP.join([record.num, record.callsign, record.name])
+
+            row = rows.get(record.dmrid)
+            if row is None:
+                rows[record.dmrid] = len(self._ids)
+                self._ids.append(int(record.dmrid))
+                self._country.append(countries[ctry])
+                fields.append(packed)
+            else:  # same DMR id again, the later record wins
+                self._country[row] = countries[ctry]
+                fields[row] = packed
+        del rows
+
+        encoded = [field.encode() for field in fields]
+        del fields
+        self._offsets = array('I', [0])
+        for field in encoded:
+            self._offsets.append(self._offsets[-1] + len(field))
+        self._buf = b''.join(encoded)
+
+        rendered = [
+            contact_row(self._record(row)) for row in range(len(self._ids))
+        ]
+        self._row_offsets = array('I', [0])
+        for row in rendered:
+            self._row_offsets.append(self._row_offsets[-1] + len(row))
+        self._rows = b''.join(rendered)
+        del rendered
+
+        calls = [field.split(b'\x1f', 2)[1].decode() for field in encoded]
+        del encoded
+
+        # lookup by DMR id: ids sorted along with their rows
+        by_id = sorted(range(len(self._ids)), key=self._ids.__getitem__)
+        self._sorted_ids = array('I', map(self._ids.__getitem__, by_id))
+        self._sorted_id_rows = array('I', by_id)
+
+        # lookup by callsign: rows sorted by (callsign, row)
+        self._calls_sorted = array(
+            'I', sorted(range(len(calls)), key=lambda r: (calls[r], r))
+        )
+
+        # selection: global rank by (callsign[2:], row) and per prefix+area
+        # buckets of ranks, ready to be merged
+        by_rank = sorted(range(len(calls)), key=lambda r: (calls[r][2:], r))
+        self._by_rank = array('I', by_rank)
+        areas = defaultdict(lambda: array('I'))
+        for rank, row in enumerate(by_rank):
+            areas[calls[row][0:3]].append(rank)
+        self._areas = dict(areas)
+        self._sample_calls()
+
+    def _sample_calls(self):
+        """Keep every SAMPLE-th of sorted callsigns decoded, so search by
+        callsign is mostly done by bisect (see _calls_from)."""
+        self._call_samples = [
+            self._callsign(row) for row in self._calls_sorted[::self.SAMPLE]
+        ]
+
+    def _fields(self, row):
+        return self._buf[self._offsets[row]:self._offsets[row + 1]] \
+            .decode().split(self.SEP)
+
+    def _callsign(self, row):
+        return self._fields(row)[1]
+
+    def _record(self, row):
+        num, callsign, name = self._fields(row)
+        country, ctry = self._countries[self._country[row]]
+        return ContactRecord(
+            num=num,
+            callsign=callsign,
+            dmrid=str(self._ids[row]),
+            name=name,
+            country=country,
+            ctry=ctry
+        )
+
+    def _row_by_id(self, dmrid):
+        if canonical_dmrid(dmrid) != dmrid:  # as DictContactStore
+            return None
+        dmrid = int(dmrid)
+        pos = bisect_left(self._sorted_ids, dmrid)
+        if pos < len(self._sorted_ids) and self._sorted_ids[pos] == dmrid:
+            return self._sorted_id_rows[pos]
+        return None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return map(str, self._ids)
+
+    def __contains__(self, dmrid):
+        return self._row_by_id(dmrid) is not None
+
+    def __getitem__(self, dmrid):
+        row = self._row_by_id(dmrid)
+        if row is None:
+            raise KeyError(dmrid)
+        return self._record(row)
+
+    def get(self, dmrid, default=None):
+        """Get record by DMR id."""
+        row = self._row_by_id(dmrid)
+        return default if row is None else self._record(row)
+
+    def _calls_from(self, callsign):
+        """Position (in _calls_sorted) of the first callsign not less than
+        given one."""
+        # the first SAMPLE-th callsign not less than given one is found by
+        # bisect, the rest is searched among the ones before it, compared as
+        # utf-8 bytes (ordered as str) without decoding rows
+        sample = bisect_left(self._call_samples, callsign)
+        key = callsign.encode()
+        sep = self.SEP.encode()
+        buf, offsets, calls = self._buf, self._offsets, self._calls_sorted
+        low = max(0, (sample - 1) * self.SAMPLE)
+        high = min(len(calls), sample * self.SAMPLE)
+        while low < high:
+            mid = (low + high) // 2
+            row = calls[mid]
+            if buf[offsets[row]:offsets[row + 1]].split(sep, 2)[1] < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def by_callsign(self, callsign):
+        """Get (first) record with given callsign."""
+        pos = self._calls_from(callsign)
+        if pos < len(self._calls_sorted):
+            row = self._calls_sorted[pos]
+            if self._callsign(row) == callsign:
+                return self._record(row)
+        return None
+
+    def by_callsign_prefix(self, prefix):
+        """Records with callsign starting with prefix, ordered by
+        callsign."""
+        for pos in range(self._calls_from(prefix), len(self._calls_sorted)):
+            row = self._calls_sorted[pos]
+            if not self._callsign(row).startswith(prefix):
+                return
+            yield self._record(row)
+
+    def by_id_prefix(self, prefix):
+        """Records with DMR id starting with prefix, ordered by DMR id."""
+        if not prefix.isdigit() or prefix.startswith('0') or \
+                not self._sorted_ids:
+            return
+        scale = 1
+        while int(prefix) * scale <= self._sorted_ids[-1]:
+            high = (int(prefix) + 1) * scale
+            pos = bisect_left(self._sorted_ids, int(prefix) * scale)
+            while pos < len(self._sorted_ids) and \
+                    self._sorted_ids[pos] < high:
+                yield self._record(self._sorted_id_rows[pos])
+                pos += 1
+            scale *= 10
+
+    def _row(self, row):
+        return self._rows[self._row_offsets[row]:self._row_offsets[row + 1]]
+
+    def row(self, dmrid):
+        """Pre-rendered CSV row (see contact_row) of record."""
+        row = self._row_by_id(dmrid)
+        if row is None:
+            raise KeyError(dmrid)
+        return self._row(row)
+
+    def sieve(self, keys):
+        """(DMR id, callsign, row) of records with callsign[0:3] in keys,
+        sorted by callsign[2:]."""
+        buckets = [self._areas[key] for key in set(keys) if key in self._areas]
+        for rank in merge(*buckets):
+            row = self._by_rank[rank]
+            yield str(self._ids[row]), self._callsign(row), self._row(row)
+
+    def iter_rows(self):
+        """(DMR id, row) of all records, ordered by DMR id."""
+        for dmrid, row in zip(self._sorted_ids, self._sorted_id_rows):
+            yield str(dmrid), self._row(row)
+
+    def to_snapshot(self):
+        """Plain (msgpack friendly) representation of the store, arrays are
+        dumped as raw machine bytes."""
+        data = {name: getattr(self, name).tobytes() for name in self.ARRAYS}
+        data['_buf'] = self._buf
+        data['_rows'] = self._rows
+        data['_countries'] = self._countries
+        data['_areas'] = {
+            key: ranks.tobytes() for key, ranks in self._areas.items()
+        }
+        return data
+
+    @classmethod
+    def from_snapshot(cls, data):
+        """Recreate store from to_snapshot() representation."""
+        store = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            column = array('H' if name == '_country' else 'I')
+            column.frombytes(data[name])
+            setattr(store, name, column)
+        store._buf = data['_buf']
+        store._rows = data['_rows']
+        store._countries = [tuple(ctry) for ctry in data['_countries']]
+        store._areas = {}
+        for key, ranks in data['_areas'].items():
+            store._areas[key] = array('I')
+            store._areas[key].frombytes(ranks)
+        store._sample_calls()
+        return store
+
+
+STORES = {
+    'dict': DictContactStore,
+    'compact': CompactContactStore,
+}
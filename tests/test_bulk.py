@@ -0,0 +1,149 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Bulk export (bulk.BulkExporter) and zip archives of compressed files
+(utils.iter_deflated_zip).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from datetime import datetime
+import io
+import zipfile
+
+import pytest
+
+from benchmarks.fixtures import synthetic_records, synthetic_repeaters
+from bulk import BulkExporter
+from channels import ChannelsFactory
+from contacts import ContactsFactory
+from przemienniki import PrzemiennikiWrapper
+import settings
+from store import DictContactStore
+import utils
+
+CONFIG = {'supported_bands': ['2m', '70cm'], 'reload_interval': 0}
+
+
+@pytest.fixture(autouse=True)
+def data(monkeypatch):
+    monkeypatch.setattr(utils, 'CONFIG', settings.Config(CONFIG))
+    monkeypatch.setattr(utils, 'CONTACTS', ContactsFactory(
+        store=DictContactStore(synthetic_records(2000))))
+    monkeypatch.setattr(utils, 'REPS', PrzemiennikiWrapper(
+        repeaters=list(synthetic_repeaters(300))))
+    monkeypatch.setattr(utils, 'DATA_VERSION', 'v1')
+
+
+def query(area, prio='', channels=True):
+    return {
+        'contacts': {'adds': [], 'tgs': [], 'prio': prio,
+                     'sp_prefix': ['SP'], 'sp_area': [area]},
+        'channels': {'repeaters': {'bands': ['2m'], 'modes': ['FM'],
+                                   'areas': [area]}} if channels else {},
+    }
+
+
+QUERIES = [
+    ('club/a', query('1')),
+    ('club/b', query('1', prio='SP5ABC')),  # channels of club/a
+    ('club/c', query('2', channels=False)),
+    ('club/a', query('1')),  # the same files as the first one
+]
+
+
+def unzipped(chunks):
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zip_file:
+        assert zip_file.testzip() is None
+        return {name: zip_file.read(name) for name in zip_file.namelist()}
+
+
+def test_iter_deflated_zip():
+    files = [('a.csv', b'a,b\r\n' * 1000), ('zażółć.csv', b''),
+             ('dir/b.csv', b'b' * 10)]
+    stamp = datetime(2018, 5, 1, 12, 30)
+    chunks = list(utils.iter_deflated_zip(
+        [(name, utils.deflate(body)) for name, body in files], stamp))
+    assert unzipped(chunks) == dict(files)
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zip_file:
+        assert zip_file.getinfo('a.csv').date_time == (2018, 5, 1, 12, 30, 0)
+    # the same files make the same archive
+    assert b''.join(chunks) == b''.join(utils.iter_deflated_zip(
+        [(name, utils.deflate(body)) for name, body in files], stamp))
+
+
+def test_plan_shares_files():
+    tasks, folders = BulkExporter.plan(QUERIES)
+    assert [kind for kind, _ in tasks] == ['contacts', 'channels', 'contacts',
+                                           'contacts']
+    assert folders == [('club_a', 0, 1), ('club_b', 2, 1),
+                       ('club_c', 3, None), ('club_a_2', 0, 1)]
+
+
+def test_entries_take_files_as_they_come():
+    tasks, folders = BulkExporter.plan(QUERIES)
+    taken = []
+
+    def files():
+        for pos in range(len(tasks)):
+            taken.append(pos)
+            yield pos
+
+    entries = BulkExporter.entries(folders, files())
+    assert next(entries) == ('club_a/contacts.csv', 0)
+    assert taken == [0]
+    assert list(entries) == [
+        ('club_a/channels.csv', 1), ('club_b/contacts.csv', 2),
+        ('club_b/channels.csv', 1), ('club_c/contacts.csv', 3),
+        ('club_a_2/contacts.csv', 0), ('club_a_2/channels.csv', 1)]
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_bulk_files(processes):
+    bulk = BulkExporter(processes)
+    bulk.start()
+    try:
+        files = unzipped(bulk.iter_zip(QUERIES))
+    finally:
+        bulk.close()
+    assert sorted(files) == sorted([
+        'club_a/contacts.csv', 'club_a/channels.csv', 'club_b/contacts.csv',
+        'club_b/channels.csv', 'club_c/contacts.csv',
+        'club_a_2/contacts.csv', 'club_a_2/channels.csv'])
+    for folder, (_, part) in zip(['club_a', 'club_b', 'club_c'], QUERIES):
+        assert files[folder + '/contacts.csv'] == \
+            b''.join(utils.CONTACTS.iter_csv(part['contacts']))
+    assert files['club_a/channels.csv'] == \
+        b''.join(ChannelsFactory().iter_csv(QUERIES[0][1]['channels']))
+    assert files['club_a/channels.csv'] == files['club_b/channels.csv']
+
+
+def test_stale_pool(monkeypatch):
+    bulk = BulkExporter(2)
+    bulk.start()
+    try:
+        assert bulk.pool is not None
+        monkeypatch.setattr(utils, 'DATA_VERSION', 'v2')
+        # files of the new data are generated by the worker itself
+        monkeypatch.setattr(bulk.pool, 'imap', None)
+        assert unzipped(bulk.iter_zip(QUERIES))
+    finally:
+        bulk.close()
+    assert bulk.pool is None
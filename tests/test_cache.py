@@ -0,0 +1,154 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Cache of generated exports (cache.ResultCache).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+
+from cache import ResultCache, query_key
+
+
+class Generator:
+    """Chunks of a file, counting how many times they were generated."""
+
+    def __init__(self, chunks=(b'a' * 10, b'b' * 10), delay=0.0, fail=False):
+        self.chunks = chunks
+        self.delay = delay
+        self.fail = fail
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.count += 1
+        for chunk in self.chunks:
+            time.sleep(self.delay)
+            if self.fail:
+                raise RuntimeError('generation failed')
+            yield chunk
+
+
+def test_query_key_is_canonical():
+    query = {'contacts': {'sp_area': ['1', '5'], 'prio': 'SP5ABC'},
+             'channels': {'services': {'a': [1], 'b': [2]}}}
+    same = {'channels': {'services': {'a': [1], 'b': [2]}},
+            'contacts': {'prio': 'SP5ABC', 'sp_area': ['5', '1']}}
+    other = {'contacts': {'sp_area': ['1', '5'], 'prio': 'SP5ABC'},
+             'channels': {'services': {'b': [2], 'a': [1]}}}
+    assert query_key(query) == query_key(same)
+    assert query_key(query) != query_key(other)  # order of services matters
+
+
+def test_bounds_and_versions():
+    cache = ResultCache(max_entries=2, max_bytes=25, max_entry_bytes=10)
+    for key in 'abc':
+        cache.put(key, None, (key.encode() * 5, 'text/csv', key))
+    assert cache.lookup('a', 1) is None  # new version
+    cache.put('a', 1, (b'a' * 5, 'text/csv', 'a'))
+    cache.put('b', 1, (b'b' * 11, 'text/csv', 'b'))  # too big
+    cache.put('c', 1, (b'c' * 10, 'text/csv', 'c'))
+    cache.put('d', 1, (b'd' * 10, 'text/csv', 'd'))  # 'a' is the oldest
+    assert [cache.lookup(key, 1) is not None for key in 'abcd'] == \
+        [False, False, True, True]
+    assert cache.lookup('c', 2) is None
+
+
+def test_get_builds_once():
+    cache = ResultCache()
+    generator = Generator(delay=0.05)
+
+    def build():
+        return b''.join(generator()), 'text/csv', 'file'
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: cache.get('k', 1, build), range(8)))
+    assert generator.count == 1
+    assert set(results) == {(b'a' * 10 + b'b' * 10, 'text/csv', 'file')}
+
+
+def test_stream_generates_once():
+    cache = ResultCache()
+    generator = Generator(delay=0.05)
+
+    def stream(_):
+        return b''.join(cache.stream('k', 1, generator(), 'text/csv', 'file'))
+
+    with ThreadPoolExecutor(8) as pool:
+        bodies = list(pool.map(stream, range(8)))
+    assert generator.count == 1
+    assert set(bodies) == {b'a' * 10 + b'b' * 10}
+    assert cache.lookup('k', 1)[0] == bodies[0]
+
+
+def test_stream_does_not_wait_for_slow_client():
+    cache = ResultCache(flight_timeout=5)
+    generator = Generator()
+    leader = cache.stream('k', 1, generator(), 'text/csv', 'file')
+    # the leader did not send anything yet, followers get the whole file
+    start = time.monotonic()
+    follower = cache.stream('k', 1, generator(), 'text/csv', 'file')
+    assert b''.join(follower) == b''.join(leader)
+    assert time.monotonic() - start < 1
+    assert generator.count == 1
+
+
+def test_stream_too_big():
+    cache = ResultCache(max_entry_bytes=15)
+    generator = Generator(delay=0.05)
+
+    def stream(_):
+        return b''.join(cache.stream('k', 1, generator(), 'text/csv', 'file'))
+
+    with ThreadPoolExecutor(4) as pool:
+        bodies = list(pool.map(stream, range(4)))
+    assert set(bodies) == {b'a' * 10 + b'b' * 10}
+    assert generator.count == 4  # each one generated its own
+    assert cache.lookup('k', 1) is None
+
+
+def test_stream_follower_timeout():
+    cache = ResultCache(flight_timeout=0.1)
+    slow = Generator(delay=0.5)
+    fast = Generator()
+    with ThreadPoolExecutor(1) as pool:
+        leader = pool.submit(cache.stream, 'k', 1, slow(), 'text/csv', 'f')
+        time.sleep(0.05)
+        start = time.monotonic()
+        follower = cache.stream('k', 1, fast(), 'text/csv', 'f')
+        assert time.monotonic() - start < 0.4
+        assert b''.join(follower) == b''.join(leader.result())
+    assert (slow.count, fast.count) == (1, 1)
+
+
+def test_stream_error_is_raised_before_sending():
+    cache = ResultCache()
+    with pytest.raises(RuntimeError):
+        cache.stream('k', 1, Generator(fail=True)(), 'text/csv', 'file')
+    # the flight has landed, nothing was cached
+    assert cache.lookup('k', 1) is None
+    body = cache.stream('k', 1, Generator()(), 'text/csv', 'file')
+    assert b''.join(body) == b'a' * 10 + b'b' * 10
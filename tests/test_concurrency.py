@@ -0,0 +1,168 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Hammer one app instance from many threads and check that every generated
+file is right: the same as generated alone, from known (synthetic) data.
+Every request differs (by a priority contact which is not in the data), so
+none is served from cache nor coalesced with another one: threads really
+generate files at the same time.
+
+The app loads data of benchmarks.fixtures from local upstream stubs (see
+benchmarks.load).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import importlib
+import io
+import itertools
+import os
+import sys
+import zipfile
+
+import msgpack
+import pytest
+import yaml
+
+from benchmarks.fixtures import synthetic_records
+from benchmarks.load import Upstream, prepare
+from presets import build
+
+CONTACTS = 5000
+REPEATERS = 500
+MEMBERS = 30
+THREADS = 16
+ROUNDS = 5
+
+
+def queries():
+    """Set of different queries, so concurrent exports differ."""
+    for areas, bands, digi_double in itertools.product(
+            [['1'], ['5', '7'], [str(a) for a in range(10)]],
+            [['2m'], ['2m', '70cm']],
+            [False, True]):
+        yield {
+            'contacts': {
+                'sp_prefix': ['SP', 'SQ', 'SO'],
+                'sp_area': areas,
+                'tgs': ['260', '2605'],
+                'adds': ['260097', 'sp5kab'],
+                'prio': 'SP5ABC SQ5XYZ',
+                'igno': areas[0] == '5' and 'SP5ABC' or ''
+            },
+            'channels': {
+                'repeaters': {
+                    'bands': bands,
+                    'modes': ['FM', 'MOTOTRBO'],
+                    'areas': areas,
+                    'digi_first': not digi_double,
+                    'digi_double': digi_double
+                },
+                'services': {},
+                'apmr': ['446.00625'] if digi_double else [],
+                'dpmr': []
+            }
+        }
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    """The app (main module) with data of fixtures."""
+    directory = str(tmp_path_factory.mktemp('app'))
+    upstream = Upstream(CONTACTS, REPEATERS, MEMBERS).start()
+    prepare(directory, upstream.urls, 0)
+    path = os.path.join(directory, 'config.yaml')
+    with open(path) as cfg_file:
+        config = yaml.safe_load(cfg_file)
+    config['bulk'] = {'processes': 1}  # no pool forked by the test
+    with open(path, 'w') as cfg_file:
+        yaml.safe_dump(config, cfg_file)
+
+    cwd = os.getcwd()
+    os.chdir(directory)  # config.yaml is loaded from there
+    try:
+        sys.modules.pop('main', None)
+        app_module = importlib.import_module('main')
+        yield app_module
+    finally:
+        os.chdir(cwd)
+        sys.modules.pop('main', None)
+        upstream.stop()
+
+
+def unpacked(data, mimetype):
+    """Files of export: [content of zip entries] (their timestamps differ)
+    or [body]."""
+    if mimetype == 'application/zip':
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            return [zip_file.read(name) for name in zip_file.namelist()]
+    return [data]
+
+
+def selected_ids(query):
+    """DMR ids of fixture contacts selected by area and prefix of query."""
+    contacts = query['contacts']
+    ignored = contacts['igno'].split()
+    return {
+        record.dmrid for record in synthetic_records(CONTACTS)
+        if record.callsign[:2] in contacts['sp_prefix'] and
+        record.callsign[2:3] in contacts['sp_area'] and
+        record.callsign not in ignored
+    }
+
+
+def test_data_loaded(app):
+    assert len(app.utils.CONTACTS.records) == CONTACTS
+    assert app.utils.REPS.repeaters
+    assert len(app.utils.KAB) == MEMBERS
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_concurrent_exports(app, monkeypatch, stream):
+    monkeypatch.setattr(app.utils, 'CONFIG',
+                        app.utils.CONFIG.replace(stream_exports=stream))
+    client = app.app.test_client()
+    expected = []
+    for query in queries():
+        # generated alone, the file is right
+        files = unpacked(*build(query, app.channels)[:2])
+        assert len(files) == 2 and all(files)
+        rows = list(csv.reader(io.StringIO(files[0].decode())))
+        assert selected_ids(query) <= {row[2].lstrip('0') for row in rows}
+        assert len(files[1].splitlines()) > 1  # header and channels
+        expected.append((query, files))
+
+    def check(job):
+        num, (query, files) = job
+        query = dict(query, contacts=dict(
+            query['contacts'],
+            prio='{} XX{}'.format(query['contacts']['prio'], num)
+        ))
+        url = '/csv/' + msgpack.packb(query, use_bin_type=True).hex()
+        response = client.get(url)
+        return response.status_code == 200 and \
+            unpacked(response.get_data(), response.mimetype) == files
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        outcome = list(pool.map(check, enumerate(expected * ROUNDS)))
+
+    assert outcome.count(False) == 0
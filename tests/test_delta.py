@@ -0,0 +1,119 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Delta exports: rows changed since a previous data version (history).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import pytest
+
+from benchmarks.fixtures import synthetic_records, synthetic_repeaters
+from channels import ChannelsFactory
+from contacts import ContactsFactory
+from history import DataHistory
+from przemienniki import PrzemiennikiWrapper
+import settings
+from store import DictContactStore
+import utils
+
+CONTACTS = {'adds': [], 'tgs': [], 'prio': '', 'sp_prefix': ['SP', 'SQ'],
+            'sp_area': list('0123456789')}
+CHANNELS = {'repeaters': {'bands': ['2m', '70cm'], 'modes': ['FM'],
+                          'areas': list('0123456789')}}
+
+
+def version(monkeypatch, name, records, repeaters):
+    monkeypatch.setattr(utils, 'DATA_VERSION', name)
+    monkeypatch.setattr(utils, 'CONTACTS', ContactsFactory(
+        store=DictContactStore(records)))
+    monkeypatch.setattr(utils, 'REPS', PrzemiennikiWrapper(
+        repeaters=repeaters))
+
+
+@pytest.fixture
+def data(monkeypatch):
+    """History of two versions: in v2 a contact was removed, one renamed
+    and one added, a repeater was removed and one moved to other
+    frequency."""
+    monkeypatch.setattr(utils, 'CONFIG', settings.Config(
+        {'supported_bands': ['2m', '70cm']}))
+    records = [record for record in synthetic_records(1000)
+               if record.callsign[:2] in CONTACTS['sp_prefix']]
+    repeaters = [rep for rep in synthetic_repeaters(200)
+                 if '2M' in rep.bands and 'FM' in rep.modes]
+    history = DataHistory(max_changes=0.5)
+    version(monkeypatch, 'v1', records, repeaters)
+    history.update()
+
+    renamed = records[1]._replace(name='Renamed')
+    added = records[0]._replace(dmrid='2609999', callsign='SP9NEW')
+    moved = repeaters[1]._replace(freqs=[{'rx': '144.6000'},
+                                         {'tx': '145.2000'}])
+    version(monkeypatch, 'v2', [renamed, added] + records[2:],
+            [moved] + repeaters[2:])
+    history.update()
+    return history, records, repeaters
+
+
+def rows(lines):
+    return [line.decode().rstrip('\r\n').split(',') for line in lines][1:]
+
+
+def test_contacts_delta(data):
+    history, records, _ = data
+    delta = history.delta('v1')
+    assert delta.version == 'v2'
+    changes = {(row[0], row[2].lstrip('0')): row[1] for row in rows(
+        delta.contacts.iter_delta_csv(CONTACTS, delta.contact_changes))}
+    assert changes == {
+        ('removed', records[0].dmrid): '{} {}'.format(records[0].callsign,
+                                                      records[0].name),
+        ('changed', records[1].dmrid): records[1].callsign + ' Renamed',
+        ('added', '2609999'): 'SP9NEW ' + records[0].name,
+    }
+
+
+def test_channels_delta(data):
+    history, _, repeaters = data
+    delta = history.delta('v1')
+    lines = ChannelsFactory().iter_delta_csv(CHANNELS, delta.reps,
+                                             delta.old_reps)
+    changes = [(row[0], row[1]) for row in rows(lines)]
+    assert sorted(changes) == [('changed', repeaters[1].sign),
+                               ('removed', repeaters[0].sign)]
+
+
+def test_no_delta(data):
+    history, _, _ = data
+    delta = history.delta('v2')
+    assert rows(delta.contacts.iter_delta_csv(
+        CONTACTS, delta.contact_changes)) == []
+    assert rows(ChannelsFactory().iter_delta_csv(
+        CHANNELS, delta.reps, delta.old_reps)) == []
+    assert history.delta('v0') is None
+
+
+def test_too_many_changes_drop_history(data, monkeypatch):
+    history, records, repeaters = data
+    version(monkeypatch, 'v3', records[:len(records) // 3], repeaters)
+    history.update()
+    assert history.delta('v1') is None
+    assert history.delta('v3') is not None
@@ -0,0 +1,114 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Selection of repeaters near a point (channels.repeaters.near of queries).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import pytest
+
+from benchmarks.fixtures import synthetic_repeaters
+import geo
+from przemienniki import RepeaterIndex
+import utils
+
+BANDS = ['2M', '70CM', '23CM']
+MODES = ['FM', 'MOTOTRBO', 'FMLINK', 'ECHOLINK']
+
+
+@pytest.fixture(scope='module')
+def index():
+    return RepeaterIndex(list(synthetic_repeaters(500)))
+
+
+def query(near):
+    return {
+        'contacts': {'adds': [], 'tgs': [], 'prio': ''},
+        'channels': {'repeaters': {'bands': ['2m'], 'modes': ['FM'],
+                                   'near': near}},
+    }
+
+
+def scan(index, lat, lon, radius):
+    """Positions of repeaters within radius, by checking every one."""
+    return {pos for pos, rep in enumerate(index.repeaters)
+            if geo.distance(lat, lon, rep.lat, rep.lon) <= radius}
+
+
+def test_locator_to_latlon():
+    lat, lon = geo.locator_to_latlon('KO02md')
+    assert 52.1 < lat < 52.2 and 21.0 < lon < 21.1
+    assert geo.locator_to_latlon('KO2') is None
+    assert geo.locator_to_latlon('ZZ00') is None
+
+
+def test_within_matches_full_scan(index):
+    found = index.grid.within(52.2, 21.0, 100)
+    assert {pos for _, pos in found} == scan(index, 52.2, 21.0, 100)
+    assert [dist for dist, _ in found] == sorted(dist for dist, _ in found)
+
+
+def test_nearest(index):
+    found = index.grid.nearest(52.2, 21.0, 10)
+    assert len(found) == 10
+    radius = found[-1][0]
+    assert {pos for _, pos in found} <= scan(index, 52.2, 21.0, radius)
+    assert len(scan(index, 52.2, 21.0, radius)) == 10
+
+
+@pytest.mark.parametrize('radius', [float('inf'), float('nan'), 1e300])
+def test_radius_out_of_range(index, radius):
+    assert len(index.grid.within(52.2, 21.0, radius)) == len(index.grid)
+    assert len(index.grid.nearest(52.2, 21.0, 5, radius)) == 5
+
+
+def test_near_filters(index):
+    found = index.near({'locator': 'KO02md', 'radius': 80},
+                       index.by_mode['FM'].__contains__)
+    assert found
+    assert all('FM' in index.repeaters[pos].modes for pos in found)
+    assert index.near({'lat': 52.2, 'lon': 21.0, 'count': 7}) == \
+        [pos for _, pos in index.grid.nearest(52.2, 21.0, 7)]
+    assert index.near({'locator': 'XX'}) == []
+
+
+@pytest.mark.parametrize('near', [
+    None,
+    {'locator': 'KO02md', 'radius': 50, 'count': 0},
+    {'lat': 52.2, 'lon': 21, 'radius': 10.5},
+])
+def test_valid_near(near):
+    assert utils.is_valid_query(query(near))
+
+
+@pytest.mark.parametrize('near', [
+    'KO02md',
+    ['KO02md'],
+    {'locator': 1234},
+    {'locator': 'KO02md', 'radius': float('inf')},
+    {'locator': 'KO02md', 'radius': float('nan')},
+    {'locator': 'KO02md', 'radius': '50'},
+    {'locator': 'KO02md', 'count': 10 ** 400},
+    {'lat': float('-inf'), 'lon': 21},
+    {'lat': 52.2, 'lon': True},
+])
+def test_invalid_near(near):
+    assert not utils.is_valid_query(query(near))
@@ -0,0 +1,83 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Profiled exports (profiling): one at a time, the latest ones kept.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import os
+import threading
+
+import pytest
+
+import profiling
+import settings
+import utils
+
+
+@pytest.fixture
+def directory(monkeypatch, tmp_path):
+    monkeypatch.setattr(utils, 'CONFIG', settings.Config(
+        {'profiling': {'directory': str(tmp_path), 'keep': 2}}))
+    return str(tmp_path)
+
+
+def query(num):
+    return {'contacts': {'prio': 'SP1A{}'.format(num)}}
+
+
+def test_profiled(directory):
+    name, result = profiling.run(query(1), lambda: 'body')
+    assert result == 'body'
+    assert sorted(os.listdir(directory)) == [name + '.prof',
+                                             name + '.query']
+
+
+def test_one_profile_at_a_time(directory):
+    started, finish = threading.Event(), threading.Event()
+    names = []
+
+    def slow():
+        started.set()
+        finish.wait(10)
+        return 'slow'
+
+    thread = threading.Thread(
+        target=lambda: names.append(profiling.run(query(1), slow)))
+    thread.start()
+    started.wait(10)
+    try:
+        # not profiled (nor failing) while the other one is
+        assert profiling.run(query(2), lambda: 'fast') == (None, 'fast')
+    finally:
+        finish.set()
+        thread.join()
+    assert names[0][0] and names[0][1] == 'slow'
+    assert profiling.run(query(3), lambda: 'again')[0]
+
+
+def test_rotate(directory):
+    for num in range(4):
+        profiling.run(query(num), lambda: None)
+    profiles = [name for name in os.listdir(directory)
+                if name.endswith('.prof')]
+    assert len(profiles) == 2
+    assert len(os.listdir(directory)) == 4
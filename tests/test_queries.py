@@ -0,0 +1,96 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Saved queries (queries.SavedQueries).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import os
+
+import pytest
+
+from benchmarks.fixtures import synthetic_records
+from contacts import ContactsFactory
+from queries import SavedQueries
+import settings
+from store import DictContactStore
+import utils
+
+
+@pytest.fixture(autouse=True)
+def data(monkeypatch):
+    monkeypatch.setattr(utils, 'CONFIG', settings.Config({}))
+    monkeypatch.setattr(utils, 'CONTACTS', ContactsFactory(
+        store=DictContactStore(synthetic_records(500))))
+    monkeypatch.setattr(utils, 'DATA_VERSION', 'v1')
+
+
+def query(prio):
+    return {'contacts': {'adds': [], 'tgs': [], 'prio': prio,
+                         'sp_prefix': ['SP'], 'sp_area': ['1']}}
+
+
+def saved(directory):
+    return sorted(name[:-len('.query')] for name in os.listdir(directory)
+                  if name.endswith('.query'))
+
+
+def test_save_and_get(tmp_path):
+    queries = SavedQueries(str(tmp_path))
+    qid = queries.save(query('SP1ABC'))
+    assert queries.save(query('SP1ABC')) == qid
+    bundle = queries.get(qid)
+    assert bundle.mimetype == 'text/csv'
+    with open(bundle.path, 'rb') as rendered:
+        assert rendered.read() == \
+            b''.join(utils.CONTACTS.iter_csv(query('SP1ABC')['contacts']))
+    assert queries.get('x' * 12) is None
+
+
+def test_nothing_saved_if_rendering_fails(tmp_path):
+    queries = SavedQueries(str(tmp_path))
+    with pytest.raises(KeyError):
+        queries.save({'contacts': {'prio': ''}})  # no tgs nor adds
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_too_big(tmp_path):
+    queries = SavedQueries(str(tmp_path))
+    with pytest.raises(ValueError):
+        queries.save(query('SP1ABC ' * 10000))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_least_recently_used_make_room(tmp_path):
+    queries = SavedQueries(str(tmp_path), max_files=3)
+    ids = [queries.save(query('SP1A{}'.format(num))) for num in range(3)]
+    for age, qid in enumerate(ids):  # ids[0] is the most recently used
+        stamp = 1000000000 + 100 * (3 - age)
+        os.utime(os.path.join(str(tmp_path), qid + '.query'), (stamp, stamp))
+    newest = queries.save(query('SP1B'))
+    assert saved(str(tmp_path)) == sorted([ids[0], ids[1], newest])
+    # files of the removed query are gone too
+    assert not [name for name in os.listdir(str(tmp_path))
+                if name.startswith(ids[2])]
+    assert queries.get(ids[2]) is None
+    # saving a query again does not remove anything
+    queries.save(query('SP1B'))
+    assert len(saved(str(tmp_path))) == 3
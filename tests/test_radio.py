@@ -0,0 +1,116 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Exports limited to capacity of radios (radio_profiles of config).
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import pytest
+
+from benchmarks.fixtures import synthetic_records, synthetic_repeaters
+from channels import ChannelsFactory
+from contacts import ContactsFactory
+from przemienniki import PrzemiennikiWrapper
+import settings
+from store import DictContactStore
+import utils
+
+CONFIG = {
+    'supported_bands': ['2m', '70cm'],
+    'radio_profiles': {
+        'tiny': {'name': 'Tiny', 'contacts': 20, 'channels': 10},
+        'gd77': {'name': 'GD-77', 'contacts': 10000, 'channels': 1024},
+    },
+}
+
+
+@pytest.fixture(autouse=True)
+def config(monkeypatch):
+    monkeypatch.setattr(utils, 'CONFIG', settings.Config(CONFIG))
+
+
+@pytest.fixture(scope='module')
+def reps():
+    return PrzemiennikiWrapper(repeaters=list(synthetic_repeaters(500)))
+
+
+@pytest.fixture(scope='module')
+def contacts():
+    return ContactsFactory(store=DictContactStore(synthetic_records(2000)))
+
+
+def channels_query(radio):
+    return {
+        'radio': radio,
+        'repeaters': {'bands': ['2m', '70cm'], 'modes': ['FM', 'MOTOTRBO'],
+                      'areas': [str(area) for area in range(10)],
+                      'digi_first': True, 'digi_double': True},
+        'services': {'Police': [148.1, 148.2]},
+        'apmr': [446.00625, 446.01875],
+    }
+
+
+def names(rows):
+    return [row.split(b',', 1)[0].decode() for row in rows]
+
+
+def test_channels_unlimited(reps):
+    rows = ChannelsFactory().select(channels_query(None), reps)
+    assert len(rows) > 10
+    assert names(rows)[-4:] == ['Police 1', 'Police 2', 'PMR 1', 'PMR 2']
+
+
+@pytest.mark.parametrize('radio', ['tiny', 'gd77'])
+def test_channels_keep_room_for_services(reps, radio):
+    everything = ChannelsFactory().select(channels_query(None), reps)
+    rows = ChannelsFactory().select(channels_query(radio), reps)
+    limit = CONFIG['radio_profiles'][radio]['channels']
+    assert len(rows) == min(limit, len(everything))
+    # repeaters are cut, services and PMR channels are all there
+    assert names(rows)[-4:] == ['Police 1', 'Police 2', 'PMR 1', 'PMR 2']
+    assert rows[:-4] == everything[:len(rows) - 4]
+
+
+def test_channels_too_many_services(reps):
+    query = dict(channels_query('tiny'),
+                 services={'Police': [148.0 + i / 100 for i in range(12)]})
+    rows = ChannelsFactory().select(query, reps)
+    assert names(rows) == ['Police {}'.format(i + 1) for i in range(10)]
+
+
+def test_contacts_limited_in_order_of_priority(contacts):
+    last = list(synthetic_records(2000))[-1]
+    query = {'adds': [], 'tgs': [], 'prio': last.callsign, 'radio': None,
+             'sp_prefix': ['SP', 'SQ', 'SO'], 'sp_area': list('0123456789')}
+    everything = list(contacts.select(query))
+    assert len(everything) > 20
+    assert everything[0] == contacts.records.by_callsign(last.callsign).dmrid
+    assert list(contacts.select(dict(query, radio='tiny'))) == \
+        everything[:20]
+
+
+@pytest.mark.parametrize('part', ['contacts', 'channels'])
+@pytest.mark.parametrize('radio', [['gd77'], {'gd77': 1}, 77])
+def test_wrong_radio_is_invalid(part, radio):
+    query = {'contacts': {'adds': [], 'tgs': [], 'prio': ''}, 'channels': {}}
+    assert utils.is_valid_query(query)
+    query[part]['radio'] = radio
+    assert not utils.is_valid_query(query)
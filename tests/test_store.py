@@ -0,0 +1,123 @@
+#
+# Copyright 2017-2018 by Satanowski
+#
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Contact stores: the compact one gives the same results as the dict one.
+
+Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
+License: GNU AGPLv3
+"""
+
+import pytest
+
+from benchmarks.fixtures import contacts_csv
+from contacts import ContactsFactory
+import settings
+from store import CompactContactStore, DictContactStore, canonical_dmrid
+import utils
+
+# odd lines of upstream list: DMR ids with leading zeros, not numbers, too
+# big, the same id twice and a short (talk group like) id
+ODD = [
+    '9001;SP1ZERO;02600007;Zenon;Poland;PL;',
+    '9002;SP1ABC;abc;Adam;Poland;PL;',
+    '9003;SP1BIG;99999999999;Bob;Poland;PL;',
+    '9004;SP1TWICE;2600100;Tom;Poland;PL;',
+    '9005;SP1SHORT;2601;Sam;Poland;PL;',
+    '9006;SP1DIGIT;²;Dan;Poland;PL;',
+]
+QUERY = {'adds': [], 'tgs': [], 'prio': '02600100 SP1SHORT 2600200',
+         'igno': 'SP1ZERO', 'sp_prefix': ['SP', 'SQ'],
+         'sp_area': list('0123456789')}
+
+
+@pytest.fixture(scope='module')
+def factories():
+    text = contacts_csv(3000) + '\r\n'.join(ODD) + '\r\n'
+    loaded = {}
+    config = utils.CONFIG
+    try:
+        for name in ('dict', 'compact'):
+            utils.CONFIG = settings.Config({'contact_store': name})
+            loaded[name] = ContactsFactory(text)
+    finally:
+        utils.CONFIG = config
+    assert isinstance(loaded['dict'].records, DictContactStore)
+    assert isinstance(loaded['compact'].records, CompactContactStore)
+    return loaded['dict'], loaded['compact']
+
+
+def test_canonical_dmrid():
+    assert canonical_dmrid('2600001') == '2600001'
+    assert canonical_dmrid('0002601') == '2601'
+    assert canonical_dmrid('0') == '0'
+    for wrong in ['', 'abc', '26x', '-1', '²', '4294967296']:
+        assert canonical_dmrid(wrong) is None
+
+
+def test_odd_ids(factories):
+    for factory in factories:
+        records = factory.records
+        assert records.get('2600007').callsign == 'SP1ZERO'
+        assert records.get('02600007') is None
+        assert records.get('2600100').callsign == 'SP1TWICE'
+        assert records.get('2601').callsign == 'SP1SHORT'
+        assert records.by_callsign('SP1ABC') is None
+        assert records.by_callsign('SP1BIG') is None
+        assert records.by_callsign('SP1DIGIT') is None
+        assert '²' not in records
+
+
+def test_same_lookups(factories):
+    plain, compact = factories
+    assert len(plain.records) == len(compact.records) == 3001  # 2 ids of ODD taken
+    assert sorted(plain.records) == sorted(compact.records)
+    for dmrid in plain.records:
+        assert plain.records[dmrid] == compact.records[dmrid]
+        assert plain.records.row(dmrid) == compact.records.row(dmrid)
+    for callsign in ['SP1TWICE', 'SP5', 'SQ', 'XX']:
+        assert plain.records.by_callsign(callsign) == \
+            compact.records.by_callsign(callsign)
+        assert list(plain.records.by_callsign_prefix(callsign)) == \
+            list(compact.records.by_callsign_prefix(callsign))
+    for prefix in ['26', '2600', '2601', '9']:
+        assert list(plain.records.by_id_prefix(prefix)) == \
+            list(compact.records.by_id_prefix(prefix))
+    keys = ['SP1', 'SP5', 'SQ9', 'DL0']
+    assert list(plain.records.sieve(keys)) == \
+        list(compact.records.sieve(keys))
+    assert list(plain.records.iter_rows()) == \
+        list(compact.records.iter_rows())
+
+
+def test_same_files(factories):
+    plain, compact = factories
+    csv = b''.join(plain.iter_csv(QUERY))
+    assert csv == b''.join(compact.iter_csv(QUERY))
+    rows = csv.decode().splitlines()[1:]
+    assert rows[0].split(',')[1:3] == ['SP1TWICE Tom', '02600100']
+    assert rows[1].split(',')[1:3] == ['SP1SHORT Sam', '00002601']
+    assert not [row for row in rows if 'SP1ZERO' in row]
+
+
+@pytest.mark.parametrize('kind', [DictContactStore, CompactContactStore])
+def test_snapshot(factories, kind):
+    store = factories[0 if kind is DictContactStore else 1].records
+    copy = kind.from_snapshot(store.to_snapshot())
+    assert list(copy.iter_rows()) == list(store.iter_rows())
+    assert copy.by_callsign('SP1ZERO') == store.by_callsign('SP1ZERO')
@@ -23,44 +23,185 @@ Copyright (C) 2017-2018 Satanowski <satanowski@gmail.com>
 License: GNU AGPLv3
 """
 
+from collections import namedtuple
+from datetime import datetime
 from pathlib import Path
+import itertools
 import logging as log
+import math
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+import zipfile
+import zlib
 
-import yaml
-
-from kab import KAB
-from przemienniki import PrzemiennikiWrapper
+import settings
 
 
 log.basicConfig(level=log.DEBUG)
 
-CONFIG = {}
-REPS = PrzemiennikiWrapper()
+CONFIG = settings.Config({})  # swapped as a whole by reload_config
+KAB = None  # members of SP5KAB set by DataRefresher (config ones until then)
+REPS = None  # PrzemiennikiWrapper, set (and swapped) by DataRefresher
+CONTACTS = None  # ContactsFactory, set (and swapped) by DataRefresher
+LAST_DATA_UPDATE = None
+DATA_VERSION = None  # changes whenever any upstream data changes
+
+
+def timestamp():
+    """Current UTC time as shown on the main page."""
+    now = datetime.utcnow()
+    return "{d} {h:02d}:{m:02d}".format(
+        d=now.date().isoformat(),
+        h=now.time().hour,
+        m=now.time().minute
+    )
+
+def parse_timestamp(stamp):
+    """datetime (UTC) of timestamp() string, None if it is not one."""
+    try:
+        return datetime.strptime(stamp, '%Y-%m-%d %H:%M')
+    except (TypeError, ValueError):
+        return None
+
+def radio_limit(query_part: dict, kind: str):
+    """Capacity (of kind: 'contacts' or 'channels') of radio profile named
+    by 'radio' of query part, None if there is no limit."""
+    profile = CONFIG.radio_profiles.get(query_part.get('radio'))
+    return profile.get(kind) if profile else None
+
+
+def output_version():
+    """Version of generated files: changes with data and config."""
+    return '{}.{}'.format(DATA_VERSION, CONFIG.version)
+
+
+_CONFIG_STAMP = None  # (mtime, size) of loaded config file
+_CONFIG_CHECKED = 0.0  # time.monotonic() of the last check
+_CONFIG_LOCK = threading.Lock()
+
+
+def _config_stamp(path):
+    stat = os.stat(str(path))
+    return stat.st_mtime_ns, stat.st_size
+
 
 def load_config():
     """Load config file."""
-    global CONFIG
+    global CONFIG, _CONFIG_STAMP
 
     path = Path.cwd() / "config.yaml"
     if not path.exists():
         log.error('No config file! Exiting!')
         sys.exit(1)
     try:
-        with open(path) as cfg_file:
-            config = yaml.load(cfg_file)
-            log.debug('Config loaded')
+        stamp = _config_stamp(path)
+        config = settings.load(path)
+        log.debug('Config loaded')
     except IOError:
         log.error('Cannot read config file! Exiting!')
         sys.exit(1)
-    if not config:
-        log.error('Empty config! Exiting!')
+    except settings.ConfigError as error:
+        log.error('Wrong config (%s)! Exiting!', error)
         sys.exit(1)
 
     CONFIG = config
-    CONFIG['sp5kab'] = KAB.retrieve_members() or config.get('sp5kab', [])
-    CONFIG['supported_modes'] = {
-        a:b for a,b in config.get('supported_modes', [])
-    }
+    _CONFIG_STAMP = stamp
+
+
+def reload_config():
+    """Load config file again if it was modified since loaded, checked at
+    most once per 'reload_interval' (config) seconds. Returns True if the
+    config was replaced; wrong one is reported and ignored (until modified
+    again)."""
+    global CONFIG, _CONFIG_STAMP, _CONFIG_CHECKED
+
+    interval = CONFIG.get('reload_interval', 2)
+    now = time.monotonic()
+    if not interval or now - _CONFIG_CHECKED < interval or \
+            not _CONFIG_LOCK.acquire(blocking=False):
+        return False
+    try:
+        _CONFIG_CHECKED = now
+        path = Path.cwd() / "config.yaml"
+        stamp = _config_stamp(path)
+        if stamp == _CONFIG_STAMP:
+            return False
+        _CONFIG_STAMP = stamp
+        config = settings.load(path)
+    except (IOError, OSError, settings.ConfigError) as error:
+        log.error('Cannot reload config, keeping the current one: %s', error)
+        return False
+    finally:
+        _CONFIG_LOCK.release()
+
+    changed = config.version != CONFIG.version
+    CONFIG = config
+    log.info('Config reloaded (%s)', 'changed' if changed else 'unchanged')
+    return changed
+
+
+def _list_of(value, kinds):
+    return isinstance(value, list) and all(isinstance(item, kinds)
+                                           for item in value)
+
+
+def _is_finite(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    try:
+        return math.isfinite(value)
+    except OverflowError:  # int too big for a float
+        return False
+
+
+def _is_valid_near(near):
+    """Check "near" selection of repeaters (see RepeaterIndex.near)."""
+    if near is None:
+        return True
+    return isinstance(near, dict) and \
+        isinstance(near.get('locator', ''), (str, type(None))) and \
+        all(near.get(key) is None or _is_finite(near[key])
+            for key in ('lat', 'lon', 'radius', 'count'))
+
+
+def is_valid_query(query):
+    """Check if decoded query has all parts (of right types) needed to
+    generate its file."""
+    if not isinstance(query, dict):
+        return False
+    contacts = query.get('contacts')
+    if not isinstance(contacts, dict) or \
+            not _list_of(contacts.get('adds'), str) or \
+            not _list_of(contacts.get('tgs'), (str, int)) or \
+            not isinstance(contacts.get('prio'), str) or \
+            not isinstance(contacts.get('igno', ''), (str, type(None))) or \
+            not _list_of(contacts.get('sp_prefix', []), str) or \
+            not _list_of(contacts.get('sp_area', []), (str, int)) or \
+            not isinstance(contacts.get('radio'), (str, type(None))):
+        return False
+    try:
+        [int(tg) for tg in contacts['tgs']]
+    except ValueError:
+        return False
+    channels = query.get('channels', {})
+    if not isinstance(channels, dict) or \
+            not isinstance(channels.get('radio'), (str, type(None))):
+        return False
+    repeaters = channels.get('repeaters', {})
+    return isinstance(repeaters, dict) and \
+        all(_list_of(repeaters.get(key, []), str)
+            for key in ('bands', 'modes')) and \
+        _list_of(repeaters.get('areas', []), (str, int)) and \
+        _is_valid_near(repeaters.get('near')) and \
+        isinstance(channels.get('services', {}), dict) and \
+        all(_list_of(freqs, (str, int, float))
+            for freqs in channels.get('services', {}).values()) and \
+        _list_of(channels.get('apmr', []), (str, int, float)) and \
+        _list_of(channels.get('dpmr', []), (str, int, float))
 
 
 def are_channels_requested(query):
@@ -70,3 +211,120 @@ def are_channels_requested(query):
     any_pmr = query.get('channels',{}).get('pmr', False)
 
     return any([any_repeater, any_service, any_pmr])
+
+
+def default_signals():
+    """Restore default handling of signals handled by Python code, in a
+    process forked (e.g. from gunicorn) to help its parent: handlers of the
+    parent are not meant for it and may keep it from stopping."""
+    for sig in signal.valid_signals():
+        if callable(signal.getsignal(sig)):
+            signal.signal(sig, signal.SIG_DFL)
+
+
+def chunked(lines, size=64 * 1024):
+    """Join (utf-8 encoded) lines into chunks of (at least) given size."""
+    buf = []
+    buf_len = 0
+    for line in lines:
+        buf.append(line)
+        buf_len += len(line)
+        if buf_len >= size:
+            yield b''.join(buf)
+            buf = []
+            buf_len = 0
+    if buf:
+        yield b''.join(buf)
+
+
+def primed(chunks):
+    """Chunks with the first one already generated, so errors of generation
+    (most likely at its start) are raised before a response is sent."""
+    chunks = iter(chunks)
+    for first in chunks:
+        return itertools.chain([first], chunks)
+    return []
+
+
+class _ZipSink:
+    """Write-only, non-seekable file collecting what ZipFile writes."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Take what has been written so far."""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return [data] if data else []
+
+
+def iter_zip(files):
+    """Generate zip archive of files, given as (name, chunks) pairs, piece
+    by piece without keeping the whole archive in memory."""
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, chunks in files:
+            with zip_file.open(name, 'w') as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+Deflated = namedtuple('Deflated', 'data,crc,size')
+
+
+def deflate(data):
+    """Compress (whole) file for zip archive, see iter_deflated_zip."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return Deflated(
+        data=compressor.compress(data) + compressor.flush(),
+        crc=zlib.crc32(data),
+        size=len(data)
+    )
+
+
+def iter_deflated_zip(files, date_time=None):
+    """Generate zip archive of already compressed files, given as (name,
+    Deflated) pairs, so the same file may be stored many times (and
+    compressed elsewhere) at the cost of compressing it once.
+
+    Files are dated date_time (datetime, now if not given), so the same
+    files make the same archive. Files must be smaller than 4 GiB, there is
+    no ZIP64 support."""
+    now = (date_time or datetime.now()).timetuple()
+    dos_time = now.tm_hour << 11 | now.tm_min << 5 | now.tm_sec // 2
+    dos_date = (now.tm_year - 1980) << 9 | now.tm_mon << 5 | now.tm_mday
+    central = []
+    offset = 0
+    for name, deflated in files:
+        encoded = name.encode()
+        flags = 0 if len(encoded) == len(name) else 0x800  # utf-8 name
+        fields = struct.pack(
+            '<HHHHHIIIH', 20, flags, zipfile.ZIP_DEFLATED, dos_time,
+            dos_date, deflated.crc, len(deflated.data), deflated.size,
+            len(encoded)
+        )
+        header = b'PK\x03\x04' + fields + b'\x00\x00' + encoded
+        central.append(
+            b'PK\x01\x02' + struct.pack('<H', 20) + fields +
+            struct.pack('<HHHHII', 0, 0, 0, 0, 0, offset) + encoded
+        )
+        yield header
+        yield deflated.data
+        offset += len(header) + len(deflated.data)
+
+    directory = b''.join(central)
+    yield directory + b'PK\x05\x06' + struct.pack(
+        '<HHHHIIH', 0, 0, len(central), len(central), len(directory),
+        offset, 0
+    )